@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Кэш ответов на вопросы по уроку: ключ — хэш урока и нормализованный вопрос. Перефразированный
+# вопрос к тому же уроку тоже попадает в кэш, если его косинусная близость по символьным
+# триграммам не ниже ANSWER_CACHE_SIMILARITY и числа в вопросах совпадают («задание 1» и «задание 2» —
+# разные вопросы, хотя их триграммы почти одинаковы)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "5000"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(24 * 60 * 60)))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.9"))
+ANSWER_CACHE_PER_LESSON = int(os.getenv("ANSWER_CACHE_PER_LESSON", "50"))
+
+_WORD_RE = re.compile(r"\w+")
+_NUMBER_RE = re.compile(r"\d+")
+
+def normalize_question(question):
+    # Регистр, пунктуация, «ё» и лишние пробелы не должны менять ключ
+    return " ".join(_WORD_RE.findall(question.lower().replace("ё", "е")))
+
+def lesson_key(skill, lesson):
+    return hashlib.sha256(f"{skill}\n{lesson}".encode("utf-8")).hexdigest()
+
+def question_vector(question):
+    """Нормированный вектор частот символьных триграмм вопроса (словарь триграмма -> вес)."""
+    padded = f" {question} "
+    counts = {}
+    for i in range(len(padded) - 2):
+        gram = padded[i:i + 3]
+        counts[gram] = counts.get(gram, 0) + 1
+    norm = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+    return {gram: count / norm for gram, count in counts.items()}
+
+def similarity(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(gram, 0.0) for gram, weight in a.items())
+
+class AnswerCache:
+    """LRU-кэш ответов в памяти процесса с поиском похожих вопросов к тому же уроку.
+
+    Похожие вопросы ищутся только среди вопросов к одному уроку (не больше per_lesson),
+    поэтому поиск — простой перебор без индекса.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_SIMILARITY,
+                 per_lesson=ANSWER_CACHE_PER_LESSON):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.per_lesson = per_lesson
+        self._entries = OrderedDict()  # (урок, вопрос) -> (ответ, вектор, время создания)
+        self._lessons = {}  # урок -> вопросы к нему в порядке добавления
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _remove(self, key):
+        del self._entries[key]
+        lesson, question = key
+        questions = self._lessons[lesson]
+        del questions[question]
+        if not questions:
+            del self._lessons[lesson]
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[2] > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, skill, lesson, question):
+        lesson = lesson_key(skill, lesson)
+        question = normalize_question(question)
+        entry = self._fresh((lesson, question))
+        if entry is not None:
+            self.hits += 1
+            return entry[0]
+        vector = question_vector(question)
+        numbers = _NUMBER_RE.findall(question)
+        best, best_score = None, self.threshold
+        for candidate in self._lessons.get(lesson, ()):
+            if _NUMBER_RE.findall(candidate) != numbers:
+                continue
+            entry = self._entries[(lesson, candidate)]
+            score = similarity(vector, entry[1])
+            if score >= best_score:
+                best, best_score = candidate, score
+        if best is not None:
+            entry = self._fresh((lesson, best))
+            if entry is not None:
+                self.similar_hits += 1
+                logger.info(f"Похожий вопрос найден в кэше (близость {best_score:.2f})")
+                return entry[0]
+        self.misses += 1
+        return None
+
+    def set(self, skill, lesson, question, answer):
+        lesson = lesson_key(skill, lesson)
+        question = normalize_question(question)
+        key = (lesson, question)
+        if key in self._entries:
+            self._remove(key)
+        questions = self._lessons.setdefault(lesson, {})
+        if len(questions) >= self.per_lesson:
+            self._remove((lesson, next(iter(questions))))
+            self.evicted += 1
+            questions = self._lessons.setdefault(lesson, {})
+        questions[question] = None
+        self._entries[key] = (answer, question_vector(question), time.time())
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evicted += 1
+
+    def stats(self):
+        lookups = self.hits + self.similar_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "lessons": len(self._lessons),
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "hit_rate": round((self.hits + self.similar_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+answer_cache = AnswerCache()
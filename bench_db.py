@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import aiosqlite
+
+# Сохранения прогресса в секунду до и после общего слоя доступа к базе (database.py).
+# «до» — как прежний bot.save_user_course: новое соединение aiosqlite на каждое сохранение,
+# курс целиком строкой и отдельный commit в режиме журнала по умолчанию. «после» — долгоживущее
+# соединение для записи с WAL и настроенными PRAGMA: полное сохранение курса и сохранение
+# только метаданных прогресса, которое теперь делает кнопка «Следующий урок».
+#
+#   python bench_db.py --saves 3000 --concurrency 50
+
+BEFORE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS user_courses (
+        user_id INTEGER PRIMARY KEY, course TEXT, current_day INTEGER, chat_id INTEGER, progress INTEGER,
+        skill TEXT, current_question INTEGER, experience TEXT, goal TEXT, preferences TEXT
+    )
+"""
+
+def prepare_environment(args, workdir):
+    # Настройки database читаются при импорте
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'progress.db')}",
+        "LOG_LEVEL": args.log_level,
+    })
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000 if values else 0.0
+
+def course_data(user_id, day):
+    return {
+        "skill": "Python", "chat_id": user_id, "current_day": day, "progress": day * 14, "current_question": 0,
+        "experience": "Новичок", "goal": "Найти работу", "preferences": "Больше практики",
+        "course": [f"<b>День {i + 1}: Урок</b>\n" + "Текст урока. " * 150 for i in range(7)],
+    }
+
+async def save_before(path, user_id, data):
+    async with aiosqlite.connect(path) as db:
+        await db.execute("""
+            INSERT OR REPLACE INTO user_courses (
+                user_id, course, current_day, chat_id, progress, skill, current_question, experience, goal, preferences
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            user_id, str(data.get("course", [])), data.get("current_day", 0), data.get("chat_id", 0),
+            data.get("progress", 0), data.get("skill", ""), data.get("current_question", 0),
+            data.get("experience", ""), data.get("goal", ""), data.get("preferences", "")
+        ))
+        await db.commit()
+
+async def run(name, save, args):
+    latencies = []
+    errors = 0
+
+    async def worker(worker_id):
+        nonlocal errors
+        for step in range(args.saves // args.concurrency):
+            user_id = worker_id * 1000 + step % args.users_per_worker
+            started = time.perf_counter()
+            try:
+                await save(user_id, course_data(user_id, step % 7))
+            except aiosqlite.OperationalError:
+                # Прежний код не переживал «database is locked»: обработчик падал, прогресс терялся
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(worker_id) for worker_id in range(args.concurrency)])
+    duration = time.perf_counter() - started
+    rate = len(latencies) / duration
+    print(f"  {name:16} {len(latencies)} сохранений за {duration:6.2f} с: {rate:7.0f} в секунду, "
+          f"p50 {percentile(latencies, 0.5):.2f} мс p99 {percentile(latencies, 0.99):.2f} мс, ошибок {errors}", flush=True)
+    return rate, errors
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="coursecraft-bench-")
+    prepare_environment(args, workdir)
+    import database
+    from logging_setup import setup_logging
+    setup_logging()
+    try:
+        print(f"Сохранений: {args.saves}, одновременно: {args.concurrency}")
+        before_path = os.path.join(workdir, "before.db")
+        async with aiosqlite.connect(before_path) as db:
+            await db.execute(BEFORE_SCHEMA)
+            await db.commit()
+        before, _ = await run("до: connect", lambda user_id, data: save_before(before_path, user_id, data), args)
+        await database.init_progress_db()
+        full, full_errors = await run("после: курс", database.save_user_course, args)
+        progress, progress_errors = await run("после: прогресс", database.save_user_progress, args)
+        print(f"Ускорение: курс целиком x{full / before:.1f}, только прогресс x{progress / before:.1f}")
+        saved = await database.load_user_course(0)
+        ok = saved is not None and len(saved["course"]) == 7 and not full_errors and not progress_errors
+        print("OK" if ok else "ОШИБКА: сохранения с ошибками или сохранённый курс не читается")
+        return ok
+    finally:
+        await database.close_databases()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сохранения прогресса в секунду до и после пула соединений")
+    parser.add_argument("--saves", type=int, default=3000, help="сколько сохранений сделать в каждом режиме")
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько пользователей сохраняются одновременно")
+    parser.add_argument("--users-per-worker", type=int, default=20, help="сколько разных пользователей у одного потока")
+    parser.add_argument("--log-level", default="WARNING")
+    raise SystemExit(0 if asyncio.run(main(parser.parse_args())) else 1)
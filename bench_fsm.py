@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+
+# Задержка get/set состояний FSM при одновременных апдейтах: MemoryStorage aiogram против
+# SQLiteStorage (fsm_storage.py) с холодным и прогретым кэшем. Каждый пользователь повторяет
+# шаг анкеты: прочитать состояние и данные, дописать данные и сменить состояние.
+#
+#   python bench_fsm.py --users 2000 --steps 10
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000 if values else 0.0
+
+async def user_flow(storage, user_id, steps, latencies):
+    for step in range(steps):
+        started = time.perf_counter()
+        await storage.get_state(chat=user_id, user=user_id)
+        await storage.get_data(chat=user_id, user=user_id)
+        latencies["get"].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        await storage.update_data(chat=user_id, user=user_id, data={"skill": "Python", "plan": ["День"] * 7, "step": step})
+        await storage.set_state(chat=user_id, user=user_id, state=f"CourseForm:step{step}")
+        latencies["set"].append(time.perf_counter() - started)
+        await asyncio.sleep(random.random() * 0.01)
+
+async def run(storage, name, args):
+    latencies = {"get": [], "set": []}
+    started = time.perf_counter()
+    await asyncio.gather(*[user_flow(storage, user_id, args.steps, latencies) for user_id in range(args.users)])
+    duration = time.perf_counter() - started
+    await storage.close()
+    print(f"  {name:12} {duration:6.2f} с  "
+          f"get p50 {percentile(latencies['get'], 0.5):.3f} мс p99 {percentile(latencies['get'], 0.99):.3f} мс  "
+          f"set p50 {percentile(latencies['set'], 0.5):.3f} мс p99 {percentile(latencies['set'], 0.99):.3f} мс", flush=True)
+
+async def main(args):
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="coursecraft-bench-")
+    # Настройки database и fsm_storage читаются при импорте
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'progress.db')}",
+        "FSM_FLUSH_INTERVAL": str(args.flush_interval),
+        "LOG_LEVEL": args.log_level,
+    })
+    import database
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+    from fsm_storage import SQLiteStorage
+    from logging_setup import setup_logging
+    from metrics import db_seconds
+    setup_logging()
+    try:
+        await database.init_progress_db()
+        print(f"Пользователей: {args.users}, шагов: {args.steps}")
+        await run(MemoryStorage(), "memory", args)
+        progress_db = database.get_db(database.PROGRESS_DB).name
+        writes_before = db_seconds._values.get((progress_db, "write"), [None, 0, 0])[2]
+        storage = SQLiteStorage()
+        await run(storage, "sqlite cold", args)
+        await run(storage, "sqlite warm", args)
+        transactions = db_seconds._values[(progress_db, "write")][2] - writes_before
+        print(f"Записей состояний: {args.users * args.steps * 2 * 2}, транзакций: {transactions}")
+        # Новый экземпляр хранилища (как после перезапуска) читает сохранённое состояние из базы
+        restarted = SQLiteStorage()
+        state = await restarted.get_state(chat=0, user=0)
+        step = (await restarted.get_data(chat=0, user=0)).get("step")
+        await restarted.close()
+        ok = state == f"CourseForm:step{args.steps - 1}" and step == args.steps - 1
+        print(f"После перезапуска: {state}, step={step}" + ("" if ok else " — ОШИБКА: состояние не сохранилось"))
+        return ok
+    finally:
+        await database.close_databases()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Задержка хранилищ состояний FSM при одновременных апдейтах")
+    parser.add_argument("--users", type=int, default=2000, help="сколько пользователей проходят анкету одновременно")
+    parser.add_argument("--steps", type=int, default=10, help="сколько шагов делает каждый пользователь")
+    parser.add_argument("--flush-interval", type=float, default=0.05, help="FSM_FLUSH_INTERVAL, секунды")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--seed", type=int, default=1)
+    raise SystemExit(0 if asyncio.run(main(parser.parse_args())) else 1)
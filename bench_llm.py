@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import math
+import os
+import shutil
+import tempfile
+import time
+
+# Одновременные вопросы пользователей к Gemini: задержки ответов должны перекрываться,
+# а не идти одна за другой. «до» — синхронный вызов, как прежний model.generate_content
+# прямо в обработчике: он останавливает цикл событий, и пользователи ждут друг друга.
+# «после» — gemini_service.answer_question с фейковым бэкендом (LLM_BACKEND=fake) через
+# планировщик: одновременно идут до GEMINI_MAX_CONCURRENCY запросов, цикл событий свободен.
+#
+#   python bench_llm.py --users 20 --latency 1.0
+
+def prepare_environment(args, workdir):
+    # Настройки llm_backend, llm_scheduler и кэшей читаются при импорте
+    os.environ.update({
+        "LLM_BACKEND": "fake",
+        "FAKE_LLM_LATENCY": str(args.latency),
+        "GEMINI_RPM": "1000000", "GEMINI_TPM": "1000000000",
+        "GEMINI_MAX_CONCURRENCY": str(args.concurrency),
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'progress.db')}",
+        "RESOURCES_DB": os.path.join(workdir, "resources.db"),
+        "CACHE_DB": os.path.join(workdir, "cache.db"),
+        "LOG_LEVEL": args.log_level,
+    })
+
+def max_overlap(intervals):
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    current = best = 0
+    for _, change in events:
+        current += change
+        best = max(best, current)
+    return best
+
+async def measure_lag(stop, lags):
+    # Насколько позже заказанного просыпается цикл событий: так же опаздывал бы любой апдейт
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.05)
+        lags.append(time.perf_counter() - started - 0.05)
+
+async def run(name, ask, calls, args):
+    # Все пользователи задают вопрос в один момент; задержка — от вопроса до ответа
+    latencies = []
+    lags = []
+    calls.clear()
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(measure_lag(stop, lags))
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+
+    async def user(user_id):
+        await ask(f"Вопрос пользователя {user_id}: с чего начать?")
+        latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*[user(user_id) for user_id in range(args.users)])
+    duration = time.perf_counter() - started
+    stop.set()
+    await monitor
+    latencies.sort()
+    overlap = max_overlap(calls)
+    print(f"  {name:6} {duration:6.2f} с на {args.users} вопросов: ответ через p50 {latencies[len(latencies) // 2]:.2f} с, "
+          f"max {latencies[-1]:.2f} с; запросов к модели одновременно до {overlap}, "
+          f"цикл событий опаздывал до {max(lags, default=0) * 1000:.0f} мс", flush=True)
+    return duration, overlap
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="coursecraft-bench-")
+    prepare_environment(args, workdir)
+    import database
+    from gemini_service import ANSWER_ERROR, answer_question
+    from llm_backend import llm_backend
+    from logging_setup import setup_logging
+    setup_logging()
+    answers = []
+    calls = []  # (начало, конец) каждого запроса к модели
+    generate = llm_backend.generate
+
+    async def timed_generate(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await generate(*args, **kwargs)
+        finally:
+            calls.append((started, time.perf_counter()))
+
+    llm_backend.generate = timed_generate
+
+    async def ask_blocking(question):
+        started = time.perf_counter()
+        time.sleep(args.latency)
+        calls.append((started, time.perf_counter()))
+
+    async def ask(question):
+        answers.append(await answer_question(question))
+
+    try:
+        print(f"Пользователей: {args.users}, задержка ответа {args.latency} с, GEMINI_MAX_CONCURRENCY={args.concurrency}")
+        if args.mode in ("blocking", "both"):
+            await run("до", ask_blocking, calls, args)
+        duration, overlap = await run("после", ask, calls, args)
+        # Волнами по GEMINI_MAX_CONCURRENCY запросов, а не по одному
+        expected = min(args.users, args.concurrency)
+        waves = math.ceil(args.users / args.concurrency)
+        ok = overlap >= expected and ANSWER_ERROR not in answers and duration < waves * args.latency * 1.5
+        print("OK" if ok else f"ОШИБКА: ответы не перекрываются (ожидалось одновременно {expected}) или пришли с ошибкой")
+        return ok
+    finally:
+        await database.close_databases()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перекрытие задержек Gemini у одновременных пользователей")
+    parser.add_argument("--users", type=int, default=20, help="сколько пользователей задают вопрос одновременно")
+    parser.add_argument("--latency", type=float, default=1.0, help="задержка ответа модели, секунды")
+    parser.add_argument("--concurrency", type=int, default=8, help="GEMINI_MAX_CONCURRENCY")
+    parser.add_argument("--mode", choices=("blocking", "async", "both"), default="both")
+    parser.add_argument("--log-level", default="WARNING")
+    raise SystemExit(0 if asyncio.run(main(parser.parse_args())) else 1)
@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import time
+from collections import defaultdict, deque
+from aiohttp import web
+from loadtest import FakeBotAPI
+
+# Проверка очереди исходящих сообщений (outbox.py) на локальном Bot API, который, как Telegram,
+# отвечает 429 с retry_after при превышении лимитов на бота и на чат. Одновременно уходят
+# пачка напоминаний (PRIORITY_BULK) и ответы пользователям; обычный Bot теряет часть сообщений,
+# ThrottledBot должен доставить все, пропуская ответы пользователям вперёд напоминаний.
+#
+#   python bench_outbox.py --reminders 300 --users 20
+
+class RateLimitedBotAPI(FakeBotAPI):
+    def __init__(self, global_limit, chat_limit, retry_after=1):
+        super().__init__(latency=lambda: 0.01)
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.retry_after = retry_after
+        self.rejected = 0
+        self._sent = deque()
+        self._sent_by_chat = defaultdict(deque)
+
+    async def handle(self, request):
+        data = await request.post()
+        now = time.monotonic()
+        chat_sent = self._sent_by_chat[data.get("chat_id")]
+        for sent in (self._sent, chat_sent):
+            while sent and now - sent[0] > 1:
+                sent.popleft()
+        if len(self._sent) >= self.global_limit or len(chat_sent) >= self.chat_limit:
+            self.rejected += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        self._sent.append(now)
+        chat_sent.append(now)
+        return await super().handle(request)
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000
+
+def describe(values):
+    if not values:
+        return "не доставлены"
+    return f"p50 {percentile(values, 0.5):.0f} мс p95 {percentile(values, 0.95):.0f} мс"
+
+async def run(kind, args):
+    from aiogram import Bot
+    from aiogram.bot.api import TelegramAPIServer
+    from aiogram.utils.exceptions import RetryAfter
+    from llm_scheduler import PRIORITY_BULK
+    from outbox import Outbox, ThrottledBot, send_priority
+    api = RateLimitedBotAPI(args.global_limit, args.chat_limit)
+    await api.start()
+    server = TelegramAPIServer.from_base(api.url)
+    if kind == "outbox":
+        bot = ThrottledBot("123456:bench", server=server, outbox=Outbox())
+    else:
+        bot = Bot("123456:bench", server=server)
+    dropped = 0
+    latencies = {"interactive": [], "reminder": []}
+
+    async def send(chat_id, text, kind):
+        nonlocal dropped
+        started = time.perf_counter()
+        try:
+            await bot.send_message(chat_id, text)
+            latencies[kind].append(time.perf_counter() - started)
+        except RetryAfter:
+            dropped += 1
+
+    async def reminder(chat_id):
+        send_priority.set(PRIORITY_BULK)
+        await send(chat_id, "Готов к новому уроку?", "reminder")
+
+    async def user(chat_id):
+        # Ответ, отметка прогресса, урок и правки потокового вывода
+        for i in range(args.messages):
+            await send(chat_id, f"Сообщение {i}", "interactive")
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *[reminder(100000 + i) for i in range(args.reminders)], *[user(i) for i in range(args.users)]
+    )
+    duration = time.perf_counter() - started
+    total = args.reminders + args.users * args.messages
+    print(f"  {kind:6} {duration:5.1f} с: доставлено {total - dropped}/{total}, ответов 429 {api.rejected}, "
+          f"потеряно {dropped}; ответы {describe(latencies['interactive'])}, "
+          f"напоминания {describe(latencies['reminder'])}", flush=True)
+    await (await bot.get_session()).close()
+    await api.stop()
+    return dropped
+
+async def main(args):
+    print(f"Напоминаний: {args.reminders}, пользователей: {args.users} по {args.messages} сообщений, "
+          f"лимиты Bot API: {args.global_limit}/с на бота, {args.chat_limit}/с на чат")
+    if args.mode in ("plain", "both"):
+        await run("plain", args)
+    if args.mode in ("outbox", "both"):
+        dropped = await run("outbox", args)
+        if dropped:
+            print("ОШИБКА: outbox потерял сообщения")
+            return False
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка outbox на локальном Bot API с лимитами Telegram")
+    parser.add_argument("--reminders", type=int, default=300, help="сколько напоминаний уходит одновременно")
+    parser.add_argument("--users", type=int, default=20, help="сколько пользователей получают ответы")
+    parser.add_argument("--messages", type=int, default=5, help="сколько сообщений получает каждый пользователь")
+    parser.add_argument("--global-limit", type=int, default=30, help="сообщений в секунду на бота до 429")
+    parser.add_argument("--chat-limit", type=int, default=3, help="сообщений в секунду в чат до 429")
+    parser.add_argument("--mode", choices=("plain", "outbox", "both"), default="both")
+    raise SystemExit(0 if asyncio.run(main(parser.parse_args())) else 1)
@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+# Отложенная запись прогресса (user_repository.py): сколько нажатий «Следующий урок» в секунду
+# успевают сохраниться и сколькими транзакциями, когда пользователей больше, чем помещается
+# в кэш. Затем проверка сбоя: пока запись идёт, кэш переполняется новыми пользователями,
+# а запись падает — повторная запись должна сохранить прогресс всех пользователей.
+#
+#   python bench_progress.py --users 5000 --steps 7 --cache 1000
+
+def prepare_environment(args, workdir):
+    # Настройки database и user_repository читаются при импорте
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'progress.db')}",
+        "LOG_LEVEL": args.log_level,
+    })
+
+def new_course(user_id):
+    return {
+        "skill": "Python", "chat_id": user_id, "current_day": 0, "completed_lessons": [],
+        "course": [f"<b>День {day + 1}: Урок</b>\nТекст урока {day + 1}" for day in range(7)],
+    }
+
+async def next_lesson(repository, user_id):
+    data = await repository.get_course(user_id)
+    data["completed_lessons"].append((data["skill"], data["current_day"]))
+    data["current_day"] += 1
+    await repository.save_progress(user_id)
+
+async def run(args):
+    import database
+    from metrics import db_seconds
+    from user_repository import UserRepository
+    repository = UserRepository(max_users=args.cache)
+    progress_db = database.get_db(database.PROGRESS_DB).name
+    for user_id in range(args.users):
+        await repository.start_course(user_id, new_course(user_id))
+    await repository.close()
+    writes_before = db_seconds._values[(progress_db, "write")][2]
+    started = time.perf_counter()
+    for _ in range(args.steps):
+        await asyncio.gather(*[next_lesson(repository, user_id) for user_id in range(args.users)])
+    await repository.close()
+    duration = time.perf_counter() - started
+    transactions = db_seconds._values[(progress_db, "write")][2] - writes_before
+    saves = args.users * args.steps
+    print(f"Сохранений прогресса: {saves} за {duration:.2f} с ({saves / duration:.0f} в секунду), "
+          f"транзакций {transactions}, {repository.stats()}", flush=True)
+    restored = await database.load_user_course(args.users - 1)
+    return restored["current_day"] == args.steps
+
+async def check_failed_flush(args):
+    import user_repository
+    from database import load_user_course
+    repository = user_repository.UserRepository(max_users=args.check_cache, flush_interval=3600)
+    users = range(args.users, args.users + args.check_cache)
+    for user_id in users:
+        await repository.start_course(user_id, new_course(user_id))
+    save_user_changes = user_repository.save_user_changes
+
+    async def failing_save(courses, lessons):
+        # Пока запись «идёт», в кэш приходят новые пользователи без курса, и он переполняется
+        for user_id in range(-args.check_cache * 2, 0):
+            await repository.get(user_id)
+        raise RuntimeError("database is locked")
+
+    user_repository.save_user_changes = failing_save
+    try:
+        await repository.flush()
+    except RuntimeError:
+        pass
+    finally:
+        user_repository.save_user_changes = save_user_changes
+    await repository.flush()
+    saved = [user_id for user_id in users if await load_user_course(user_id) is not None]
+    print(f"Запись упала при переполненном кэше ({repository.stats()['cached']}/{args.check_cache}), "
+          f"после повторной записи сохранено курсов: {len(saved)} из {len(users)}")
+    return len(saved) == len(users)
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="coursecraft-bench-")
+    prepare_environment(args, workdir)
+    import database
+    from logging_setup import setup_logging
+    setup_logging()
+    try:
+        await database.init_progress_db()
+        print(f"Пользователей: {args.users}, шагов: {args.steps}, кэш: {args.cache}")
+        ok = await run(args)
+        if not ok:
+            print("ОШИБКА: прогресс последнего пользователя не сохранился")
+        if not await check_failed_flush(args):
+            print("ОШИБКА: прогресс потерян после неудачной записи")
+            ok = False
+        print("OK" if ok else "ОШИБКА")
+        return ok
+    finally:
+        await database.close_databases()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отложенная запись прогресса пользователей")
+    parser.add_argument("--users", type=int, default=5000, help="сколько пользователей проходят курс")
+    parser.add_argument("--steps", type=int, default=7, help="сколько уроков проходит каждый пользователь")
+    parser.add_argument("--cache", type=int, default=1000, help="USER_CACHE_SIZE")
+    parser.add_argument("--check-cache", type=int, default=10, help="размер кэша в проверке неудачной записи")
+    parser.add_argument("--log-level", default="WARNING")
+    raise SystemExit(0 if asyncio.run(main(parser.parse_args())) else 1)
@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+# Проверка планировщика напоминаний на большом числе пользователей: напоминания всех
+# пользователей хранятся в таблице reminders, а рассылает их одна фоновая задача, поэтому
+# число корутин и память не должны расти с числом напоминаний. Бот заменён счётчиком вызовов,
+# база прогресса — временной копией.
+#
+#   python bench_reminders.py --reminders 100000
+
+class CountingBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.sent += 1
+
+def prepare_environment(args, workdir):
+    # Настройки reminders и database читаются при импорте
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'progress.db')}",
+        "REMINDER_RATE": str(args.rate),
+        "REMINDER_BATCH_SIZE": str(args.batch),
+        "LOG_LEVEL": args.log_level,
+    })
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="coursecraft-bench-")
+    prepare_environment(args, workdir)
+    import database
+    from logging_setup import setup_logging
+    from metrics import memory_stats
+    from reminders import ReminderScheduler, LAST_DAY
+    setup_logging()
+    try:
+        await database.init_progress_db()
+        # Каждый седьмой пользователь уже на последнем дне: его напоминание удаляется без отправки
+        await database.get_db(database.PROGRESS_DB).executemany(
+            "INSERT INTO user_courses (user_id, current_day, chat_id) VALUES (?, ?, ?)",
+            [(user_id, user_id % (LAST_DAY + 1), user_id) for user_id in range(args.reminders)]
+        )
+        expected = sum(1 for user_id in range(args.reminders) if user_id % (LAST_DAY + 1) < LAST_DAY)
+        tasks_before = len(asyncio.all_tasks())
+        rss_before = memory_stats()["rss_bytes"]
+        scheduler = ReminderScheduler()
+        bot = CountingBot()
+        started = time.perf_counter()
+        for user_id in range(args.reminders):
+            await scheduler.schedule(user_id, user_id, delay=1 + user_id % args.spread)
+        # Повторное планирование того же пользователя заменяет напоминание
+        await scheduler.schedule(0, 0, delay=1)
+        rows = (await database.get_db(database.PROGRESS_DB).fetchone("SELECT COUNT(*) FROM reminders"))[0]
+        print(f"Запланировано {args.reminders} за {time.perf_counter() - started:.1f} с: строк {rows}, "
+              f"задач asyncio {len(asyncio.all_tasks()) - tasks_before}, "
+              f"RSS +{(memory_stats()['rss_bytes'] - rss_before) / 2 ** 20:.1f} МБ", flush=True)
+
+        scheduler.start(bot)
+        started = time.perf_counter()
+        max_tasks = 0
+        while await database.next_reminder_at() is not None and bot.sent < expected:
+            if time.perf_counter() - started > args.timeout:
+                break
+            max_tasks = max(max_tasks, len(asyncio.all_tasks()) - tasks_before)
+            await asyncio.sleep(0.5)
+        duration = time.perf_counter() - started
+        await scheduler.stop()
+        print(f"Отправлено {bot.sent} из {expected} за {duration:.1f} с ({bot.sent / duration:.0f} в секунду), "
+              f"задач asyncio не больше {max_tasks}, RSS +{(memory_stats()['rss_bytes'] - rss_before) / 2 ** 20:.1f} МБ")
+        ok = rows == args.reminders and bot.sent == expected
+        print("OK" if ok else "ОШИБКА: число строк или отправленных напоминаний не совпало")
+        return ok
+    finally:
+        await database.close_databases()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка планировщика напоминаний")
+    parser.add_argument("--reminders", type=int, default=100000, help="сколько пользователей с напоминаниями")
+    parser.add_argument("--spread", type=int, default=3, help="на сколько секунд разнесены сроки напоминаний")
+    parser.add_argument("--rate", type=float, default=100000, help="REMINDER_RATE, сообщений в секунду")
+    parser.add_argument("--batch", type=int, default=1000, help="REMINDER_BATCH_SIZE")
+    parser.add_argument("--timeout", type=float, default=300, help="сколько секунд ждать рассылки")
+    parser.add_argument("--log-level", default="WARNING")
+    raise SystemExit(0 if asyncio.run(main(parser.parse_args())) else 1)
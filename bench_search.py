@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+from itertools import accumulate
+
+# Поиск материалов для промпта урока на синтетическом каталоге: прежний запрос
+# tags LIKE '%навык%' (полный просмотр таблицы, все совпадения) против полнотекстового
+# индекса FTS5 с ранжированием bm25 и лимитом (database.get_resources_by_tags).
+# Теги, слова названий и текстов распределены по Ципфу, как в настоящем каталоге:
+# немного популярных навыков и длинный хвост редких. Навыки для запросов тоже выбираются по Ципфу.
+#
+#   python bench_search.py --resources 100000 --queries 500
+
+SKILLS = [
+    "python", "английский язык", "javascript", "маркетинг", "java", "excel", "дизайн", "sql",
+    "публичные выступления", "финансы", "c++", "фотография", "гитара", "тайм-менеджмент", "go",
+]
+LIKE_SQL = "SELECT title, author, type, content FROM resources WHERE tags LIKE ?"
+
+def prepare_environment(args, workdir):
+    # Настройки database читаются при импорте
+    os.environ.update({
+        "RESOURCES_DB": os.path.join(workdir, "resources.db"),
+        "CACHE_DB": os.path.join(workdir, "cache.db"),
+        "LOG_LEVEL": args.log_level,
+    })
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000 if values else 0.0
+
+class Zipf:
+    def __init__(self, population, exponent, rng):
+        self.population = population
+        self.cum_weights = list(accumulate(1 / rank ** exponent for rank in range(1, len(population) + 1)))
+        self.rng = rng
+
+    def sample(self, k=1):
+        return self.rng.choices(self.population, cum_weights=self.cum_weights, k=k)
+
+def catalogue(args, rng):
+    tags = Zipf(SKILLS + [f"навык{i}" for i in range(args.tags - len(SKILLS))], args.exponent, rng)
+    words = Zipf([f"термин{i}" for i in range(args.words)], args.exponent, rng)
+    for i in range(args.resources):
+        yield (
+            f"{' '.join(words.sample(4)).capitalize()} {i}", f"Автор {i % 997}", rng.choice(("book", "article")),
+            " ".join(words.sample(args.content_words)), ", ".join(set(tags.sample(rng.randint(1, 3)))),
+        )
+
+async def run(name, search, queries):
+    latencies = []
+    returned = 0
+    for skill in queries:
+        started = time.perf_counter()
+        rows = await search(skill)
+        latencies.append(time.perf_counter() - started)
+        returned += len(rows)
+    total = sum(latencies)
+    print(f"  {name:6} {len(queries) / total:7.0f} запросов/с  p50 {percentile(latencies, 0.5):7.2f} мс  "
+          f"p99 {percentile(latencies, 0.99):7.2f} мс  материалов в ответе в среднем {returned / len(queries):.0f}",
+          flush=True)
+    return total
+
+async def main(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="coursecraft-bench-")
+    prepare_environment(args, workdir)
+    import database
+    from logging_setup import setup_logging
+    setup_logging()
+    try:
+        await database.init_db()
+        started = time.perf_counter()
+        inserted, _ = await database.add_resources_bulk(catalogue(args, rng), batch_size=5000)
+        print(f"Каталог: {inserted} материалов, {args.tags} тегов, импорт с индексом за {time.perf_counter() - started:.1f} с")
+        db = database.get_db(database.RESOURCES_DB)
+        queries = Zipf(SKILLS, args.exponent, rng).sample(args.queries)
+
+        async def like(skill):
+            return await db.fetchall(LIKE_SQL, (f"%{skill}%",))
+
+        like_total = await run("LIKE", like, queries)
+        fts_total = await run("FTS5", database.get_resources_by_tags, queries)
+        print(f"Ускорение x{like_total / fts_total:.1f}")
+        # LIKE находит «java» внутри «javascript»; индекс ищет целые слова
+        like_rows = len(await like("java"))
+        only_java = (await db.fetchone(
+            "SELECT COUNT(*) FROM resources WHERE tags LIKE '%java%' AND tags NOT LIKE '%javascript%'"
+        ))[0]
+        found = await database.get_resources_by_tags("java", limit=args.check_limit)
+        tags = await db.fetchall(
+            f"SELECT tags FROM resources WHERE title IN ({', '.join('?' * len(found))})", [row[0] for row in found]
+        )
+        fts_wrong = sum(1 for (row_tags,) in tags if "java" not in [tag.strip() for tag in row_tags.split(",")])
+        print(f"Запрос «java»: LIKE возвращает {like_rows} материалов, из них с тегом java {only_java}; "
+              f"у FTS5 из первых {len(found)} без тега java: {fts_wrong}")
+        ok = fts_wrong == 0 and fts_total < like_total
+        print("OK" if ok else "ОШИБКА: индекс нашёл лишнее или оказался медленнее LIKE")
+        return ok
+    finally:
+        await database.close_databases()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Поиск по каталогу материалов: LIKE против FTS5")
+    parser.add_argument("--resources", type=int, default=100000, help="сколько материалов в каталоге")
+    parser.add_argument("--tags", type=int, default=2000, help="сколько разных тегов")
+    parser.add_argument("--words", type=int, default=20000, help="сколько разных слов в названиях и текстах")
+    parser.add_argument("--content-words", type=int, default=60, help="длина текста материала в словах")
+    parser.add_argument("--exponent", type=float, default=1.1, help="показатель распределения Ципфа")
+    parser.add_argument("--queries", type=int, default=500, help="сколько поисковых запросов сделать")
+    parser.add_argument("--check-limit", type=int, default=50, help="сколько результатов FTS5 проверить на «java»")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--seed", type=int, default=1)
+    raise SystemExit(0 if asyncio.run(main(parser.parse_args())) else 1)
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import aiosqlite
+from database import RESOURCES_DB, get_db
+
+logger = logging.getLogger(__name__)
+
+# Кэш ответов Gemini: срок жизни записи и максимальное число записей (лишние вытесняются по LRU)
+CACHE_DB = os.getenv("CACHE_DB", RESOURCES_DB)
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(7 * 24 * 60 * 60)))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+# last_used обновляется не чаще раза в CACHE_TOUCH_INTERVAL секунд: для LRU такой точности
+# хватает, а попадание в кэш не занимает блокировку записи
+CACHE_TOUCH_INTERVAL = int(os.getenv("CACHE_TOUCH_INTERVAL", "3600"))
+# Вытеснение запускается, когда записей больше CACHE_MAX_ENTRIES, и оставляет на эту долю
+# меньше, чтобы следующие записи не запускали его снова
+CACHE_EVICT_FRACTION = 0.1
+
+def normalize(value):
+    # Регистр и лишние пробелы не должны менять ключ кэша
+    return " ".join(str(value).lower().split())
+
+def make_key(namespace, *parts):
+    payload = json.dumps([namespace] + [normalize(part) for part in parts], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ResponseCache:
+    """Постоянный кэш ответов, адресуемый по содержимому входных данных запроса."""
+
+    def __init__(self, path=CACHE_DB, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, touch_interval=CACHE_TOUCH_INTERVAL):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.hits = {}
+        self.misses = {}
+        self._rows = 0  # оценка сверху числа записей: замена записи тоже считается
+        self._ready = False
+
+    async def _connect(self):
+        db = get_db(self.path)
+        if not self._ready:
+            async with db.transaction() as conn:
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS response_cache (
+                        key TEXT PRIMARY KEY,
+                        namespace TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_used REAL NOT NULL
+                    )
+                """)
+                await conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)")
+                async with conn.execute("SELECT COUNT(*) FROM response_cache") as cursor:
+                    self._rows = (await cursor.fetchone())[0]
+            self._ready = True
+        return db
+
+    async def get(self, namespace, *parts):
+        """Возвращает закэшированное значение или None; ошибки кэша не мешают запросу."""
+        key = make_key(namespace, *parts)
+        now = time.time()
+        try:
+            db = await self._connect()
+            row = await db.fetchone("SELECT value, created_at, last_used FROM response_cache WHERE key = ?", (key,))
+            if row is not None and now - row[1] <= self.ttl and now - row[2] > self.touch_interval:
+                await db.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+        except aiosqlite.Error as e:
+            logger.warning(f"Ошибка чтения кэша '{namespace}': {e}")
+            row = None
+        if row is None or now - row[1] > self.ttl:
+            self.misses[namespace] = self.misses.get(namespace, 0) + 1
+            return None
+        self.hits[namespace] = self.hits.get(namespace, 0) + 1
+        return json.loads(row[0])
+
+    async def set(self, namespace, value, *parts):
+        now = time.time()
+        try:
+            db = await self._connect()
+            async with db.transaction() as conn:
+                await conn.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, namespace, value, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (make_key(namespace, *parts), namespace, json.dumps(value, ensure_ascii=False), now, now)
+                )
+                self._rows += 1
+                if self._rows > self.max_entries:
+                    await self._evict(conn, now)
+        except aiosqlite.Error as e:
+            logger.warning(f"Ошибка записи в кэш '{namespace}': {e}")
+
+    async def _evict(self, conn, now):
+        # Сначала устаревшие записи, затем давно не использованные сверх keep
+        keep = self.max_entries - int(self.max_entries * CACHE_EVICT_FRACTION)
+        await conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl,))
+        await conn.execute("""
+            DELETE FROM response_cache WHERE key IN (
+                SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, (keep,))
+        async with conn.execute("SELECT COUNT(*) FROM response_cache") as cursor:
+            self._rows = (await cursor.fetchone())[0]
+
+    def stats(self):
+        namespaces = set(self.hits) | set(self.misses)
+        return {
+            namespace: {"hits": self.hits.get(namespace, 0), "misses": self.misses.get(namespace, 0)}
+            for namespace in sorted(namespaces)
+        }
+
+response_cache = ResponseCache()
@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import time
+import zlib
+import aiosqlite
+from answer_cache import normalize_question, question_vector, similarity
+from cache import CACHE_DB, make_key
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+# Библиотека готовых курсов: курс, целиком сгенерированный для одного пользователя, выдаётся
+# другим пользователям с тем же навыком, опытом, целью и предпочтениями, если их план совпадает
+# или отличается формулировками (средняя близость заголовков не ниже COURSE_LIBRARY_SIMILARITY)
+COURSE_LIBRARY_ENABLED = os.getenv("COURSE_LIBRARY_ENABLED", "1") == "1"
+COURSE_LIBRARY_DB = os.getenv("COURSE_LIBRARY_DB", CACHE_DB)
+COURSE_LIBRARY_SIZE = int(os.getenv("COURSE_LIBRARY_SIZE", "2000"))
+COURSE_LIBRARY_SIMILARITY = float(os.getenv("COURSE_LIBRARY_SIMILARITY", "0.9"))
+# Курсы, на которые часто жалуются (правка урока, отказ), перестают выдаваться; оценка
+# учитывается, только когда у курса набралось COURSE_LIBRARY_MIN_VOTES отзывов
+COURSE_LIBRARY_MIN_QUALITY = float(os.getenv("COURSE_LIBRARY_MIN_QUALITY", "0.3"))
+COURSE_LIBRARY_MIN_VOTES = int(os.getenv("COURSE_LIBRARY_MIN_VOTES", "5"))
+# Через сколько дней без выдачи оценка курса при вытеснении уменьшается вдвое
+COURSE_LIBRARY_HALF_LIFE = float(os.getenv("COURSE_LIBRARY_HALF_LIFE", "14")) * 24 * 60 * 60
+COURSE_LIBRARY_CANDIDATES = 20
+
+def profile_key(skill, experience, goal, preferences):
+    return make_key("course_profile", skill, experience, goal, preferences)
+
+def plan_key(plan):
+    return make_key("course_plan", *[normalize_question(title) for title in plan])
+
+def plan_similarity(a, b):
+    """Средняя близость заголовков уроков двух планов по дням."""
+    if len(a) != len(b):
+        return 0.0
+    scores = [
+        similarity(question_vector(normalize_question(x)), question_vector(normalize_question(y)))
+        for x, y in zip(a, b)
+    ]
+    return sum(scores) / len(scores)
+
+def quality(completed, complaints):
+    # Оценка с априорным значением 0.5, чтобы один отзыв не решал судьбу курса
+    return (completed + 1) / (completed + complaints + 2)
+
+class CourseLibrary:
+    """Постоянная библиотека сгенерированных курсов в базе кэша ответов."""
+
+    def __init__(self, path=COURSE_LIBRARY_DB, enabled=COURSE_LIBRARY_ENABLED, max_courses=COURSE_LIBRARY_SIZE,
+                 threshold=COURSE_LIBRARY_SIMILARITY, min_quality=COURSE_LIBRARY_MIN_QUALITY,
+                 min_votes=COURSE_LIBRARY_MIN_VOTES):
+        self.path = path
+        self.enabled = enabled
+        self.max_courses = max_courses
+        self.threshold = threshold
+        self.min_quality = min_quality
+        self.min_votes = min_votes
+        self.hits = 0
+        self.close_hits = 0
+        self.misses = 0
+        self.added = 0
+        self.evicted = 0
+        self._ready = False
+
+    async def _connect(self):
+        db = get_db(self.path)
+        if not self._ready:
+            async with db.transaction() as conn:
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS course_library (
+                        profile TEXT NOT NULL,
+                        plan_key TEXT NOT NULL,
+                        plan TEXT NOT NULL,
+                        lessons BLOB NOT NULL,
+                        completed INTEGER NOT NULL DEFAULT 0,
+                        complaints INTEGER NOT NULL DEFAULT 0,
+                        uses INTEGER NOT NULL DEFAULT 0,
+                        created_at REAL NOT NULL,
+                        last_used REAL NOT NULL,
+                        PRIMARY KEY (profile, plan_key)
+                    ) WITHOUT ROWID
+                """)
+                # Кто уже оставил отзыв о курсе: не больше одной жалобы и одного прохождения от пользователя
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS course_library_votes (
+                        profile TEXT NOT NULL,
+                        plan_key TEXT NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        completed INTEGER NOT NULL,
+                        PRIMARY KEY (profile, plan_key, user_id, completed)
+                    ) WITHOUT ROWID
+                """)
+            self._ready = True
+        return db
+
+    async def find(self, skill, experience, goal, preferences, plan):
+        """Возвращает (план, уроки) подходящего курса или None.
+
+        При близком, но не точном совпадении возвращается план библиотечного курса:
+        заголовки уроков должны совпадать с самими уроками.
+        """
+        if not self.enabled:
+            return None
+        profile = profile_key(skill, experience, goal, preferences)
+        key = plan_key(plan)
+        try:
+            db = await self._connect()
+            rows = await db.fetchall(
+                "SELECT plan_key, plan, completed, complaints FROM course_library WHERE profile = ? "
+                "ORDER BY last_used DESC LIMIT ?",
+                (profile, COURSE_LIBRARY_CANDIDATES)
+            )
+            best, best_score = None, self.threshold
+            for candidate_key, candidate_plan, completed, complaints in rows:
+                if completed + complaints >= self.min_votes and quality(completed, complaints) < self.min_quality:
+                    continue
+                score = 1.0 if candidate_key == key else plan_similarity(plan, json.loads(candidate_plan))
+                if score >= best_score:
+                    best, best_score = candidate_key, score
+            if best is None:
+                self.misses += 1
+                return None
+            row = await db.fetchone(
+                "SELECT plan, lessons FROM course_library WHERE profile = ? AND plan_key = ?", (profile, best)
+            )
+            if row is None:
+                self.misses += 1
+                return None
+            await db.execute(
+                "UPDATE course_library SET uses = uses + 1, last_used = ? WHERE profile = ? AND plan_key = ?",
+                (time.time(), profile, best)
+            )
+        except aiosqlite.Error as e:
+            logger.warning(f"Ошибка поиска курса в библиотеке: {e}")
+            return None
+        if best == key:
+            self.hits += 1
+        else:
+            self.close_hits += 1
+        logger.info(f"Курс по '{skill}' взят из библиотеки (близость плана {best_score:.2f})")
+        return json.loads(row[0]), json.loads(zlib.decompress(row[1]).decode("utf-8"))
+
+    async def add(self, skill, experience, goal, preferences, plan, lessons):
+        """Сохраняет полностью сгенерированный курс и вытесняет худшие по оценке и давности."""
+        if not self.enabled or not all(lessons):
+            return
+        now = time.time()
+        lessons_blob = zlib.compress(json.dumps(lessons, ensure_ascii=False).encode("utf-8"))
+        try:
+            db = await self._connect()
+            async with db.transaction() as conn:
+                await conn.execute(
+                    "INSERT OR IGNORE INTO course_library (profile, plan_key, plan, lessons, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (profile_key(skill, experience, goal, preferences), plan_key(plan),
+                     json.dumps(plan, ensure_ascii=False), lessons_blob, now, now)
+                )
+                async with conn.execute("SELECT COUNT(*) FROM course_library") as cursor:
+                    (count,) = await cursor.fetchone()
+                if count > self.max_courses:
+                    await self._evict(conn, count - self.max_courses, now)
+        except aiosqlite.Error as e:
+            logger.warning(f"Ошибка сохранения курса в библиотеку: {e}")
+            return
+        self.added += 1
+
+    async def _evict(self, conn, count, now):
+        # Оценка качества убывает с давностью последней выдачи: старый непопулярный курс
+        # уступает место новому, а часто выдаваемый хороший курс остаётся
+        async with conn.execute(
+            "SELECT profile, plan_key, completed, complaints, last_used FROM course_library"
+        ) as cursor:
+            rows = await cursor.fetchall()
+        rows.sort(key=lambda row: quality(row[2], row[3]) * 0.5 ** ((now - row[4]) / COURSE_LIBRARY_HALF_LIFE))
+        evicted = [row[:2] for row in rows[:count]]
+        await conn.executemany("DELETE FROM course_library WHERE profile = ? AND plan_key = ?", evicted)
+        await conn.executemany("DELETE FROM course_library_votes WHERE profile = ? AND plan_key = ?", evicted)
+        self.evicted += count
+
+    async def feedback(self, user_id, course, completed):
+        """Учитывает исход курса пользователя: completed=True — курс пройден, False — жалоба.
+
+        Повторный отзыв того же вида от того же пользователя о том же курсе не считается.
+        """
+        if not self.enabled or not course.get("plan"):
+            return
+        column = "completed" if completed else "complaints"
+        key = (
+            profile_key(course["skill"], course.get("experience", "Не указано"), course.get("goal", "Не указано"),
+                        course.get("preferences", "Не указано")),
+            plan_key(course["plan"]),
+        )
+        try:
+            db = await self._connect()
+            async with db.transaction() as conn:
+                async with conn.execute(
+                    "SELECT 1 FROM course_library WHERE profile = ? AND plan_key = ?", key
+                ) as cursor:
+                    if await cursor.fetchone() is None:
+                        return  # Курса нет в библиотеке
+                cursor = await conn.execute(
+                    "INSERT OR IGNORE INTO course_library_votes (profile, plan_key, user_id, completed) VALUES (?, ?, ?, ?)",
+                    (*key, user_id, int(completed))
+                )
+                inserted = cursor.rowcount
+                await cursor.close()
+                if not inserted:
+                    return
+                await conn.execute(
+                    f"UPDATE course_library SET {column} = {column} + 1 WHERE profile = ? AND plan_key = ?", key
+                )
+        except aiosqlite.Error as e:
+            logger.warning(f"Ошибка записи отзыва о курсе: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.close_hits + self.misses
+        return {
+            "hits": self.hits,
+            "close_hits": self.close_hits,
+            "misses": self.misses,
+            "added": self.added,
+            "evicted": self.evicted,
+            "hit_rate": round((self.hits + self.close_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+course_library = CourseLibrary()
@@ -1,80 +1,550 @@
-import sqlite3
-from datetime import datetime
-
-def init_db():
-    conn = sqlite3.connect('course_craft.db')
-    c = conn.cursor()
-    # Существующие таблицы
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    skill TEXT,
-                    experience TEXT,
-                    goal TEXT,
-                    preferences TEXT,
-                    current_lesson INTEGER DEFAULT 0,
-                    course_plan TEXT,
-                    course_content TEXT,
-                    last_interaction TEXT)''')
-    
-    # Таблица для книг и статей
-    c.execute('''CREATE TABLE IF NOT EXISTS resources (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    title TEXT NOT NULL,
-                    author TEXT,
-                    type TEXT CHECK(type IN ('book', 'article')),
-                    content TEXT,
-                    tags TEXT)''')
-    
-    conn.commit()
-    conn.close()
-
-def add_resource(title, author, resource_type, content, tags):
-    conn = sqlite3.connect('course_craft.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO resources (title, author, type, content, tags) VALUES (?, ?, ?, ?, ?)",
-              (title, author, resource_type, content, tags))
-    conn.commit()
-    conn.close()
-
-def get_resources_by_tags(tags):
-    conn = sqlite3.connect('course_craft.db')
-    c = conn.cursor()
-    c.execute("SELECT title, author, type, content FROM resources WHERE tags LIKE ?", (f"%{tags}%",))
-    results = c.fetchall()
-    conn.close()
-    return results
-
-def add_user(user_id, skill, experience, goal, preferences):
-    conn = sqlite3.connect('course_craft.db')
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO users (user_id, skill, experience, goal, preferences, last_interaction) VALUES (?, ?, ?, ?, ?, ?)",
-              (user_id, skill, experience, goal, preferences, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
-
-def get_user(user_id):
-    conn = sqlite3.connect('course_craft.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    user = c.fetchone()
-    conn.close()
-    return user
-
-def update_user_lesson(user_id, lesson_index, course_plan, course_content):
-    conn = sqlite3.connect('course_craft.db')
-    c = conn.cursor()
-    c.execute("UPDATE users SET current_lesson = ?, course_plan = ?, course_content = ?, last_interaction = ? WHERE user_id = ?",
-              (lesson_index, course_plan, course_content, datetime.now().isoformat(), user_id))
-    conn.commit()
-    conn.close()
-
-def update_user_interaction(user_id):
-    conn = sqlite3.connect('course_craft.db')
-    c = conn.cursor()
-    c.execute("UPDATE users SET last_interaction = ? WHERE user_id = ?",
-              (datetime.now().isoformat(), user_id))
-    conn.commit()
-    conn.close()
-
-if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+import ast
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from itertools import islice
+import aiosqlite
+from metrics import db_errors, db_seconds
+from search import build_match_query, normalize_tags, normalize_text
+from serialization import (
+    PROGRESS_COLUMNS, SCHEMA_VERSION, decode_lesson, decode_state, encode_lesson, encode_state, progress_row,
+)
+
+logger = logging.getLogger(__name__)
+
+# Базы данных: каталог материалов и прогресс пользователей
+RESOURCES_DB = os.getenv("RESOURCES_DB", "course_craft.db")
+PROGRESS_DB = os.getenv("DATABASE_URL", "sqlite:///course_progress.db").replace("sqlite:///", "")
+
+# Размер пула соединений для чтения и кэша подготовленных выражений на соединение
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+# Сколько самых релевантных материалов возвращает поиск по каталогу
+RESOURCE_SEARCH_LIMIT = int(os.getenv("RESOURCE_SEARCH_LIMIT", "5"))
+# Веса bm25 для столбцов индекса: название, теги, содержание
+RESOURCE_RANK_WEIGHTS = (2.0, 10.0, 1.0)
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA busy_timeout=5000",
+)
+
+class Database:
+    """Долгоживущие соединения с одним файлом SQLite.
+
+    Все записи идут через одно соединение под блокировкой, чтения — через небольшой
+    пул соединений. Благодаря WAL читатели не ждут писателя, а sqlite3 переиспользует
+    подготовленные выражения внутри каждого соединения.
+    """
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.readers = readers
+        self._writer = None
+        self._reader_pool = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            writer = await self._connect()
+            reader_pool = asyncio.Queue()
+            for _ in range(self.readers):
+                await reader_pool.put(await self._connect())
+            self._writer, self._reader_pool = writer, reader_pool
+            logger.info(f"Открыта база данных {self.path} ({self.readers} соединений для чтения)")
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Соединение для записи; изменения фиксируются одним коммитом при выходе."""
+        await self.open()
+        started = time.perf_counter()
+        async with self._write_lock:
+            acquired = time.perf_counter()
+            db_seconds.observe(acquired - started, self.name, "write_wait")
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                db_errors.inc(self.name, "write")
+                await self._writer.rollback()
+                raise
+            finally:
+                db_seconds.observe(time.perf_counter() - acquired, self.name, "write")
+
+    async def execute(self, sql, params=()):
+        async with self.transaction() as conn:
+            cursor = await conn.execute(sql, params)
+            rowcount = cursor.rowcount
+            await cursor.close()
+        return rowcount
+
+    async def executemany(self, sql, seq_of_params):
+        async with self.transaction() as conn:
+            await conn.executemany(sql, seq_of_params)
+
+    @asynccontextmanager
+    async def reader(self):
+        await self.open()
+        conn = await self._reader_pool.get()
+        started = time.perf_counter()
+        try:
+            yield conn
+        except BaseException:
+            db_errors.inc(self.name, "read")
+            raise
+        finally:
+            db_seconds.observe(time.perf_counter() - started, self.name, "read")
+            self._reader_pool.put_nowait(conn)
+
+    async def fetchone(self, sql, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def close(self):
+        async with self._open_lock:
+            if self._writer is None:
+                return
+            await self._writer.close()
+            while not self._reader_pool.empty():
+                await self._reader_pool.get_nowait().close()
+            self._writer, self._reader_pool = None, None
+
+_databases = {}
+
+def get_db(path):
+    """Общий экземпляр Database для файла базы; соединения открываются при первом запросе."""
+    if path not in _databases:
+        _databases[path] = Database(path)
+    return _databases[path]
+
+async def close_databases():
+    for db in _databases.values():
+        await db.close()
+
+async def init_db():
+    db = get_db(RESOURCES_DB)
+    async with db.transaction() as conn:
+        # Существующие таблицы
+        await conn.execute('''CREATE TABLE IF NOT EXISTS users (
+                        user_id INTEGER PRIMARY KEY,
+                        skill TEXT,
+                        experience TEXT,
+                        goal TEXT,
+                        preferences TEXT,
+                        current_lesson INTEGER DEFAULT 0,
+                        course_plan TEXT,
+                        course_content TEXT,
+                        last_interaction TEXT)''')
+
+        # Таблица для книг и статей
+        await conn.execute('''CREATE TABLE IF NOT EXISTS resources (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        title TEXT NOT NULL,
+                        author TEXT,
+                        type TEXT CHECK(type IN ('book', 'article')),
+                        content TEXT,
+                        tags TEXT,
+                        content_hash TEXT)''')
+
+        # Миграция: хеш содержимого для идемпотентного импорта, повторы удаляются
+        async with conn.execute("PRAGMA table_info(resources)") as cursor:
+            columns = [row[1] for row in await cursor.fetchall()]
+        if "content_hash" not in columns:
+            logger.info("Добавляем хеши содержимого в таблицу resources")
+            await conn.execute("ALTER TABLE resources ADD COLUMN content_hash TEXT")
+        async with conn.execute(
+            "SELECT id, title, author, type, content, tags FROM resources WHERE content_hash IS NULL"
+        ) as cursor:
+            unhashed = await cursor.fetchall()
+        if unhashed:
+            await conn.executemany(
+                "UPDATE resources SET content_hash = ? WHERE id = ?",
+                [(resource_hash(*row[1:]), row[0]) for row in unhashed]
+            )
+            await conn.execute(
+                "DELETE FROM resources WHERE id NOT IN (SELECT MIN(id) FROM resources GROUP BY content_hash)"
+            )
+        await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_resources_content_hash ON resources (content_hash)")
+
+        # Полнотекстовый индекс по материалам: хранит нормализованные основы слов, rowid = resources.id
+        await conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS resources_fts USING fts5(
+                        title, tags, content, tokenize='unicode61 remove_diacritics 2')''')
+        async with conn.execute(
+            "SELECT (SELECT COUNT(*) FROM resources) - (SELECT COUNT(*) FROM resources_fts)"
+        ) as cursor:
+            missing = (await cursor.fetchone())[0]
+    if missing:
+        logger.info("Индекс материалов не совпадает с каталогом, перестраиваем")
+        await rebuild_resource_index()
+
+def resource_hash(title, author, resource_type, content, tags):
+    # Регистр и пробелы не влияют на хеш, чтобы одинаковые материалы не дублировались
+    payload = "\x1f".join(" ".join((field or "").split()).lower() for field in (title, author, resource_type, content, tags))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _index_row(resource_id, title, tags, content):
+    return (resource_id, normalize_text(title), normalize_tags(tags), normalize_text(content))
+
+async def rebuild_resource_index(batch_size=1000):
+    """Перестраивает полнотекстовый индекс по всей таблице resources."""
+    db = get_db(RESOURCES_DB)
+    indexed = 0
+    async with db.transaction() as conn:
+        await conn.execute("DELETE FROM resources_fts")
+        async with conn.execute("SELECT id, title, tags, content FROM resources") as cursor:
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                await conn.executemany(
+                    "INSERT INTO resources_fts (rowid, title, tags, content) VALUES (?, ?, ?, ?)",
+                    [_index_row(*row) for row in rows]
+                )
+                indexed += len(rows)
+        await conn.execute("INSERT INTO resources_fts (resources_fts) VALUES ('optimize')")
+    logger.info(f"Индекс материалов перестроен: {indexed} записей")
+    return indexed
+
+async def add_resources_bulk(resources, batch_size=1000, on_batch=None):
+    """Импортирует материалы пачками, каждая пачка — отдельная транзакция.
+
+    resources — итерируемое кортежей (title, author, type, content, tags); читается
+    лениво, в памяти держится только текущая пачка. Блокировка записи держится только
+    на время записи пачки, поэтому долгий импорт не останавливает кэш ответов и библиотеку
+    курсов в той же базе. Материалы, чей хеш уже есть в базе, пропускаются, поэтому повторный
+    импорт (в том числе после прерванного) ничего не меняет. on_batch(inserted, total)
+    вызывается после каждой пачки. Возвращает (добавлено, пропущено).
+    """
+    inserted = total = 0
+    resources = iter(resources)
+    db = get_db(RESOURCES_DB)
+    while True:
+        batch = list(islice(resources, batch_size))
+        if not batch:
+            break
+        async with db.transaction() as conn:
+            async with conn.execute("SELECT COALESCE(MAX(id), 0) FROM resources") as cursor:
+                last_id = (await cursor.fetchone())[0]
+            await conn.executemany(
+                "INSERT INTO resources (title, author, type, content, tags, content_hash) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (content_hash) DO NOTHING",
+                [(*row, resource_hash(*row)) for row in batch]
+            )
+            # Новые строки — те, чей id больше прежнего максимума (AUTOINCREMENT, транзакция держит запись)
+            async with conn.execute("SELECT id, title, tags, content FROM resources WHERE id > ?", (last_id,)) as cursor:
+                new_rows = await cursor.fetchall()
+            await conn.executemany(
+                "INSERT INTO resources_fts (rowid, title, tags, content) VALUES (?, ?, ?, ?)",
+                [_index_row(*row) for row in new_rows]
+            )
+        inserted += len(new_rows)
+        total += len(batch)
+        if on_batch:
+            on_batch(inserted, total)
+    return inserted, total - inserted
+
+async def add_resource(title, author, resource_type, content, tags):
+    inserted, _ = await add_resources_bulk([(title, author, resource_type, content, tags)])
+    return inserted == 1
+
+async def get_resources_by_tags(tags, limit=RESOURCE_SEARCH_LIMIT):
+    """Самые релевантные материалы по навыку.
+
+    Сначала ищем по названию и тегам; если совпадений меньше limit, добираем по тексту.
+    Поиск идёт по целым основам слов, поэтому «java» не находит «javascript».
+    """
+    query = build_match_query(tags)
+    if not query:
+        return []
+    db = get_db(RESOURCES_DB)
+    sql = f"""
+        SELECT r.id, r.title, r.author, r.type, r.content
+        FROM resources_fts JOIN resources r ON r.id = resources_fts.rowid
+        WHERE resources_fts MATCH ?
+        ORDER BY bm25(resources_fts, {", ".join(map(str, RESOURCE_RANK_WEIGHTS))})
+        LIMIT ?
+    """
+    rows = await db.fetchall(sql, (f"{{title tags}} : ({query})", limit))
+    if len(rows) < limit:
+        found = {row[0] for row in rows}
+        extra = await db.fetchall(sql, (f"content : ({query})", limit + len(rows)))
+        rows += [row for row in extra if row[0] not in found][:limit - len(rows)]
+    return [row[1:] for row in rows]
+
+async def add_user(user_id, skill, experience, goal, preferences):
+    await get_db(RESOURCES_DB).execute(
+        "INSERT OR REPLACE INTO users (user_id, skill, experience, goal, preferences, last_interaction) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, skill, experience, goal, preferences, datetime.now().isoformat())
+    )
+
+async def get_user(user_id):
+    return await get_db(RESOURCES_DB).fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+
+async def update_user_lesson(user_id, lesson_index, course_plan, course_content):
+    await get_db(RESOURCES_DB).execute(
+        "UPDATE users SET current_lesson = ?, course_plan = ?, course_content = ?, last_interaction = ? WHERE user_id = ?",
+        (lesson_index, course_plan, course_content, datetime.now().isoformat(), user_id)
+    )
+
+async def update_user_interaction(user_id):
+    await get_db(RESOURCES_DB).execute(
+        "UPDATE users SET last_interaction = ? WHERE user_id = ?",
+        (datetime.now().isoformat(), user_id)
+    )
+
+# Прогресс пользователей по курсам: метаданные в user_courses, уроки — по строке на день в user_lessons
+async def init_progress_db():
+    logger.info(f"Инициализация базы данных: {PROGRESS_DB}")
+    async with get_db(PROGRESS_DB).transaction() as conn:
+        # Столбец course — устаревший формат (str(list) с уроками); после миграции NULL, кроме курсов,
+        # которые не удалось разобрать
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_courses (
+                user_id INTEGER PRIMARY KEY,
+                course TEXT,
+                current_day INTEGER,
+                chat_id INTEGER,
+                progress INTEGER,
+                skill TEXT,
+                current_question INTEGER,
+                experience TEXT,
+                goal TEXT,
+                preferences TEXT,
+                state TEXT
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_lessons (
+                user_id INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                body BLOB,
+                PRIMARY KEY (user_id, day)
+            ) WITHOUT ROWID
+        """)
+        # Одно напоминание на пользователя; планировщик выбирает ближайшие по индексу due_at
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS reminders (
+                user_id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                due_at REAL NOT NULL
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders_due_at ON reminders (due_at)")
+        # Состояния диалогов aiogram (FSM): переживают перезапуск и доступны всем экземплярам бота
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                state TEXT,
+                data TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (chat_id, user_id)
+            ) WITHOUT ROWID
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)")
+        async with conn.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+        if version < SCHEMA_VERSION:
+            await _migrate_progress_db(conn)
+            await conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+async def _migrate_progress_db(conn):
+    # Версия 1 хранила весь курс строкой str(list) в user_courses.course; переносим уроки в user_lessons
+    async with conn.execute("PRAGMA table_info(user_courses)") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if "state" not in columns:
+        await conn.execute("ALTER TABLE user_courses ADD COLUMN state TEXT")
+    async with conn.execute("SELECT user_id, course FROM user_courses WHERE course IS NOT NULL AND course != ''") as cursor:
+        rows = await cursor.fetchall()
+    migrated = []
+    for user_id, course in rows:
+        try:
+            lessons = ast.literal_eval(course)
+        except (ValueError, SyntaxError) as e:
+            # Неразобранный курс остаётся в user_courses.course, чтобы его можно было изучить вручную
+            logger.warning(f"Не удалось разобрать курс user_id={user_id}: {e}")
+            continue
+        await conn.executemany(
+            "INSERT OR REPLACE INTO user_lessons (user_id, day, body) VALUES (?, ?, ?)",
+            [(user_id, day, encode_lesson(lesson)) for day, lesson in enumerate(lessons)]
+        )
+        migrated.append((user_id,))
+    await conn.executemany("UPDATE user_courses SET course = NULL WHERE user_id = ?", migrated)
+    logger.info(
+        f"База прогресса обновлена до версии {SCHEMA_VERSION}, перенесено курсов: {len(migrated)}, "
+        f"не разобрано: {len(rows) - len(migrated)}"
+    )
+
+_PROGRESS_SELECT = f"SELECT user_id, {', '.join(PROGRESS_COLUMNS)}, state FROM user_courses"
+
+def _build_course(row, lesson_rows):
+    course_data = decode_state(row[-1])
+    course_data.update(zip(PROGRESS_COLUMNS, row[1:-1]))
+    course = []
+    for day, body in lesson_rows:
+        course.extend([None] * (day + 1 - len(course)))
+        course[day] = decode_lesson(body)
+    course_data["course"] = course
+    return course_data
+
+async def load_user_courses():
+    user_courses = {}
+    logger.info("Загрузка данных из базы...")
+    db = get_db(PROGRESS_DB)
+    lessons = {}
+    for user_id, day, body in await db.fetchall("SELECT user_id, day, body FROM user_lessons ORDER BY user_id, day"):
+        lessons.setdefault(user_id, []).append((day, body))
+    for row in await db.fetchall(_PROGRESS_SELECT):
+        user_courses[row[0]] = _build_course(row, lessons.get(row[0], []))
+    logger.info(f"Загружено {len(user_courses)} записей из базы")
+    return user_courses
+
+async def load_user_course(user_id):
+    db = get_db(PROGRESS_DB)
+    row = await db.fetchone(f"{_PROGRESS_SELECT} WHERE user_id = ?", (user_id,))
+    if row is None:
+        return None
+    lesson_rows = await db.fetchall("SELECT day, body FROM user_lessons WHERE user_id = ? ORDER BY day", (user_id,))
+    return _build_course(row, lesson_rows)
+
+_PROGRESS_UPSERT = f"""
+    INSERT OR REPLACE INTO user_courses (user_id, {', '.join(PROGRESS_COLUMNS)}, state)
+    VALUES ({', '.join(['?'] * (len(PROGRESS_COLUMNS) + 2))})
+"""
+
+async def save_user_course(user_id, course_data):
+    """Полное сохранение: метаданные и все уроки курса (при создании, замене или отмене курса)."""
+    logger.info(f"Сохранение данных для user_id={user_id}")
+    async with get_db(PROGRESS_DB).transaction() as conn:
+        await conn.execute(_PROGRESS_UPSERT, (user_id, *progress_row(course_data), encode_state(course_data)))
+        await conn.execute("DELETE FROM user_lessons WHERE user_id = ?", (user_id,))
+        await conn.executemany(
+            "INSERT INTO user_lessons (user_id, day, body) VALUES (?, ?, ?)",
+            [(user_id, day, encode_lesson(lesson)) for day, lesson in enumerate(course_data.get("course", []))]
+        )
+
+async def save_user_progress(user_id, course_data):
+    """Сохраняет только метаданные прогресса (текущий день, пройденные уроки и т. п.) без уроков."""
+    await get_db(PROGRESS_DB).execute(_PROGRESS_UPSERT, (user_id, *progress_row(course_data), encode_state(course_data)))
+
+async def save_user_lesson(user_id, day, lesson):
+    await get_db(PROGRESS_DB).execute(
+        "INSERT OR REPLACE INTO user_lessons (user_id, day, body) VALUES (?, ?, ?)",
+        (user_id, day, encode_lesson(lesson))
+    )
+
+async def save_user_changes(courses, lessons):
+    """Записывает накопленные изменения многих пользователей одной транзакцией.
+
+    courses — список (user_id, course_data, full): при full=True уроки пользователя
+    перезаписываются целиком, иначе сохраняются только метаданные прогресса;
+    lessons — список (user_id, day, lesson) для отдельных уроков.
+    """
+    async with get_db(PROGRESS_DB).transaction() as conn:
+        await conn.executemany(
+            _PROGRESS_UPSERT,
+            [(user_id, *progress_row(course_data), encode_state(course_data)) for user_id, course_data, _ in courses]
+        )
+        full = [(user_id, course_data) for user_id, course_data, is_full in courses if is_full]
+        await conn.executemany("DELETE FROM user_lessons WHERE user_id = ?", [(user_id,) for user_id, _ in full])
+        await conn.executemany(
+            "INSERT OR REPLACE INTO user_lessons (user_id, day, body) VALUES (?, ?, ?)",
+            [
+                (user_id, day, encode_lesson(lesson))
+                for user_id, course_data in full for day, lesson in enumerate(course_data.get("course", []))
+            ] + [(user_id, day, encode_lesson(lesson)) for user_id, day, lesson in lessons]
+        )
+
+# Напоминания о следующем уроке
+async def save_reminder(user_id, chat_id, due_at):
+    await get_db(PROGRESS_DB).execute(
+        """
+        INSERT INTO reminders (user_id, chat_id, due_at) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET chat_id = excluded.chat_id, due_at = excluded.due_at
+        """,
+        (user_id, chat_id, due_at)
+    )
+
+async def delete_reminder(user_id):
+    await get_db(PROGRESS_DB).execute("DELETE FROM reminders WHERE user_id = ?", (user_id,))
+
+async def next_reminder_at():
+    row = await get_db(PROGRESS_DB).fetchone("SELECT MIN(due_at) FROM reminders")
+    return row[0]
+
+async def get_due_reminders(now, limit):
+    """Наступившие напоминания: (user_id, chat_id, due_at, current_day); current_day — None, если курса нет."""
+    return await get_db(PROGRESS_DB).fetchall(
+        """
+        SELECT r.user_id, r.chat_id, r.due_at, c.current_day
+        FROM reminders r LEFT JOIN user_courses c ON c.user_id = r.user_id
+        WHERE r.due_at <= ? ORDER BY r.due_at LIMIT ?
+        """,
+        (now, limit)
+    )
+
+async def finish_reminders(rescheduled, removed):
+    # Условие на старый due_at не даёт затереть напоминание, которое пользователь успел перепланировать
+    async with get_db(PROGRESS_DB).transaction() as conn:
+        await conn.executemany("UPDATE reminders SET due_at = ? WHERE user_id = ? AND due_at = ?", rescheduled)
+        await conn.executemany("DELETE FROM reminders WHERE user_id = ? AND due_at = ?", removed)
+
+# Состояния FSM
+async def load_fsm_state(chat_id, user_id):
+    return await get_db(PROGRESS_DB).fetchone(
+        "SELECT state, data, updated_at FROM fsm_states WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
+    )
+
+async def save_fsm_states(rows, removed):
+    """rows — (chat_id, user_id, state, data, updated_at) для записи, removed — (chat_id, user_id) для удаления."""
+    async with get_db(PROGRESS_DB).transaction() as conn:
+        await conn.executemany(
+            """
+            INSERT INTO fsm_states (chat_id, user_id, state, data, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            """,
+            rows
+        )
+        await conn.executemany("DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ?", removed)
+
+async def delete_expired_fsm_states(before):
+    return await get_db(PROGRESS_DB).execute("DELETE FROM fsm_states WHERE updated_at < ?", (before,))
+
+if __name__ == "__main__":
+    # python database.py — создать таблицы; python database.py rebuild-index — перестроить поисковый индекс
+    async def main():
+        try:
+            await init_db()
+            if sys.argv[1:] == ["rebuild-index"]:
+                await rebuild_resource_index()
+        finally:
+            await close_databases()
+
+    asyncio.run(main())
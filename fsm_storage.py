@@ -0,0 +1,174 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import time
+import typing
+from collections import OrderedDict
+from aiogram.dispatcher.storage import BaseStorage
+from database import load_fsm_state, save_fsm_states, delete_expired_fsm_states
+
+logger = logging.getLogger(__name__)
+
+# Брошенные диалоги (пользователь не ответил на вопрос анкеты) забываются через FSM_STATE_TTL секунд
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(7 * 24 * 60 * 60)))
+# Изменения копятся FSM_FLUSH_INTERVAL секунд и записываются одной транзакцией
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.05"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_CLEANUP_INTERVAL = 60 * 60
+FSM_CLOSE_TIMEOUT = 10
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище состояний aiogram в таблице fsm_states базы прогресса.
+
+    Чтения обслуживаются из LRU-кэша в памяти процесса, записи объединяются: несколько
+    set_state/update_data одного обработчика превращаются в одну строку в общей транзакции.
+    При аварийном завершении теряются изменения не старше FSM_FLUSH_INTERVAL. Кэш считается
+    источником истины, поэтому при нескольких экземплярах бота апдейты одного пользователя
+    должны обрабатываться одним экземпляром.
+    """
+
+    def __init__(self, ttl=FSM_STATE_TTL, flush_interval=FSM_FLUSH_INTERVAL, cache_size=FSM_CACHE_SIZE):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._loading = {}
+        self._dirty = set()
+        self._flush_task = None
+        self._last_cleanup = 0.0
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    async def _entry(self, chat, user):
+        key = self._key(chat, user)
+        entry = self._cache.get(key)
+        if entry is None:
+            # Параллельные обращения к одному ключу ждут одну загрузку
+            task = self._loading.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._load(key))
+                self._loading[key] = task
+            entry = await asyncio.shield(task)
+        else:
+            self._cache.move_to_end(key)
+        if entry["updated_at"] < time.time() - self.ttl:
+            entry.update(state=None, data={})
+        return key, entry
+
+    async def _load(self, key):
+        try:
+            row = await load_fsm_state(*key)
+            if key not in self._cache:
+                if row:
+                    state, data, updated_at = row
+                    self._cache[key] = {"state": state, "data": json.loads(data) if data else {}, "updated_at": updated_at}
+                else:
+                    self._cache[key] = {"state": None, "data": {}, "updated_at": time.time()}
+                self._evict()
+            return self._cache[key]
+        finally:
+            self._loading.pop(key, None)
+
+    def _evict(self):
+        # Несохранённые записи не вытесняются; после сброса на диск они станут обычными
+        while len(self._cache) > self.cache_size:
+            key = next(iter(self._cache))
+            if key in self._dirty:
+                break
+            self._cache.popitem(last=False)
+
+    def _touch(self, key, entry):
+        entry["updated_at"] = time.time()
+        self._dirty.add(key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи состояний FSM: {e}")
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией и удаляет просроченные состояния."""
+        keys, self._dirty = self._dirty, set()
+        rows = []
+        removed = []
+        for key in keys:
+            entry = self._cache[key]
+            if entry["state"] is None and not entry["data"]:
+                removed.append(key)
+            else:
+                rows.append((*key, entry["state"], json.dumps(entry["data"], ensure_ascii=False), entry["updated_at"]))
+        try:
+            if rows or removed:
+                await save_fsm_states(rows, removed)
+        except BaseException:
+            self._dirty |= keys
+            raise
+        self._evict()
+        now = time.time()
+        if now - self._last_cleanup > FSM_CLEANUP_INTERVAL:
+            self._last_cleanup = now
+            expired = await delete_expired_fsm_states(now - self.ttl)
+            if expired:
+                logger.info(f"Удалено просроченных состояний FSM: {expired}")
+
+    async def close(self):
+        # Фоновую запись не отменяем посреди транзакции, а дожидаемся её
+        if self._flush_task and not self._flush_task.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self._flush_task), FSM_CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error("Не удалось дождаться записи состояний FSM при завершении")
+                return
+        if self._dirty:
+            await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, entry = await self._entry(chat, user)
+        return entry["state"] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, entry = await self._entry(chat, user)
+        return copy.deepcopy(entry["data"] or default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, entry = await self._entry(chat, user)
+        entry["state"] = self.resolve_state(state)
+        self._touch(key, entry)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, entry = await self._entry(chat, user)
+        entry["data"] = copy.deepcopy(data or {})
+        self._touch(key, entry)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        key, entry = await self._entry(chat, user)
+        entry["data"].update(copy.deepcopy(data or {}), **kwargs)
+        self._touch(key, entry)
@@ -1,207 +1,444 @@
-import google.generativeai as genai
-import logging
-import os
-from dotenv import load_dotenv
-import hashlib
-from database import get_resources_by_tags  # Импортируем функцию поиска
-
-load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-
-logger = logging.getLogger(__name__)
-
-def generate_plan(skill, experience, goal, edit_request=""):
-    try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        prompt = (
-            f"Ты — эксперт в обучении с 20-летним опытом. "
-            f"Создай план курса из 7 уроков для навыка '{skill}'. "
-            f"Уровень опыта: '{experience}'. Цель: '{goal}'. {edit_request}. "
-            f"Применяй закон 80/20: фокус на 20% тем, дающих 80% результата. "
-            f"Каждый урок — заголовок (50-70 символов). "
-            f"Возвращай только 7 строк без нумерации и лишнего текста."
-        )
-        response = model.generate_content(prompt).text.strip().split("\n")
-        lessons = [line.strip() for line in response if line.strip()]
-        if len(lessons) != 7:
-            logger.warning(f"План содержит {len(lessons)} уроков вместо 7, корректируем")
-            return lessons[:7] if len(lessons) > 7 else lessons + ["Дополнительный урок"] * (7 - len(lessons))
-        return lessons
-    except Exception as e:
-        logger.error(f"Ошибка генерации плана: {str(e)}")
-        return None
-
-def generate_course(skill, experience, goal, preferences, plan, generated_lessons=None):
-    try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        plan_str = "\n".join([f"День {i+1}: {title}" for i, title in enumerate(plan)])
-        exclude_lessons = ""
-        if generated_lessons:
-            exclude_lessons = (
-                "Не повторяй следующие уроки (хеши):\n" +
-                "\n".join([f"- {hashlib.md5(lesson.encode()).hexdigest()}" for lesson in generated_lessons]) +
-                "\nГенерируй новый уникальный контент для каждого дня."
-            )
-        
-        # Проверяем базу данных
-        resources = get_resources_by_tags(skill.lower())
-        resource_content = ""
-        if resources:
-            resource_content = "Используй следующий материал из базы данных:\n"
-            for title, author, res_type, content in resources:
-                resource_content += f"- {res_type.capitalize()} '{title}' от {author}: {content[:200]}...\n"
-            resource_content += "Интегрируй этот материал в уроки, адаптируя под структуру.\n"
-        
-        prompt = (
-            f"Ты — эксперт в обучении с 20-летним опытом, создающий вдохновляющие курсы. "
-            f"Разработай 7-дневный курс по навыку '{skill}' для цели '{goal}'. "
-            f"Уровень опыта: {experience}. Предпочтения: {preferences}.\n\n"
-            f"### Принцип 80/20\n"
-            f"- Дай 20% знаний, которые обеспечат 80% результата.\n"
-            f"- Убери всё лишнее, оставь только самое важное.\n\n"
-            f"### Длительность\n"
-            f"- Курс длится 7 дней. Используй план:\n{plan_str}\n\n"
-            f"### Структура урока\n"
-            f"- Каждый урок должен быть в точном формате:\n"
-            f"  <b>День X: [Название урока]</b>\n"
-            f"  <b>Краткое введение 🎯</b>: 3-4 предложения (почему это важно, с мотивацией).\n"
-            f"  <b>Основной шаг 🚀</b>: Ключевая идея, 3-4 совета. В конце ОБЯЗАТЕЛЬНО добавь: 'Не уверен? Задай мне вопрос!'.\n"
-            f"  <b>Практический пример 🌟</b>: Реальная ситуация с деталями.\n"
-            f"  <b>Практическое задание 1 ✍️</b>: Простое задание для практики.\n"
-            f"  <b>Практическое задание 2 ✍️</b>: Задание для закрепления.\n"
-            f"  💡 Полезный совет: Короткий и практичный.\n"
-            f"  Не стесняйся задавать вопросы — я здесь, чтобы помочь!\n"
-            f"  По любому поводу можешь задать мне вопрос! 🚀\n"
-            f"  <b>Спрашивай обо всём! 🤓</b>\n"
-            f"- Не дублируй заголовки, используй ТОЛЬКО указанный формат.\n"
-            f"### Персонализация\n"
-            f"- Для новичков: простые основы. Для среднего: больше практики. Для продвинутых: сложные задачи.\n"
-            f"- Учитывай предпочтения ({preferences}) в примерах и стиле.\n"
-            f"- Если программирование — используй Python, если язык не указан.\n\n"
-            f"### Формат\n"
-            f"- Длина урока: 1800-2400 символов (строго соблюдай этот диапазон).\n"
-            f"- Используй <b>жирный текст</b> с <b></b> только для заголовков.\n"
-            f"- Никаких ** или * в тексте.\n"
-            f"- Добавляй смайлики (🎯, 🚀, 🌟, ✍️) к заголовкам.\n"
-            f"- Пиши вдохновляюще, дружелюбно, как наставник.\n"
-            f"- Разделяй уроки символом '---'.\n"
-            f"- Не указывай время выполнения заданий.\n"
-            f"{resource_content if resource_content else 'Если материала нет, создай курс с нуля.'}\n"
-            f"{exclude_lessons}"
-        )
-        response = model.generate_content(prompt).text.strip()
-        logger.info(f"Сырой ответ Gemini для курса: {response[:500]}...")
-        lessons = [lesson.strip() for lesson in response.split("---") if lesson.strip()]
-        if len(lessons) != 7:
-            logger.warning(f"Сгенерировано {len(lessons)} уроков вместо 7, корректируем")
-            while len(lessons) < 7:
-                lessons.append(
-                    f"<b>День {len(lessons) + 1}: Дополнительный шаг к '{skill}'</b>\n"
-                    f"<b>Краткое введение 🎯</b>: Ты близок к цели '{goal}' — продолжай!\n"
-                    f"<b>Основной шаг 🚀</b>: Практикуй '{skill}' каждый день. Не уверен? Задай мне вопрос!\n"
-                    f"<b>Практический пример 🌟</b>: Примени '{skill}' в жизни.\n"
-                    f"<b>Практическое задание 1 ✍️</b>: Сделай простой шаг.\n"
-                    f"<b>Практическое задание 2 ✍️</b>: Закрепи результат.\n"
-                    f"💡 Полезный совет: Постоянство — ключ к успеху.\n"
-                    f"Не стесняйся задавать вопросы — я здесь, чтобы помочь!\n"
-                    f"По любому поводу можешь задать мне вопрос! 🚀\n"
-                    f"<b>Спрашивай обо всём! 🤓</b>"
-                )
-            lessons = lessons[:7]
-        return lessons
-    except Exception as e:
-        logger.error(f"Ошибка генерации курса: {str(e)}")
-        return None
-
-def answer_question(question, context=""):
-    try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        prompt = (
-            f"Ты — наставник с 20-летним опытом. Контекст: {context}\n"
-            f"Ответь на вопрос: '{question}'.\n"
-            f"Применяй закон 80/20: 20% ключевой информации для 80% понимания.\n"
-            f"Текст — 300-500 символов, вдохновляющий и дружелюбный.\n"
-            f"Используй <b>жирный текст</b> с <b></b> для ключевых моментов, никаких ** или других символов.\n"
-            f"Добавляй смайлики (🎯, 🚀, 🌟, ✍️). Не делай структуру урока, просто ответь."
-        )
-        response = model.generate_content(prompt).text.strip()
-        logger.info(f"Сырой ответ Gemini на вопрос: {response}")
-        return response
-    except Exception as e:
-        logger.error(f"Ошибка при ответе на вопрос: {str(e)}")
-        return (
-            f"<b>Ой, не переживай!</b> 🎯 Я помогу! Задай вопрос ещё раз, и мы разберёмся вместе. ✍️"
-        )
-
-def generate_course_suggestions(skill):
-    try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        prompt = (
-            f"Ты — эксперт в обучении. Предложи 3 идеи для курсов после '{skill}'. "
-            f"Каждая идея — строка (30-50 символов). "
-            f"Возвращай только 3 строки без лишнего текста."
-        )
-        response = model.generate_content(prompt).text.strip().split("\n")
-        suggestions = [suggestion.strip() for suggestion in response if suggestion.strip()]
-        if len(suggestions) != 3:
-            logger.warning(f"Сгенерировано {len(suggestions)} предложений вместо 3, корректируем")
-            return suggestions[:3] if len(suggestions) > 3 else suggestions + ["Дополнительный курс"] * (3 - len(suggestions))
-        return suggestions
-    except Exception as e:
-        logger.error(f"Ошибка генерации предложений: {str(e)}")
-        return None
-
-def update_lesson(skill, experience, goal, preferences, current_lesson, edit_request, day):
-    try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        current_title = current_lesson.split('\n')[0].replace("<b>", "").replace("</b>", "").split(": ")[1].strip()
-        
-        # Проверяем базу данных
-        resources = get_resources_by_tags(skill.lower())
-        resource_content = ""
-        if resources:
-            resource_content = "Используй следующий материал из базы данных:\n"
-            for title, author, res_type, content in resources:
-                resource_content += f"- {res_type.capitalize()} '{title}' от {author}: {content[:200]}...\n"
-            resource_content += "Интегрируй этот материал в урок, адаптируя под структуру.\n"
-        
-        prompt = (
-            f"Ты — эксперт в обучении с 20-летним опытом. "
-            f"Обнови урок по навыку '{skill}' с учётом пожелания: '{edit_request}'. "
-            f"Уровень опыта: {experience}. Цель: {goal}. Предпочтения: {preferences}. "
-            f"Текущий урок:\n{current_lesson}\n"
-            f"Применяй закон 80/20: 20% знаний для 80% результата.\n"
-            f"Сохрани заголовок урока: '<b>День {day + 1}: {current_title}</b>'.\n"
-            f"### Структура урока\n"
-            f"- Урок должен быть в точном формате:\n"
-            f"  <b>День X: [Название урока]</b>\n"
-            f"  <b>Краткое введение 🎯</b>: 2-3 предложения (почему это важно, с мотивацией).\n"
-            f"  <b>Основной шаг 🚀</b>: Ключевая идея, 3-4 совета. В конце ОБЯЗАТЕЛЬНО добавь: 'Не уверен? Задай мне вопрос!'.\n"
-            f"  <b>Практический пример 🌟</b>: Реальная ситуация с деталями.\n"
-            f"  <b>Практическое задание 1 ✍️</b>: Простое задание с инструкциями.\n"
-            f"  <b>Практическое задание 2 ✍️</b>: Задание для закрепления с инструкциями.\n"
-            f"  💡 Полезный совет: Короткий и практичный.\n"
-            f"  Не стесняйся задавать вопросы — я здесь, чтобы помочь!\n"
-            f"  По любому поводу можешь задать мне вопрос! 🚀\n"
-            f"  <b>Спрашивай обо всём! 🤓</b>\n"
-            f"- Не дублируй заголовки, используй ТОЛЬКО указанный формат.\n"
-            f"### Дополнительно\n"
-            f"- Сделай акцент на практических шагах для '{edit_request}'.\n"
-            f"- Длина: 1800-2400 символов (строго соблюдай этот диапазон).\n"
-            f"- Используй <b>жирный текст</b> с <b></b> ТОЛЬКО для заголовков.\n"
-            f"- Никаких ** или * в тексте.\n"
-            f"- Пиши вдохновляюще и дружелюбно.\n"
-            f"{resource_content if resource_content else 'Если материала нет, обнови урок с нуля.'}"
-        )
-        response = model.generate_content(prompt).text.strip()
-        logger.info(f"Сырой ответ Gemini для обновления урока: {response[:500]}...")
-        # Проверяем длину
-        lesson_length = len(response)
-        if lesson_length < 1800 or lesson_length > 2400:
-            logger.warning(f"Длина обновлённого урока {lesson_length} символов, ожидалось 1800-2400")
-        return response
-    except Exception as e:
-        logger.error(f"Ошибка обновления урока: {str(e)}")
-        return current_lesson
-
-__all__ = ["generate_plan", "generate_course", "answer_question", "generate_course_suggestions", "update_lesson"]
\ No newline at end of file
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+from database import get_resources_by_tags  # Импортируем функцию поиска
+from cache import response_cache
+from answer_cache import answer_cache
+from prompt_builder import PromptBuilder, RESOURCE_CANDIDATES, estimate_tokens, select_resources
+from llm_scheduler import llm_scheduler, QueueFull, PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK
+from llm_backend import llm_backend, MODEL_FAST, MODEL_STRONG
+from metrics import llm_metrics, record_llm_tokens
+from logging_setup import log_text
+from lesson_sections import SECTIONS, SECTIONS_BY_KEY, excerpt, join_sections, parse_lesson, parse_rewrite, route_edit, splice
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Таймаут одного запроса к Gemini и оценка длины ответа для лимита токенов в минуту
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "90"))
+GEMINI_OUTPUT_TOKENS = int(os.getenv("GEMINI_OUTPUT_TOKENS", "1000"))
+
+async def _generate_text(prompt, timeout=None, on_text=None, priority=PRIORITY_NORMAL, on_queued=None, model=MODEL_FAST):
+    """Асинхронный запрос к Gemini через общий планировщик; отмена задачи прерывает запрос.
+
+    Если передан on_text, ответ читается потоком, и корутина on_text вызывается
+    с накопленным текстом после каждого фрагмента. on_queued(позиция) вызывается,
+    если запросу пришлось ждать квоту. model — MODEL_FAST или MODEL_STRONG (см. llm_backend).
+    """
+    timeout = timeout or GEMINI_TIMEOUT
+    prompt_tokens = estimate_tokens(prompt)
+
+    async def call():
+        try:
+            return await asyncio.wait_for(llm_backend.generate(prompt, model, on_text), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Gemini не ответил за {timeout} секунд")
+            raise
+
+    text = await llm_scheduler.run(
+        call, prompt_tokens + GEMINI_OUTPUT_TOKENS, priority, on_queued,
+        measure=lambda text: prompt_tokens + estimate_tokens(text)
+    )
+    record_llm_tokens(prompt_tokens, estimate_tokens(text))
+    return text.strip()
+
+@llm_metrics()
+async def generate_plan(skill, experience, goal, edit_request="", on_queued=None):
+    try:
+        cached = await response_cache.get("plan", skill, experience, goal, edit_request)
+        if cached:
+            logger.info(f"План для навыка '{skill}' взят из кэша")
+            return cached
+        prompt = (
+            f"Ты — эксперт в обучении с 20-летним опытом. "
+            f"Создай план курса из 7 уроков для навыка '{skill}'. "
+            f"Уровень опыта: '{experience}'. Цель: '{goal}'. {edit_request}. "
+            f"Применяй закон 80/20: фокус на 20% тем, дающих 80% результата. "
+            f"Каждый урок — заголовок (50-70 символов). "
+            f"Возвращай только 7 строк без нумерации и лишнего текста."
+        )
+        response = (await _generate_text(prompt, on_queued=on_queued)).split("\n")
+        lessons = [line.strip() for line in response if line.strip()]
+        if len(lessons) != 7:
+            logger.warning(f"План содержит {len(lessons)} уроков вместо 7, корректируем")
+            return lessons[:7] if len(lessons) > 7 else lessons + ["Дополнительный урок"] * (7 - len(lessons))
+        await response_cache.set("plan", lessons, skill, experience, goal, edit_request)
+        return lessons
+    except Exception as e:
+        logger.error(f"Ошибка генерации плана: {str(e)}")
+        return None
+
+# Параметры конвейера генерации курса: один запрос на каждый день плана
+COURSE_DAYS = 7
+LESSON_CONCURRENCY = int(os.getenv("LESSON_CONCURRENCY", "3"))
+LESSON_MAX_ATTEMPTS = int(os.getenv("LESSON_MAX_ATTEMPTS", "3"))
+LESSON_MIN_LENGTH = 1200
+LESSON_MAX_LENGTH = 4000  # Лимит Telegram на длину сообщения — 4096 символов
+
+# Заголовки разделов, которые обязаны присутствовать в каждом уроке
+LESSON_SECTIONS = [section.marker for section in SECTIONS if section.template]
+
+async def _get_resource_content(skill, target="уроки"):
+    # Проверяем базу данных
+    try:
+        resources = await get_resources_by_tags(skill.lower(), limit=RESOURCE_CANDIDATES)
+    except Exception as e:
+        logger.error(f"Ошибка поиска материалов для '{skill}': {str(e)}")
+        return ""
+    # В промпт попадают только самые релевантные неповторяющиеся фрагменты в пределах бюджета токенов
+    lines = select_resources(resources)
+    if not lines:
+        return ""
+    return (
+        "Используй следующий материал из базы данных:\n" + "".join(lines) +
+        f"Интегрируй этот материал в {target}, адаптируя под структуру.\n"
+    )
+
+def check_lesson_format(lesson, day):
+    """Возвращает описание проблемы с форматом урока или None, если урок корректен."""
+    if not lesson.startswith(f"<b>День {day + 1}"):
+        return "неверный заголовок"
+    missing = [section for section in LESSON_SECTIONS if section not in lesson]
+    if missing:
+        return f"нет разделов: {', '.join(missing)}"
+    if "---" in lesson:
+        return "лишний разделитель '---'"
+    if not LESSON_MIN_LENGTH <= len(lesson) <= LESSON_MAX_LENGTH:
+        return f"длина {len(lesson)} символов"
+    return None
+
+def _lesson_prompt(skill, experience, goal, preferences, plan, day, resource_content):
+    plan_str = "\n".join([f"День {i+1}: {title}" for i, title in enumerate(plan)])
+    instructions = (
+        f"Ты — эксперт в обучении с 20-летним опытом, создающий вдохновляющие курсы. "
+        f"Ты пишешь 7-дневный курс по навыку '{skill}' для цели '{goal}'. "
+        f"Уровень опыта: {experience}. Предпочтения: {preferences}.\n\n"
+        f"### Принцип 80/20\n"
+        f"- Дай 20% знаний, которые обеспечат 80% результата.\n"
+        f"- Убери всё лишнее, оставь только самое важное.\n\n"
+        f"### План курса\n{plan_str}\n\n"
+        f"### Задача\n"
+        f"- Напиши ТОЛЬКО урок для дня {day + 1}: '{plan[day]}'.\n"
+        f"- Не повторяй темы других дней плана, опирайся на предыдущие дни.\n\n"
+        f"### Структура урока\n"
+        f"- Урок должен быть в точном формате:\n"
+        f"  <b>День {day + 1}: {plan[day]}</b>\n"
+        f"  <b>Краткое введение 🎯</b>: 3-4 предложения (почему это важно, с мотивацией).\n"
+        f"  <b>Основной шаг 🚀</b>: Ключевая идея, 3-4 совета. В конце ОБЯЗАТЕЛЬНО добавь: 'Не уверен? Задай мне вопрос!'.\n"
+        f"  <b>Практический пример 🌟</b>: Реальная ситуация с деталями.\n"
+        f"  <b>Практическое задание 1 ✍️</b>: Простое задание для практики.\n"
+        f"  <b>Практическое задание 2 ✍️</b>: Задание для закрепления.\n"
+        f"  💡 Полезный совет: Короткий и практичный.\n"
+        f"  Не стесняйся задавать вопросы — я здесь, чтобы помочь!\n"
+        f"  По любому поводу можешь задать мне вопрос! 🚀\n"
+        f"  <b>Спрашивай обо всём! 🤓</b>\n"
+        f"- Не дублируй заголовки, используй ТОЛЬКО указанный формат.\n"
+        f"### Персонализация\n"
+        f"- Для новичков: простые основы. Для среднего: больше практики. Для продвинутых: сложные задачи.\n"
+        f"- Учитывай предпочтения ({preferences}) в примерах и стиле.\n"
+        f"- Если программирование — используй Python, если язык не указан.\n\n"
+        f"### Формат\n"
+        f"- Длина урока: 1800-2400 символов (строго соблюдай этот диапазон).\n"
+        f"- Используй <b>жирный текст</b> с <b></b> только для заголовков.\n"
+        f"- Никаких ** или * в тексте.\n"
+        f"- Добавляй смайлики (🎯, 🚀, 🌟, ✍️) к заголовкам.\n"
+        f"- Пиши вдохновляюще, дружелюбно, как наставник.\n"
+        f"- Не используй разделитель '---'.\n"
+        f"- Не указывай время выполнения заданий."
+    )
+    return (
+        PromptBuilder(f"урок дня {day + 1}")
+        .add("инструкции", instructions)
+        .add("материалы", resource_content or "Если материала нет, создай урок с нуля.")
+        .build()
+    )
+
+@llm_metrics()
+async def generate_lesson(skill, experience, goal, preferences, plan, day, resource_content=None, on_text=None,
+                          priority=PRIORITY_NORMAL, on_queued=None):
+    """Генерирует урок одного дня; при ошибке формата повторяет запрос только для этого дня."""
+    if resource_content is None:
+        resource_content = await _get_resource_content(skill)
+    prompt = _lesson_prompt(skill, experience, goal, preferences, plan, day, resource_content)
+    for attempt in range(1, LESSON_MAX_ATTEMPTS + 1):
+        try:
+            lesson = await _generate_text(
+                prompt, on_text=on_text, priority=priority, on_queued=on_queued if attempt == 1 else None,
+                model=MODEL_STRONG
+            )
+        except QueueFull as e:
+            logger.warning(f"Урок дня {day + 1} не поставлен в очередь: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка генерации урока дня {day + 1} (попытка {attempt}/{LESSON_MAX_ATTEMPTS}): {str(e)}")
+            continue
+        log_text(logger, "gemini", f"Сырой ответ Gemini для дня {day + 1}", lesson)
+        problem = check_lesson_format(lesson, day)
+        if problem is None:
+            return lesson
+        logger.warning(f"Урок дня {day + 1} не прошёл проверку формата ({problem}), попытка {attempt}/{LESSON_MAX_ATTEMPTS}")
+    logger.error(f"Не удалось сгенерировать урок дня {day + 1} за {LESSON_MAX_ATTEMPTS} попыток")
+    return None
+
+def start_course_generation(skill, experience, goal, preferences, plan, on_first_lesson_text=None,
+                            on_first_lesson_queued=None):
+    """Запускает параллельную генерацию всех дней курса и возвращает список задач по дням.
+
+    Одновременно выполняется не больше LESSON_CONCURRENCY запросов; задачи стартуют
+    по порядку дней, поэтому первый урок готов раньше остальных. Первый урок можно
+    читать потоком через on_first_lesson_text; остальные дни идут с фоновым приоритетом.
+    """
+    semaphore = asyncio.Semaphore(LESSON_CONCURRENCY)
+    resource_task = asyncio.create_task(_get_resource_content(skill))
+
+    async def run_day(day):
+        resource_content = await asyncio.shield(resource_task)
+        async with semaphore:
+            if day == 0:
+                return await generate_lesson(
+                    skill, experience, goal, preferences, plan, day, resource_content,
+                    on_first_lesson_text, PRIORITY_NORMAL, on_first_lesson_queued
+                )
+            return await generate_lesson(
+                skill, experience, goal, preferences, plan, day, resource_content, priority=PRIORITY_BULK
+            )
+
+    return [asyncio.create_task(run_day(day)) for day in range(COURSE_DAYS)]
+
+@llm_metrics()
+async def generate_course(skill, experience, goal, preferences, plan):
+    try:
+        lessons = await asyncio.gather(*start_course_generation(skill, experience, goal, preferences, plan))
+        if any(lesson is None for lesson in lessons):
+            logger.error(f"Курс по '{skill}' сгенерирован не полностью")
+            return None
+        return list(lessons)
+    except Exception as e:
+        logger.error(f"Ошибка генерации курса: {str(e)}")
+        return None
+
+ANSWER_BUSY = "<b>Сейчас очень много вопросов</b> 🙏 Попробуй задать свой через минуту — я обязательно отвечу!"
+ANSWER_ERROR = "<b>Ой, не переживай!</b> 🎯 Я помогу! Задай вопрос ещё раз, и мы разберёмся вместе. ✍️"
+SIMPLIFY_QUESTION = "Объясни этот урок проще"
+# Для упрощения модели достаточно заголовка, введения и основного шага: задания и пример
+# только удлиняют промпт
+SIMPLIFY_SECTIONS = ("title", "intro", "main")
+
+@llm_metrics()
+async def generate_answer(question, context="", on_text=None, priority=PRIORITY_INTERACTIVE, on_queued=None):
+    """Запрос ответа на вопрос; ошибки не перехватываются."""
+    prompt = (
+        f"Ты — наставник с 20-летним опытом. Контекст: {context}\n"
+        f"Ответь на вопрос: '{question}'.\n"
+        f"Применяй закон 80/20: 20% ключевой информации для 80% понимания.\n"
+        f"Текст — 300-500 символов, вдохновляющий и дружелюбный.\n"
+        f"Используй <b>жирный текст</b> с <b></b> для ключевых моментов, никаких ** или других символов.\n"
+        f"Добавляй смайлики (🎯, 🚀, 🌟, ✍️). Не делай структуру урока, просто ответь."
+    )
+    return await _generate_text(prompt, on_text=on_text, priority=priority, on_queued=on_queued)
+
+@llm_metrics(ANSWER_BUSY, ANSWER_ERROR)
+async def answer_question(question, context="", on_text=None, on_queued=None):
+    try:
+        response = await generate_answer(question, context, on_text=on_text, on_queued=on_queued)
+        log_text(logger, "gemini", "Сырой ответ Gemini на вопрос", response)
+        return response
+    except QueueFull as e:
+        logger.warning(f"Вопрос не поставлен в очередь: {e}")
+        return ANSWER_BUSY
+    except Exception as e:
+        logger.error(f"Ошибка при ответе на вопрос: {str(e)}")
+        return ANSWER_ERROR
+
+@llm_metrics(ANSWER_BUSY, ANSWER_ERROR)
+async def answer_lesson_question(skill, lesson, question, on_text=None, on_queued=None):
+    """Ответ на вопрос по уроку; такой же или похожий вопрос к тому же уроку берётся из answer_cache."""
+    cached = answer_cache.get(skill, lesson, question)
+    if cached is not None:
+        return cached
+    context = f"Пользователь проходит курс по '{skill}'. Текущий урок:\n{lesson}"
+    try:
+        response = await generate_answer(question, context, on_text=on_text, on_queued=on_queued)
+    except QueueFull as e:
+        logger.warning(f"Вопрос не поставлен в очередь: {e}")
+        return ANSWER_BUSY
+    except Exception as e:
+        logger.error(f"Ошибка при ответе на вопрос: {str(e)}")
+        return ANSWER_ERROR
+    answer_cache.set(skill, lesson, question, response)
+    return response
+
+@llm_metrics()
+async def simplify_lesson_text(skill, lesson, on_text=None, priority=PRIORITY_INTERACTIVE, on_queued=None):
+    """Упрощённое объяснение урока или None при ошибке.
+
+    Результат кэшируется по тексту урока, поэтому ответ, подготовленный заранее
+    (см. prefetch.py), отдаётся по кнопке без нового запроса.
+    """
+    cached = await response_cache.get("simplify", skill, lesson)
+    if cached:
+        return cached
+    context = f"Пользователь проходит курс по '{skill}'. Текущий урок:\n{excerpt(lesson, SIMPLIFY_SECTIONS)}"
+    try:
+        response = await generate_answer(SIMPLIFY_QUESTION, context, on_text, priority, on_queued)
+    except QueueFull as e:
+        logger.warning(f"Упрощение урока не поставлено в очередь: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка упрощения урока: {str(e)}")
+        return None
+    await response_cache.set("simplify", response, skill, lesson)
+    return response
+
+@llm_metrics()
+async def generate_course_suggestions(skill, priority=PRIORITY_NORMAL):
+    try:
+        cached = await response_cache.get("suggestions", skill)
+        if cached:
+            return cached
+        prompt = (
+            f"Ты — эксперт в обучении. Предложи 3 идеи для курсов после '{skill}'. "
+            f"Каждая идея — строка (30-50 символов). "
+            f"Возвращай только 3 строки без лишнего текста."
+        )
+        response = (await _generate_text(prompt, priority=priority)).split("\n")
+        suggestions = [suggestion.strip() for suggestion in response if suggestion.strip()]
+        if len(suggestions) != 3:
+            logger.warning(f"Сгенерировано {len(suggestions)} предложений вместо 3, корректируем")
+            return suggestions[:3] if len(suggestions) > 3 else suggestions + ["Дополнительный курс"] * (3 - len(suggestions))
+        await response_cache.set("suggestions", suggestions, skill)
+        return suggestions
+    except Exception as e:
+        logger.error(f"Ошибка генерации предложений: {str(e)}")
+        return None
+
+async def _update_lesson_sections(skill, experience, goal, preferences, sections, keys, edit_request, day,
+                                  resource_content, on_text=None, on_queued=None):
+    """Переписывает только разделы keys урока; None, если ответ не удалось встроить в урок."""
+    current = dict(sections)
+    names = ", ".join(f"'{SECTIONS_BY_KEY[key].name}'" for key in keys)
+    templates = "\n".join(
+        f"  {SECTIONS_BY_KEY[key].template} Сейчас раздел занимает {len(current[key].strip())} символов."
+        for key in keys
+    )
+    task = (
+        f"Ты — эксперт в обучении с 20-летним опытом. "
+        f"Перепиши часть урока по навыку '{skill}' с учётом пожелания: '{edit_request}'. "
+        f"Уровень опыта: {experience}. Цель: {goal}. Предпочтения: {preferences}. "
+        f"Текущий урок:"
+    )
+    instructions = (
+        f"Применяй закон 80/20: 20% знаний для 80% результата.\n"
+        f"### Что вернуть\n"
+        f"- Верни только разделы {names} в этом порядке, каждый со своим заголовком:\n"
+        f"{templates}\n"
+        f"- Остальные разделы урока не меняются: не повторяй их и ничего не добавляй до и после.\n"
+        f"- Каждый раздел — не длиннее чем в полтора раза относительно текущего.\n"
+        f"- Сделай акцент на практических шагах для '{edit_request}'.\n"
+        f"- Используй <b>жирный текст</b> с <b></b> ТОЛЬКО для заголовков.\n"
+        f"- Никаких ** или * в тексте.\n"
+        f"- Пиши вдохновляюще и дружелюбно, в стиле остального урока."
+    )
+    prompt = (
+        PromptBuilder("обновление разделов урока")
+        .add("задача", task)
+        .add("текущий урок", join_sections(sections))
+        .add("инструкции", instructions)
+        .add("материалы", resource_content)
+        .build()
+    )
+    show = None
+    if on_text is not None:
+        # Пока разделы пишутся, пользователь видит урок до первого изменённого раздела и новый текст
+        head = join_sections(sections[:[key for key, _ in sections].index(keys[0])])
+
+        async def show(text):
+            await on_text(head + text)
+
+    response = await _generate_text(prompt, on_text=show, on_queued=on_queued, model=MODEL_STRONG)
+    log_text(logger, "gemini", f"Сырой ответ Gemini для разделов {keys}", response)
+    rewritten = parse_rewrite(response, keys)
+    if rewritten is None:
+        logger.warning(f"Ответ с разделами {keys} не разобран, урок дня {day + 1} обновляется целиком")
+        return None
+    lesson = join_sections(splice(sections, rewritten))
+    problem = check_lesson_format(lesson, day)
+    if problem:
+        logger.warning(f"Урок дня {day + 1} после замены разделов {keys}: {problem}, обновляем целиком")
+        return None
+    return lesson
+
+@llm_metrics()
+async def update_lesson(skill, experience, goal, preferences, current_lesson, edit_request, day, on_text=None, on_queued=None):
+    """Урок, обновлённый по пожеланию, или текущий урок при ошибке.
+
+    Пожелание, касающееся отдельных разделов («Больше примеров»), переписывает только их
+    (см. lesson_sections); если ответ не встраивается в урок, урок переписывается целиком.
+    """
+    try:
+        current_title = current_lesson.split('\n')[0].replace("<b>", "").replace("</b>", "").split(": ")[1].strip()
+        
+        # Проверяем базу данных
+        resource_content = await _get_resource_content(skill, "урок")
+        
+        keys = route_edit(edit_request)
+        sections = parse_lesson(current_lesson) if keys else None
+        if sections:
+            lesson = await _update_lesson_sections(
+                skill, experience, goal, preferences, sections, keys, edit_request, day, resource_content,
+                on_text=on_text, on_queued=on_queued
+            )
+            if lesson:
+                return lesson
+        
+        task = (
+            f"Ты — эксперт в обучении с 20-летним опытом. "
+            f"Обнови урок по навыку '{skill}' с учётом пожелания: '{edit_request}'. "
+            f"Уровень опыта: {experience}. Цель: {goal}. Предпочтения: {preferences}. "
+            f"Текущий урок:"
+        )
+        instructions = (
+            f"Применяй закон 80/20: 20% знаний для 80% результата.\n"
+            f"Сохрани заголовок урока: '<b>День {day + 1}: {current_title}</b>'.\n"
+            f"### Структура урока\n"
+            f"- Урок должен быть в точном формате:\n"
+            f"  <b>День X: [Название урока]</b>\n"
+            f"  <b>Краткое введение 🎯</b>: 2-3 предложения (почему это важно, с мотивацией).\n"
+            f"  <b>Основной шаг 🚀</b>: Ключевая идея, 3-4 совета. В конце ОБЯЗАТЕЛЬНО добавь: 'Не уверен? Задай мне вопрос!'.\n"
+            f"  <b>Практический пример 🌟</b>: Реальная ситуация с деталями.\n"
+            f"  <b>Практическое задание 1 ✍️</b>: Простое задание с инструкциями.\n"
+            f"  <b>Практическое задание 2 ✍️</b>: Задание для закрепления с инструкциями.\n"
+            f"  💡 Полезный совет: Короткий и практичный.\n"
+            f"  Не стесняйся задавать вопросы — я здесь, чтобы помочь!\n"
+            f"  По любому поводу можешь задать мне вопрос! 🚀\n"
+            f"  <b>Спрашивай обо всём! 🤓</b>\n"
+            f"- Не дублируй заголовки, используй ТОЛЬКО указанный формат.\n"
+            f"### Дополнительно\n"
+            f"- Сделай акцент на практических шагах для '{edit_request}'.\n"
+            f"- Длина: 1800-2400 символов (строго соблюдай этот диапазон).\n"
+            f"- Используй <b>жирный текст</b> с <b></b> ТОЛЬКО для заголовков.\n"
+            f"- Никаких ** или * в тексте.\n"
+            f"- Пиши вдохновляюще и дружелюбно."
+        )
+        prompt = (
+            PromptBuilder("обновление урока")
+            .add("задача", task)
+            .add("текущий урок", current_lesson)
+            .add("инструкции", instructions)
+            .add("материалы", resource_content or "Если материала нет, обнови урок с нуля.")
+            .build()
+        )
+        response = await _generate_text(prompt, on_text=on_text, on_queued=on_queued, model=MODEL_STRONG)
+        log_text(logger, "gemini", "Сырой ответ Gemini для обновления урока", response)
+        # Проверяем длину
+        lesson_length = len(response)
+        if lesson_length < 1800 or lesson_length > 2400:
+            logger.warning(f"Длина обновлённого урока {lesson_length} символов, ожидалось 1800-2400")
+        return response
+    except Exception as e:
+        logger.error(f"Ошибка обновления урока: {str(e)}")
+        return current_lesson
+
+__all__ = ["generate_plan", "generate_course", "generate_lesson", "start_course_generation", "check_lesson_format", "answer_question", "answer_lesson_question", "simplify_lesson_text", "generate_course_suggestions", "update_lesson"]
\ No newline at end of file
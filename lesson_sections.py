@@ -0,0 +1,119 @@
+import re
+
+# Урок (см. _lesson_prompt в gemini_service) состоит из фиксированных разделов: заголовок дня,
+# пять разделов с заголовками <b>…</b>, полезный совет и неизменная концовка с призывом задавать
+# вопросы. Раздел начинается со строки, содержащей его маркер, и тянется до следующего раздела.
+# Пожелание к уроку («Больше примеров») переписывает только затронутые разделы, а не весь урок.
+
+class Section:
+    def __init__(self, key, marker, template=None):
+        self.key = key
+        self.marker = marker
+        self.name = marker and marker.replace("<b>", "")
+        self.template = template  # Строка формата для промпта; None — раздел не переписывается
+
+SECTIONS = [
+    Section("title", "<b>День"),
+    Section("intro", "<b>Краткое введение", "<b>Краткое введение 🎯</b>: 3-4 предложения (почему это важно, с мотивацией)."),
+    Section("main", "<b>Основной шаг", "<b>Основной шаг 🚀</b>: Ключевая идея, 3-4 совета. В конце ОБЯЗАТЕЛЬНО добавь: 'Не уверен? Задай мне вопрос!'."),
+    Section("example", "<b>Практический пример", "<b>Практический пример 🌟</b>: Реальная ситуация с деталями."),
+    Section("task1", "<b>Практическое задание 1", "<b>Практическое задание 1 ✍️</b>: Простое задание с инструкциями."),
+    Section("task2", "<b>Практическое задание 2", "<b>Практическое задание 2 ✍️</b>: Задание для закрепления с инструкциями."),
+    Section("tip", "Полезный совет", "💡 Полезный совет: Короткий и практичный."),
+    Section("outro", None),  # Всё после строки совета
+]
+SECTIONS_BY_KEY = {section.key: section for section in SECTIONS}
+EDITABLE = [section.key for section in SECTIONS if section.template]
+
+# Разделы, которых касается пожелание, по началам слов в нём. Пожелание без этих слов
+# («проще», «на английском») или затрагивающее весь урок переписывает урок целиком
+EDIT_ROUTES = (
+    (("пример", "кейс", "ситуац", "истори", "код"), ("example",)),
+    (("задани", "упражнен", "практик", "задач", "домашк"), ("task1", "task2")),
+    (("совет", "лайфхак", "подсказ"), ("tip",)),
+    (("введени", "вступлени", "мотивац", "зачем"), ("intro",)),
+    (("теори", "объяснени", "основн", "шаг", "иде", "термин"), ("main",)),
+)
+WHOLE_LESSON_WORDS = ("весь", "всё", "все", "всех", "целиком", "полностью")
+WHOLE_LESSON_PREFIXES = ("стил", "тональн", "язык", "английск")
+
+_WORD_RE = re.compile(r"\w+")
+
+def parse_lesson(lesson):
+    """Список (ключ, текст) разделов урока, склеивающийся обратно в исходный текст, или None.
+
+    None — если урока нет (None), какого-то маркера нет или разделы идут не по порядку:
+    такой урок переписывается целиком.
+    """
+    if not lesson:
+        return None
+    starts = []
+    position = 0
+    for section in SECTIONS[:-1]:
+        found = lesson.find(section.marker, position)
+        if found < 0:
+            return None
+        start = lesson.rfind("\n", 0, found) + 1
+        if starts and start <= starts[-1]:
+            return None  # Два маркера в одной строке
+        starts.append(start)
+        position = found + len(section.marker)
+    if starts[0] != 0:
+        return None
+    # Совет — одна строка, за ней концовка
+    tip_end = lesson.find("\n", position)
+    starts.append(len(lesson) if tip_end < 0 else tip_end)
+    ends = starts[1:] + [len(lesson)]
+    return [(section.key, lesson[start:end]) for section, start, end in zip(SECTIONS, starts, ends)]
+
+def join_sections(sections):
+    return "".join(text for _, text in sections)
+
+def excerpt(lesson, keys):
+    """Текст только указанных разделов урока или весь урок, если его не удалось разобрать.
+
+    Для отсутствующего урока — пустая строка.
+    """
+    sections = parse_lesson(lesson)
+    if sections is None:
+        return lesson or ""
+    return "\n".join(text.strip() for key, text in sections if key in keys)
+
+def route_edit(edit_request):
+    """Ключи разделов, которые нужно переписать по пожеланию, или None — переписать весь урок."""
+    words = _WORD_RE.findall(edit_request.lower())
+    if any(word in WHOLE_LESSON_WORDS or word.startswith(WHOLE_LESSON_PREFIXES) for word in words):
+        return None
+    keys = set()
+    for prefixes, section_keys in EDIT_ROUTES:
+        if any(word.startswith(prefixes) for word in words):
+            keys.update(section_keys)
+    if not keys or len(keys) == len(EDITABLE):
+        return None
+    return [key for key in EDITABLE if key in keys]
+
+def parse_rewrite(response, keys):
+    """Разбирает ответ с переписанными разделами keys: словарь ключ -> текст или None."""
+    markers = [(key, response.find(SECTIONS_BY_KEY[key].marker)) for key in keys]
+    if any(found < 0 for _, found in markers):
+        return None
+    starts = [response.rfind("\n", 0, found) + 1 for _, found in markers]
+    if starts != sorted(starts) or len(set(starts)) != len(starts):
+        return None
+    ends = starts[1:] + [len(response)]
+    rewritten = {key: response[start:end].strip() for (key, _), start, end in zip(markers, starts, ends)}
+    # Модель могла вернуть и соседние разделы: их маркеры попадут в текст последнего раздела
+    for key, text in rewritten.items():
+        if any(section.marker in text[1:] for section in SECTIONS[1:-1] if section.key != key):
+            return None
+    return rewritten
+
+def splice(sections, rewritten):
+    """Заменяет разделы текстами из rewritten, сохраняя пробелы и переносы между разделами."""
+    spliced = []
+    for key, text in sections:
+        if key in rewritten:
+            body = text.rstrip()
+            text = rewritten[key] + text[len(body):]
+        spliced.append((key, text))
+    return spliced
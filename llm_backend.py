@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import random
+import re
+import google.generativeai as genai
+from dotenv import load_dotenv
+from lesson_sections import SECTIONS
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Какая реализация отвечает на запросы: gemini или fake (детерминированные ответы без сети)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+# Быстрая модель — для коротких ответов (план, предложения, вопросы), сильная — для уроков
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", "gemini-1.5-flash")
+GEMINI_STRONG_MODEL = os.getenv("GEMINI_STRONG_MODEL", "gemini-1.5-flash")
+# GEMINI_API_ENDPOINT позволяет направить запросы на локальный тестовый сервер (REST вместо gRPC)
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+# Задержка фейкового бэкенда на весь ответ (делится между фрагментами потока), формат — см. latency_sampler;
+# для сильной модели можно задать отдельное распределение
+FAKE_LLM_LATENCY = os.getenv("FAKE_LLM_LATENCY", "0.2")
+FAKE_LLM_STRONG_LATENCY = os.getenv("FAKE_LLM_STRONG_LATENCY", FAKE_LLM_LATENCY)
+
+MODEL_FAST = "fast"
+MODEL_STRONG = "strong"
+
+class GeminiBackend:
+    """Запросы к Gemini через google-generativeai.
+
+    Объекты GenerativeModel создаются один раз на модель и переиспользуются; библиотека
+    держит один клиент (и одно gRPC-соединение) на процесс.
+    """
+
+    def __init__(self, models=None):
+        if GEMINI_API_ENDPOINT:
+            genai.configure(
+                api_key=os.getenv("GEMINI_API_KEY"), transport="rest",
+                client_options={"api_endpoint": GEMINI_API_ENDPOINT}
+            )
+        else:
+            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        self.models = models or {MODEL_FAST: GEMINI_FAST_MODEL, MODEL_STRONG: GEMINI_STRONG_MODEL}
+        self._pool = {}
+        self.calls = {tier: 0 for tier in self.models}
+
+    def model(self, tier):
+        name = self.models[tier]
+        if name not in self._pool:
+            logger.info(f"Создана модель {name} для запросов '{tier}'")
+            self._pool[name] = genai.GenerativeModel(name)
+        return self._pool[name]
+
+    async def generate(self, prompt, tier=MODEL_FAST, on_text=None):
+        model = self.model(tier)
+        self.calls[tier] += 1
+        if GEMINI_API_ENDPOINT:
+            # Асинхронный клиент google-generativeai не работает поверх REST:
+            # выполняем обычный запрос в отдельном потоке и отдаём ответ целиком
+            response = await asyncio.to_thread(model.generate_content, prompt)
+            if on_text is not None:
+                await on_text(response.text)
+            return response.text
+        if on_text is None:
+            response = await model.generate_content_async(prompt)
+            return response.text
+        response = await model.generate_content_async(prompt, stream=True)
+        text = ""
+        async for chunk in response:
+            text += chunk.text
+            await on_text(text)
+        return text
+
+    def stats(self):
+        return {"backend": "gemini", "models": self.models, "calls": dict(self.calls)}
+
+def latency_sampler(spec):
+    """Функция, возвращающая случайную задержку в секундах по описанию распределения.
+
+    "0.5" — постоянная, "uniform:0.2,2" — равномерная, "lognormal:1.5,0.6" — логнормальная
+    с медианой 1.5 с и сигмой 0.6, "exp:1.0" — экспоненциальная со средним 1 с.
+    """
+    kind, _, params = str(spec).partition(":")
+    if not params:
+        value = float(kind)
+        return lambda: value
+    args = [float(param) for param in params.split(",")]
+    if kind == "uniform":
+        return lambda: random.uniform(*args)
+    if kind == "lognormal":
+        median, sigma = args
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    if kind == "exp":
+        return lambda: random.expovariate(1 / args[0])
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+_SECTIONS_RE = re.compile(r"Верни только разделы (.+?) в этом порядке")
+_LESSON_TITLE_RE = re.compile(r"<b>День (\d+): (.+?)</b>")
+_LINES_RE = re.compile(r"Возвращай только (\d+) строк")
+# Вопросы и упрощение (generate_answer) передают текущий урок в контексте, поэтому этот
+# маркер проверяется раньше заголовка урока
+_ANSWER_MARKER = "Ответь на вопрос"
+_FAKE_WORDS = (
+    "практика", "пример", "шаг", "идея", "навык", "результат", "цель", "привычка", "ошибка", "совет",
+    "задача", "основа", "метод", "проект", "опыт", "вопрос", "план", "прогресс", "инструмент", "приём",
+)
+
+class FakeBackend:
+    """Детерминированные ответы без обращения к сети — для нагрузочных тестов обработчиков.
+
+    Одинаковый промпт всегда даёт одинаковый ответ. Уроки проходят check_lesson_format,
+    планы и предложения содержат запрошенное число строк.
+    """
+
+    def __init__(self, latency=FAKE_LLM_LATENCY, strong_latency=FAKE_LLM_STRONG_LATENCY, chunks=4):
+        self.latency = {MODEL_FAST: latency_sampler(latency), MODEL_STRONG: latency_sampler(strong_latency)}
+        self.chunks = chunks
+        self.calls = {MODEL_FAST: 0, MODEL_STRONG: 0}
+
+    def _words(self, rng, count):
+        return " ".join(rng.choice(_FAKE_WORDS) for _ in range(count))
+
+    def respond(self, prompt):
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        rewrite = _SECTIONS_RE.search(prompt)
+        if rewrite:
+            # Переписать отдельные разделы урока (см. lesson_sections)
+            names = re.findall(r"'(.+?)'", rewrite.group(1))
+            headers = [section.template.split(":")[0] for section in SECTIONS if section.name in names]
+            return "\n\n".join(f"{header}: {self._words(rng, 40)}." for header in headers)
+        if _ANSWER_MARKER in prompt:
+            return self._answer(rng)
+        title = _LESSON_TITLE_RE.search(prompt)
+        if title:
+            day, name = title.groups()
+            sections = [
+                f"<b>День {day}: {name}</b>",
+                f"<b>Краткое введение 🎯</b>: {self._words(rng, 40)}.",
+                f"<b>Основной шаг 🚀</b>: {self._words(rng, 60)}. Не уверен? Задай мне вопрос!",
+                f"<b>Практический пример 🌟</b>: {self._words(rng, 50)}.",
+                f"<b>Практическое задание 1 ✍️</b>: {self._words(rng, 25)}.",
+                f"<b>Практическое задание 2 ✍️</b>: {self._words(rng, 25)}.",
+                f"💡 Полезный совет: {self._words(rng, 15)}.",
+                "Не стесняйся задавать вопросы — я здесь, чтобы помочь!",
+                "По любому поводу можешь задать мне вопрос! 🚀",
+                "<b>Спрашивай обо всём! 🤓</b>",
+            ]
+            return "\n\n".join(sections)
+        lines = _LINES_RE.search(prompt)
+        if lines:
+            return "\n".join(f"{self._words(rng, 5).capitalize()} {i + 1}" for i in range(int(lines.group(1))))
+        return self._answer(rng)
+
+    def _answer(self, rng):
+        return f"<b>Ответ</b> 🎯 {self._words(rng, 50)}."
+
+    async def generate(self, prompt, tier=MODEL_FAST, on_text=None):
+        self.calls[tier] += 1
+        text = self.respond(prompt)
+        step = max(1, len(text) // self.chunks)
+        ends = range(step, len(text) + step, step)
+        delay = self.latency[tier]() / len(ends)
+        for end in ends:
+            await asyncio.sleep(delay)
+            if on_text is not None:
+                await on_text(text[:end])
+        return text
+
+    def stats(self):
+        return {"backend": "fake", "calls": dict(self.calls)}
+
+def create_backend(name=LLM_BACKEND):
+    if name == "fake":
+        logger.warning("Используется фейковый LLM-бэкенд: ответы не настоящие")
+        return FakeBackend()
+    return GeminiBackend()
+
+llm_backend = create_backend()
@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
+
+# Квоты Gemini: запросы и токены в минуту, число одновременных запросов
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "60"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+# Сколько запросов каждого приоритета может ждать в очереди; лишние сразу получают отказ
+GEMINI_QUEUE_SIZE = int(os.getenv("GEMINI_QUEUE_SIZE", "100"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_RETRY_BASE = 1.0
+GEMINI_RETRY_CAP = 30.0
+
+# Чем меньше число, тем раньше запрос получит квоту
+PRIORITY_INTERACTIVE = 0  # ответы на вопросы по уроку
+PRIORITY_NORMAL = 1  # запросы, которых пользователь ждёт: план, первый урок, правка урока
+PRIORITY_BULK = 2  # фоновая генерация остальных дней курса
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_NORMAL: "normal", PRIORITY_BULK: "bulk"}
+
+# 429 и ошибки сервера повторяем; остальные ошибки (неверный запрос, ключ) — нет
+RETRYABLE_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ServerError)
+
+class QueueFull(Exception):
+    """Очередь запросов к Gemini переполнена."""
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None):
+        # capacity — допустимый всплеск; по умолчанию вся минутная квота
+        self.capacity = capacity or per_minute
+        self.tokens = float(self.capacity)
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Сколько секунд ждать, пока в ведре наберётся amount (не больше ёмкости)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        # Отрицательное amount возвращает переоценённую квоту
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - min(amount, self.capacity))
+
+class LLMScheduler:
+    """Единая очередь запросов к LLM с лимитами RPM/TPM, приоритетами и повторами.
+
+    Запрос получает слот, когда в обоих ведрах хватает квоты и число активных запросов
+    меньше max_concurrency; среди ожидающих первым идёт запрос с меньшим приоритетом,
+    при равенстве — более ранний. После 429 выдача слотов приостанавливается на время отката.
+    """
+
+    def __init__(self, rpm=GEMINI_RPM, tpm=GEMINI_TPM, max_concurrency=GEMINI_MAX_CONCURRENCY,
+                 queue_size=GEMINI_QUEUE_SIZE, max_retries=GEMINI_MAX_RETRIES):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.active = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._queued = {priority: 0 for priority in PRIORITY_NAMES}  # без отменённых, ещё лежащих в куче
+        self._cancelled = 0
+        self._timer = None
+        self._paused_until = 0.0
+        self._stats = {
+            priority: {"granted": 0, "rejected": 0, "retries": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for priority in PRIORITY_NAMES
+        }
+
+    def _dispatch(self):
+        while self._heap and self.active < self.max_concurrency:
+            priority, _, amount, future = self._heap[0]
+            if future.cancelled():
+                # Уже вычтен из _queued при отмене в acquire
+                heapq.heappop(self._heap)
+                self._cancelled -= 1
+                continue
+            now = time.monotonic()
+            wait = max(self._paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(amount))
+            if wait > 0:
+                self._schedule(wait)
+                return
+            heapq.heappop(self._heap)
+            self._queued[priority] -= 1
+            self.requests.take(1)
+            self.tokens.take(amount)
+            self.active += 1
+            future.set_result(None)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _position(self, priority, seq):
+        return sum(1 for p, s, _, future in self._heap if (p, s) < (priority, seq) and not future.cancelled()) + 1
+
+    async def acquire(self, amount, priority=PRIORITY_BULK, on_queued=None):
+        """Ждёт слот для запроса примерно на amount токенов; on_queued(позиция) вызывается, если слот выдан не сразу."""
+        stats = self._stats[priority]
+        if self._queued[priority] >= self.queue_size:
+            stats["rejected"] += 1
+            raise QueueFull(f"В очереди {PRIORITY_NAMES[priority]} уже {self._queued[priority]} запросов")
+        seq = next(self._seq)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, seq, amount, future))
+        self._queued[priority] += 1
+        started = time.monotonic()
+        self._dispatch()
+        try:
+            if not future.done() and on_queued is not None:
+                try:
+                    await on_queued(self._position(priority, seq))
+                except Exception as e:
+                    logger.warning(f"Не удалось сообщить о месте в очереди: {e}")
+            await future
+        except asyncio.CancelledError:
+            # Отмена задачи обычно отменяет и ожидаемый future
+            if not future.done():
+                future.cancel()
+            if future.cancelled():
+                self._queued[priority] -= 1
+                self._forget_cancelled()
+            else:
+                # Слот был выдан в момент отмены — возвращаем его
+                self.release()
+            raise
+        waited = time.monotonic() - started
+        stats["granted"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def _forget_cancelled(self):
+        # Отменённый запрос уходит из кучи, только дойдя до её вершины; если отменённых
+        # накопилось больше половины (отмена курса снимает до 6 фоновых уроков), кучу пересобираем
+        self._cancelled += 1
+        if self._cancelled * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if not entry[3].cancelled()]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def release(self, reserved=0, used=0):
+        """Освобождает слот; used — фактический расход токенов, если он отличается от оценки."""
+        self.active -= 1
+        if used:
+            self.tokens.take(used - reserved)
+        self._dispatch()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def backoff_delay(self, attempt):
+        # Экспоненциальный откат с полным джиттером, чтобы повторы не приходили пачкой
+        return random.uniform(0, min(GEMINI_RETRY_CAP, GEMINI_RETRY_BASE * 2 ** attempt))
+
+    async def run(self, call, amount, priority=PRIORITY_BULK, on_queued=None, measure=None):
+        """Выполняет call() в слоте планировщика, повторяя его при 429 и ошибках сервера.
+
+        measure(result) возвращает фактический расход токенов для поправки лимита TPM.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(amount, priority, on_queued)
+            on_queued = None  # О месте в очереди сообщаем только один раз
+            used = 0
+            try:
+                result = await call()
+                used = measure(result) if measure else 0
+                return result
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                if isinstance(e, google_exceptions.TooManyRequests):
+                    # Квота провайдера исчерпана: притормаживаем все запросы, а не только этот
+                    self.pause(delay)
+                self._stats[priority]["retries"] += 1
+                logger.warning(f"Gemini вернул ошибку ({e}), повтор {attempt + 1}/{self.max_retries} через {delay:.1f} с")
+            finally:
+                self.release(amount, used)
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        result = {"active": self.active}
+        for priority, name in PRIORITY_NAMES.items():
+            stats = self._stats[priority]
+            result[name] = {
+                "queued": self._queued[priority],
+                "granted": stats["granted"],
+                "rejected": stats["rejected"],
+                "retries": stats["retries"],
+                "wait_avg_s": round(stats["wait_total"] / stats["granted"], 3) if stats["granted"] else 0.0,
+                "wait_max_s": round(stats["wait_max"], 3),
+            }
+        return result
+
+llm_scheduler = LLMScheduler()
@@ -1,39 +1,93 @@
-from database import init_db, add_resource
-
-def load_resources_from_file(filename):
-    init_db()  # Убеждаемся, что база создана
-    
-    with open(filename, 'r', encoding='utf-8') as file:
-        lines = [line.strip() for line in file.readlines() if line.strip()]
-        
-        # Разбиваем на блоки по 5 строк (title, author, type, content, tags)
-        for i in range(0, len(lines), 5):
-            if i + 4 < len(lines):  # Проверяем, что блок полный
-                title = lines[i]
-                author = lines[i + 1]
-                resource_type = lines[i + 2]
-                content = lines[i + 3]
-                tags = lines[i + 4]
-                
-                # Проверка формата
-                if resource_type not in ["book", "article"]:
-                    print(f"Ошибка: '{title}' имеет неверный тип '{resource_type}'. Пропускаем.")
-                    continue
-                if len(content) > 500:
-                    print(f"Ошибка: '{title}' имеет содержание длиннее 500 символов. Обрезаем.")
-                    content = content[:500]
-                
-                # Добавляем в базу
-                add_resource(title, author, resource_type, content, tags)
-                print(f"Добавлен ресурс: {title}")
-            else:
-                print("Ошибка: файл содержит неполный блок данных. Проверьте формат.")
-
-if __name__ == "__main__":
-    try:
-        load_resources_from_file("resources.txt")
-        print("Все ресурсы успешно загружены в базу!")
-    except FileNotFoundError:
-        print("Ошибка: файл 'resources.txt' не найден. Создайте его и добавьте книги.")
-    except Exception as e:
-        print(f"Ошибка при загрузке: {str(e)}")
\ No newline at end of file
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+from database import init_db, add_resources_bulk, close_databases
+
+RESOURCE_TYPES = ["book", "article"]
+MAX_CONTENT_LENGTH = 500
+FIELDS = ["title", "author", "type", "content", "tags"]
+
+def iter_text_blocks(file):
+    # Блоки по 5 непустых строк (title, author, type, content, tags); файл читается построчно
+    block = []
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        block.append(line)
+        if len(block) == 5:
+            yield block
+            block = []
+    if block:
+        print("Ошибка: файл содержит неполный блок данных. Проверьте формат.")
+
+def iter_jsonl(file):
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"Ошибка: строка {number} не является JSON ({e}). Пропускаем.")
+            continue
+        yield [str(record.get(field) or "").strip() for field in FIELDS]
+
+def iter_csv(file):
+    for record in csv.DictReader(file):
+        yield [(record.get(field) or "").strip() for field in FIELDS]
+
+def iter_resources(filename):
+    """Лениво читает материалы из .txt (блоки по 5 строк), .jsonl или .csv и проверяет формат."""
+    extension = os.path.splitext(filename)[1].lower()
+    readers = {".jsonl": iter_jsonl, ".csv": iter_csv}
+    with open(filename, "r", encoding="utf-8", newline="") as file:
+        for title, author, resource_type, content, tags in readers.get(extension, iter_text_blocks)(file):
+            # Проверка формата
+            if resource_type not in RESOURCE_TYPES:
+                print(f"Ошибка: '{title}' имеет неверный тип '{resource_type}'. Пропускаем.")
+                continue
+            if len(content) > MAX_CONTENT_LENGTH:
+                print(f"Ошибка: '{title}' имеет содержание длиннее {MAX_CONTENT_LENGTH} символов. Обрезаем.")
+                content = content[:MAX_CONTENT_LENGTH]
+            yield title, author, resource_type, content, tags
+
+async def load_resources_from_file(filename, batch_size=1000):
+    await init_db()  # Убеждаемся, что база создана
+    started = time.perf_counter()
+
+    def report(inserted, total):
+        if total % (batch_size * 100):
+            return
+        elapsed = time.perf_counter() - started
+        print(f"Обработано {total} ресурсов, добавлено {inserted} ({total / elapsed:.0f} ресурсов/с)")
+
+    inserted, skipped = await add_resources_bulk(iter_resources(filename), batch_size, on_batch=report)
+    elapsed = time.perf_counter() - started
+    print(
+        f"{filename}: добавлено {inserted}, уже были в базе {skipped}, "
+        f"за {elapsed:.1f} с ({(inserted + skipped) / max(elapsed, 1e-9):.0f} ресурсов/с)"
+    )
+    return inserted, skipped
+
+async def main(filenames, batch_size):
+    try:
+        for filename in filenames:
+            await load_resources_from_file(filename, batch_size)
+    finally:
+        await close_databases()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Загрузка книг и статей в базу (.txt, .jsonl, .csv)")
+    parser.add_argument("files", nargs="*", default=["resources.txt"])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.files, args.batch_size))
+        print("Все ресурсы успешно загружены в базу!")
+    except FileNotFoundError as e:
+        print(f"Ошибка: файл '{e.filename}' не найден. Создайте его и добавьте книги.")
+    except Exception as e:
+        print(f"Ошибка при загрузке: {str(e)}")
@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from aiohttp import web
+
+# Нагрузочный прогон бота без сети: синтетические апдейты идут через настоящий Dispatcher
+# и обработчики course.py, Bot API заменён локальной заглушкой, Gemini — фейковым бэкендом
+# (LLM_BACKEND=fake). Результат — пропускная способность и перцентили задержки по шагам
+# сценария в JSON, который можно сравнить с прогоном другой версии через --compare.
+#
+#   python loadtest.py --users 1000 --llm-latency lognormal:1.5,0.5 --output new.json --compare old.json
+
+QUESTIONS = (
+    "Можно пример попроще?",
+    "Сколько времени тратить на практику?",
+    "С чего начать, если совсем нет опыта?",
+    "Как понять, что задание выполнено правильно?",
+)
+ERROR_REPLIES = ("Не удалось", "Произошла ошибка", "Ой, не переживай")
+BOT_ID = 123456  # совпадает с токеном "123456:loadtest"
+# Заголовок, с которого обработчики начинают ответ: "<b>Ответ</b>:\n", "<b>Простое объяснение</b>:\n"
+ANSWER_HEADER_RE = re.compile(r"<b>[^<]*</b>:\n")
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0.0
+
+class FakeBotAPI:
+    """Заглушка Bot API: отвечает на любой метод, считает вызовы и ответы-ошибки бота."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = {}
+        self.error_replies = 0
+        self.last_text = {}  # chat_id -> текст последнего отправленного или изменённого сообщения
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        delay = self.latency()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        text = data.get("text", "")
+        if any(reply in text for reply in ERROR_REPLIES):
+            self.error_replies += 1
+        if method.startswith(("send", "edit", "copy", "forward")):
+            chat_id = int(data.get("chat_id") or 0)
+            if text:
+                self.last_text[chat_id] = text
+            return web.json_response({"ok": True, "result": {
+                "message_id": next(self._message_ids), "date": int(time.time()),
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "CourseCraftBot"},
+                "chat": {"id": chat_id, "type": "private"}, "text": text,
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+class UpdateFactory:
+    """Апдейты Telegram от имени пользователя user_id (чат совпадает с пользователем)."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def message(self, user_id, text):
+        update_id = next(self._ids)
+        message = {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id),
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, user_id, data):
+        # У каждого нажатия своё сообщение, иначе UserLockMiddleware примет его за повтор
+        update_id = next(self._ids)
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "chat_instance": str(user_id), "data": data, "from": self._user(user_id),
+            # Как в Telegram: сообщение с кнопкой отправлено ботом
+            "message": {"message_id": update_id, "date": int(time.time()), "text": "...",
+                        "from": {"id": BOT_ID, "is_bot": True, "first_name": "CourseCraftBot"},
+                        "chat": {"id": user_id, "type": "private"}},
+        }}
+
+class LoadTest:
+    def __init__(self, args, bot_module, api, think_time):
+        self.args = args
+        self.bot = bot_module
+        self.api = api
+        self.think_time = think_time
+        self.updates = UpdateFactory()
+        self.latencies = {}
+        self.errors = {}
+        self.answers_as_lessons = {}
+        self.completed = 0
+
+    async def step(self, name, update):
+        from aiogram import types
+        started = time.perf_counter()
+        try:
+            # Отдельная задача на апдейт, как при polling: aiogram хранит состояние FSM в контексте задачи
+            await asyncio.create_task(self.bot.dp.process_update(types.Update(**update)))
+        except Exception as e:
+            self.errors.setdefault(name, {})
+            self.errors[name][type(e).__name__] = self.errors[name].get(type(e).__name__, 0) + 1
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        delay = self.think_time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def check_answer(self, name, user_id):
+        # Ответ на вопрос и упрощение — короткий текст, а не урок: урок в ответе значит, что
+        # модель (или фейковый бэкенд) перепутала промпты
+        from gemini_service import check_lesson_format
+        course = await self.bot.users.get_course(user_id)
+        text = self.api.last_text.get(user_id, "")
+        header = ANSWER_HEADER_RE.match(text)
+        if header:
+            text = text[header.end():]
+        if course and check_lesson_format(text, course["current_day"]) is None:
+            self.answers_as_lessons[name] = self.answers_as_lessons.get(name, 0) + 1
+
+    async def run_user(self, user_id, rng):
+        args = self.args
+        await asyncio.sleep(args.ramp_up * user_id / args.users)
+        message, callback = self.updates.message, self.updates.callback
+        await self.step("start", message(user_id, "/start"))
+        await self.step("skill", message(user_id, f"Навык {rng.randrange(args.skills)}"))
+        await self.step("goal", message(user_id, "Найти работу"))
+        await self.step("experience", message(user_id, "Новичок"))
+        if rng.random() < 0.5:
+            await self.step("preferences", message(user_id, "Больше практики"))
+        else:
+            await self.step("preferences", callback(user_id, "skip_preferences"))
+        await self.step("approve_plan", callback(user_id, "approve_plan"))
+        for day in range(7):
+            if rng.random() < args.simplify_rate:
+                await self.step("simplify", callback(user_id, "simplify_lesson"))
+                await self.check_answer("simplify", user_id)
+            if rng.random() < args.question_rate:
+                await self.step("question_button", callback(user_id, "custom_question"))
+                await self.step("question", message(user_id, rng.choice(QUESTIONS)))
+                await self.check_answer("question", user_id)
+            if day < 6:
+                await self.step("next_lesson", callback(user_id, "next_lesson"))
+        await self.step("finish_course", callback(user_id, "finish_course"))
+        course = await self.bot.users.get_course(user_id)
+        if course and course["current_day"] == 6:
+            self.completed += 1
+
+    async def report_progress(self, started):
+        while True:
+            await asyncio.sleep(10)
+            updates = sum(len(values) for values in self.latencies.values())
+            print(f"  {time.perf_counter() - started:.0f} с: апдейтов {updates}, прошли курс {self.completed}", flush=True)
+
+    async def run(self):
+        started = time.perf_counter()
+        progress = asyncio.create_task(self.report_progress(started))
+        try:
+            await asyncio.gather(*[
+                self.run_user(user_id, random.Random(self.args.seed + user_id)) for user_id in range(1, self.args.users + 1)
+            ])
+        finally:
+            progress.cancel()
+        return time.perf_counter() - started
+
+    def step_report(self):
+        steps = {}
+        for name, values in self.latencies.items():
+            values = sorted(values)
+            steps[name] = {
+                "count": len(values),
+                "errors": sum(self.errors.get(name, {}).values()),
+                "mean_ms": round(sum(values) / len(values) * 1000, 1),
+                "p50_ms": round(percentile(values, 0.5) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+            }
+        return steps
+
+def git_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def prepare_environment(args, workdir):
+    # Настройки модулей бота читаются при импорте, поэтому окружение задаётся до первого
+    # импорта модулей бота (в том числе llm_backend)
+    env = {
+        "TELEGRAM_TOKEN": f"{BOT_ID}:loadtest", "GEMINI_API_KEY": "loadtest", "LLM_BACKEND": "fake",
+        "FAKE_LLM_LATENCY": args.llm_latency, "FAKE_LLM_STRONG_LATENCY": args.lesson_latency or args.llm_latency,
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'progress.db')}",
+        "RESOURCES_DB": os.path.join(workdir, "resources.db"),
+        "CACHE_DB": os.path.join(workdir, "cache.db"),
+        "LOG_LEVEL": args.log_level,
+        # Квоты аккаунта Gemini к фейковому бэкенду не относятся; одновременность и очереди остаются как в боте
+        "GEMINI_RPM": "1000000", "GEMINI_TPM": "1000000000",
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    if os.path.exists(args.resources_db):
+        shutil.copy(args.resources_db, env["RESOURCES_DB"])
+    os.environ.update(env)
+    return {key: value for key, value in env.items() if key not in ("TELEGRAM_TOKEN", "GEMINI_API_KEY")}
+
+def compare(report, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nСравнение с {baseline_path} ({baseline.get('version')}):")
+    old, new = baseline["throughput_updates_per_s"], report["throughput_updates_per_s"]
+    change = f" ({(new - old) / old * 100:+.1f}%)" if old else ""
+    print(f"  пропускная способность: {old} -> {new} апдейтов/с{change}")
+    for name, stats in report["steps"].items():
+        before = baseline["steps"].get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            change = f" ({(stats[key] - before[key]) / before[key] * 100:+.0f}%)" if before[key] else ""
+            changes.append(f"{key[:-3]} {before[key]} -> {stats[key]}{change}")
+        print(f"  {name:16} " + ", ".join(changes))
+
+async def main(args):
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="coursecraft-loadtest-")
+    environment = prepare_environment(args, workdir)
+    from llm_backend import llm_backend, latency_sampler
+    api = FakeBotAPI(latency_sampler(args.api_latency))
+    await api.start()
+    os.environ["TELEGRAM_API_SERVER"] = environment["TELEGRAM_API_SERVER"] = api.url
+    import bot as bot_module
+    from aiogram import Bot, Dispatcher
+    from llm_scheduler import llm_scheduler
+    from outbox import outbox
+    from metrics import loop_lag
+    Bot.set_current(bot_module.bot)
+    Dispatcher.set_current(bot_module.dp)
+    await bot_module.on_startup(bot_module.dp)
+    test = LoadTest(args, bot_module, api, latency_sampler(args.think_time))
+    try:
+        print(f"Пользователей: {args.users}, навыков: {args.skills}, Bot API {api.url}", flush=True)
+        duration = await test.run()
+        updates = sum(len(values) for values in test.latencies.values())
+        report = {
+            "version": git_version(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            "environment": environment,
+            "duration_s": round(duration, 2),
+            "updates": updates,
+            "throughput_updates_per_s": round(updates / duration, 1),
+            "completed_users": test.completed,
+            "bot_error_replies": api.error_replies,
+            "answers_as_lessons": test.answers_as_lessons,
+            "steps": test.step_report(),
+            "errors": test.errors,
+            "bot_api_calls": api.calls,
+            "stats": {
+                "llm_backend": llm_backend.stats(),
+                "llm_scheduler": llm_scheduler.stats(),
+                "outbox": outbox.stats(),
+                "users": bot_module.users.stats(),
+                "prefetch": bot_module.prefetcher.stats(),
+                "course_library": bot_module.course_library.stats(),
+                "answer_cache": bot_module.answer_cache.stats(),
+                "event_loop_max_lag_ms": round(loop_lag.max_lag * 1000, 1),
+            },
+        }
+    finally:
+        await bot_module.on_shutdown(bot_module.dp)
+        await (await bot_module.bot.get_session()).close()
+        await api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"Готово за {report['duration_s']} с: {report['throughput_updates_per_s']} апдейтов/с, "
+          f"прошли курс {report['completed_users']}/{args.users}, ответов-ошибок {report['bot_error_replies']}")
+    for name, stats in report["steps"].items():
+        print(f"  {name:16} n={stats['count']:<6} p50 {stats['p50_ms']:>9} мс  p95 {stats['p95_ms']:>9} мс  "
+              f"p99 {stats['p99_ms']:>9} мс  ошибок {stats['errors']}")
+    if test.answers_as_lessons:
+        print(f"ОШИБКА: вместо ответа пришёл урок: {test.answers_as_lessons}")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота с фейковыми Bot API и Gemini")
+    parser.add_argument("--users", type=int, default=200, help="сколько пользователей проходят курс одновременно")
+    parser.add_argument("--skills", type=int, default=50, help="сколько разных навыков выбирают пользователи")
+    parser.add_argument("--ramp-up", type=float, default=10.0, help="за сколько секунд приходят все пользователи")
+    parser.add_argument("--think-time", default="uniform:0.5,2", help="пауза пользователя между шагами")
+    parser.add_argument("--llm-latency", default="lognormal:1.0,0.5", help="задержка ответа быстрой модели")
+    parser.add_argument("--lesson-latency", default="lognormal:4.0,0.4", help="задержка ответа сильной модели (уроки)")
+    parser.add_argument("--api-latency", default="uniform:0.02,0.08", help="задержка ответа Bot API")
+    parser.add_argument("--question-rate", type=float, default=0.3, help="вероятность вопроса к уроку")
+    parser.add_argument("--simplify-rate", type=float, default=0.2, help="вероятность нажатия «Ты непонятно объясняешь»")
+    parser.add_argument("--resources-db", default="course_craft.db", help="каталог материалов (копируется)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="дополнительные настройки бота, например GEMINI_RPM=100000")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="loadtest.json")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    asyncio.run(main(parser.parse_args()))
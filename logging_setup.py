@@ -0,0 +1,141 @@
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# Логи пишутся в отдельном потоке: обработчики только кладут запись в очередь, а поток
+# QueueListener пишет её в stderr и, в отладочном режиме, в файл с ротацией
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text или json (одна запись — одна строка JSON)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Сколько символов текста (урока, ответа Gemini, сообщения пользователя) попадает в обычный лог
+LOG_PAYLOAD_CHARS = int(os.getenv("LOG_PAYLOAD_CHARS", "200"))
+# Доля записей категории, попадающих в обычный лог, например "user_text=0.1,gemini=0.2";
+# записи без категории и предупреждения с ошибками не отбрасываются
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "user_text=0.1,gemini=0.2")
+# Отладочный режим: все записи, включая отброшенные выборкой, пишутся в файл с ротацией
+# вместе с полными текстами
+LOG_DEBUG_FILE = os.getenv("LOG_DEBUG_FILE")
+LOG_DEBUG_FILE_BYTES = int(os.getenv("LOG_DEBUG_FILE_BYTES", str(20 * 1024 * 1024)))
+LOG_DEBUG_FILE_COUNT = int(os.getenv("LOG_DEBUG_FILE_COUNT", "5"))
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+def summarize(text, limit=LOG_PAYLOAD_CHARS):
+    """Короткое представление длинного текста для лога: длина, хэш и начало."""
+    text = str(text)
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+    head = text[:limit].replace("\n", " ")
+    return f"[{len(text)} симв., {digest}] {head}{'…' if len(text) > limit else ''}"
+
+def log_text(logger, category, message, text, level=logging.INFO):
+    """Пишет message с укороченным text; полный текст уходит только в отладочный файл."""
+    if logger.isEnabledFor(level):
+        logger.log(level, f"{message}: {summarize(text)}", extra={"category": category, "payload": text})
+
+def parse_sampling(value):
+    rates = {}
+    for item in value.split(","):
+        if "=" in item:
+            category, rate = item.split("=", 1)
+            rates[category.strip()] = float(rate)
+    return rates
+
+# Счётчики потерянных записей для /metrics
+_dropped = {"queue_full": 0, "sampled_out": {}}
+
+class SamplingFilter(logging.Filter):
+    """Пропускает в обычный лог только долю записей каждой категории."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "category", None))
+        if rate is None or record.levelno >= logging.WARNING or random.random() < rate:
+            return True
+        sampled_out = _dropped["sampled_out"]
+        sampled_out[record.category] = sampled_out.get(record.category, 0) + 1
+        return False
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if hasattr(record, "category"):
+            entry["category"] = record.category
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class PayloadFormatter(logging.Formatter):
+    """Формат отладочного файла: запись и следом полный текст, если он есть."""
+
+    def format(self, record):
+        text = super().format(record)
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            text = f"{text}\n{payload}"
+        return text
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Стандартный prepare склеивает сообщение и теряет exc_info; здесь сообщение только
+        # вычисляется, а форматирование (и трассировка исключения) выполняется в потоке записи
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Поток записи не успевает: теряем запись, а не блокируем цикл событий
+            _dropped["queue_full"] += 1
+
+_listener = None
+
+def setup_logging():
+    """Настраивает корневой логгер: очередь и поток записи. Повторный вызов ничего не делает."""
+    global _listener
+    if _listener is not None:
+        return
+    console = logging.StreamHandler(sys.stderr)
+    console.setLevel(LOG_LEVEL)
+    console.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    console.addFilter(SamplingFilter(parse_sampling(LOG_SAMPLING)))
+    handlers = [console]
+    if LOG_DEBUG_FILE:
+        debug_file = logging.handlers.RotatingFileHandler(
+            LOG_DEBUG_FILE, maxBytes=LOG_DEBUG_FILE_BYTES, backupCount=LOG_DEBUG_FILE_COUNT, encoding="utf-8"
+        )
+        debug_file.setFormatter(PayloadFormatter(TEXT_FORMAT))
+        handlers.append(debug_file)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(queue.Queue(LOG_QUEUE_SIZE)))
+    root.setLevel(LOG_LEVEL)
+    _listener = logging.handlers.QueueListener(root.handlers[0].queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток записи."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def logging_stats():
+    return {"queue_size": _listener.queue.qsize() if _listener else 0, **_dropped}
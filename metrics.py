@@ -0,0 +1,244 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import re
+import resource
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Метрики в текстовом формате Prometheus для /metrics. Запись метрики на горячем пути —
+# несколько обращений к словарю и bisect по границам корзин, без блокировок и фоновых задач
+METRICS_PREFIX = "coursecraft"
+# Границы корзин гистограмм в секундах: от запросов к SQLite до генерации урока
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Как часто проверять задержку цикла событий
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {_number(value)}")
+        return lines
+
+class Histogram:
+    """Гистограмма со счётчиками по корзинам; накопительные суммы считаются только при выводе."""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # метки -> [счётчики корзин (последняя — +Inf), сумма, количество]
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(round(total, 6))}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+        return lines
+
+class StatsGauges:
+    """Числа из существующего метода stats() в виде gauge-метрик.
+
+    Вложенные словари разворачиваются в имена через «_»; если задан label, ключи первого
+    уровня (шарды, пространства кэша) становятся значениями этой метки. Нечисловые поля пропускаются.
+    """
+
+    def __init__(self, name, stats, label=None):
+        self.name = name
+        self.stats = stats
+        self.label = label
+
+    def _flatten(self, prefix, value, labels, series):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                self._flatten(f"{prefix}_{_NAME_RE.sub('_', str(key))}", item, labels, series)
+        elif isinstance(value, (int, float)):
+            series.setdefault(prefix, []).append((labels, float(value)))
+
+    def render(self):
+        try:
+            stats = self.stats()
+        except Exception as e:
+            logger.warning(f"Не удалось собрать метрики {self.name}: {e}")
+            return []
+        series = {}
+        if self.label is None:
+            self._flatten(self.name, stats, (), series)
+        else:
+            for key, value in stats.items():
+                self._flatten(self.name, value, (key,), series)
+        lines = []
+        names = (self.label,) if self.label else ()
+        for name, values in series.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{_labels(names, labels)} {_number(value)}" for labels, value in values)
+        return lines
+
+class Registry:
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(f"{self.prefix}_{name}", help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(f"{self.prefix}_{name}", help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, value, label=None):
+        """value() возвращает число или словарь (как stats()); вызывается при каждом выводе."""
+        self._metrics.append(StatsGauges(f"{self.prefix}_{name}", value, label))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# Обработчики апдейтов (заполняются HandlerMetricsMiddleware)
+handler_seconds = registry.histogram("handler_seconds", "Handler latency", ("handler", "event"))
+handler_errors = registry.counter("handler_errors_total", "Handler exceptions", ("handler", "event"))
+
+# Функции gemini_service (см. llm_metrics)
+llm_seconds = registry.histogram("gemini_seconds", "gemini_service call latency", ("function",))
+llm_calls = registry.counter("gemini_calls_total", "gemini_service calls by outcome", ("function", "status"))
+llm_tokens = registry.counter("gemini_tokens_total", "Estimated LLM tokens", ("function", "kind"))
+_llm_in_flight = {}
+registry.gauge("gemini_in_flight", lambda: _llm_in_flight, label="function")
+
+# SQLite (заполняются в database.Database)
+db_seconds = registry.histogram("db_seconds", "SQLite time: write and read hold the connection, write_wait waits for the writer", ("db", "op"))
+db_errors = registry.counter("db_errors_total", "SQLite operations that raised", ("db", "op"))
+
+# Функция gemini_service, внутри которой идёт запрос к LLM: к ней относятся токены из _generate_text
+current_llm_function = contextvars.ContextVar("current_llm_function", default="other")
+
+def llm_metrics(*failures):
+    """Декоратор функции gemini_service: задержка, исход и запросы в работе.
+
+    Ошибкой считается исключение, None или одно из значений failures
+    (функции сервиса обычно перехватывают ошибки и возвращают заглушку).
+    """
+    def decorator(function):
+        name = function.__name__
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            token = current_llm_function.set(name)
+            _llm_in_flight[name] = _llm_in_flight.get(name, 0) + 1
+            started = time.perf_counter()
+            status = "error"
+            try:
+                result = await function(*args, **kwargs)
+                if result is not None and not any(result is failure for failure in failures):
+                    status = "ok"
+                return result
+            except asyncio.CancelledError:
+                status = "cancelled"
+                raise
+            finally:
+                llm_seconds.observe(time.perf_counter() - started, name)
+                llm_calls.inc(name, status)
+                _llm_in_flight[name] -= 1
+                current_llm_function.reset(token)
+
+        return wrapper
+    return decorator
+
+def record_llm_tokens(prompt_tokens, output_tokens):
+    name = current_llm_function.get()
+    llm_tokens.inc(name, "prompt", value=prompt_tokens)
+    llm_tokens.inc(name, "output", value=output_tokens)
+
+def memory_stats():
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * page_size
+    except OSError:
+        rss = 0
+    # ru_maxrss в Linux — в килобайтах
+    return {"rss_bytes": rss, "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+registry.gauge("memory", memory_stats)
+registry.gauge("asyncio_tasks", lambda: len(asyncio.all_tasks()))
+
+class LoopLagMonitor:
+    """Задержка цикла событий: насколько позже заказанного просыпается asyncio.sleep."""
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._task = None
+        self._histogram = registry.histogram("event_loop_lag_seconds", "Event loop lag")
+        registry.gauge("event_loop_lag", lambda: {"seconds": self.lag, "max_seconds": self.max_lag})
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - started - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+            self._histogram.observe(self.lag)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+loop_lag = LoopLagMonitor()
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from metrics import handler_errors, handler_seconds
+from update_queue import update_user_id
+
+logger = logging.getLogger(__name__)
+
+# Метрики блокировок собираются по шардам (user_id % USER_LOCK_SHARDS), а не по каждому пользователю
+USER_LOCK_SHARDS = int(os.getenv("USER_LOCK_SHARDS", "16"))
+# Повторное нажатие той же кнопки в течение окна после обработки тоже считается дублем
+DUPLICATE_CALLBACK_WINDOW = float(os.getenv("DUPLICATE_CALLBACK_WINDOW", "1.0"))
+
+class ShardStats:
+    def __init__(self):
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self.duplicates = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self):
+        return {
+            "waiting": self.waiting,
+            "active": self.active,
+            "processed": self.processed,
+            "duplicates": self.duplicates,
+            "wait_avg_ms": round(self.wait_total / self.processed * 1000, 2) if self.processed else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+        }
+
+class UserLockMiddleware(BaseMiddleware):
+    """Обрабатывает апдейты одного пользователя по очереди, разных пользователей — параллельно.
+
+    Обработчики course.py меняют состояние курса между await'ами (next_lesson увеличивает
+    current_day, сохраняет и отправляет урок), поэтому параллельные апдейты одного пользователя
+    могли пропустить день. Повторные нажатия той же inline-кнопки, пока первое ещё
+    обрабатывается или только что обработано, отбрасываются.
+
+    Регистрируется последним: если более поздний middleware отменит апдейт в pre_process,
+    post_process не вызовется и блокировка пользователя не освободится.
+    """
+
+    def __init__(self, shards=USER_LOCK_SHARDS, duplicate_window=DUPLICATE_CALLBACK_WINDOW):
+        super().__init__()
+        self.shards = shards
+        self.duplicate_window = duplicate_window
+        self._locks = {}
+        self._callbacks = {}
+        self._stats = [ShardStats() for _ in range(shards)]
+
+    def _callback_key(self, callback_query):
+        message_id = callback_query.message.message_id if callback_query.message else callback_query.inline_message_id
+        return callback_query.from_user.id, message_id, callback_query.data
+
+    def _is_duplicate(self, key):
+        finished = self._callbacks.get(key)
+        if finished is None:
+            return False
+        # 0 — нажатие ещё обрабатывается
+        return finished == 0 or time.monotonic() - finished < self.duplicate_window
+
+    async def on_pre_process_update(self, update, data):
+        user_id = update_user_id(update)
+        if user_id is None:
+            return
+        stats = self._stats[user_id % self.shards]
+        if update.callback_query:
+            key = self._callback_key(update.callback_query)
+            if self._is_duplicate(key):
+                stats.duplicates += 1
+                try:
+                    await update.callback_query.answer()
+                except Exception as e:
+                    logger.warning(f"Не удалось ответить на повторное нажатие: {e}")
+                raise CancelHandler()
+            self._callbacks[key] = 0
+            data["callback_key"] = key
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        stats.waiting += 1
+        started = time.monotonic()
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            # Апдейт отменён, не дождавшись очереди: post_process для него не вызовется
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+            if "callback_key" in data:
+                self._callbacks[data["callback_key"]] = time.monotonic()
+            raise
+        finally:
+            stats.waiting -= 1
+        waited = time.monotonic() - started
+        stats.active += 1
+        stats.wait_total += waited
+        stats.wait_max = max(stats.wait_max, waited)
+        data["locked_user_id"] = user_id
+
+    async def on_post_process_update(self, update, results, data):
+        key = data.get("callback_key")
+        if key is not None:
+            self._callbacks[key] = time.monotonic()
+            self._forget_old_callbacks()
+        user_id = data.get("locked_user_id")
+        if user_id is None:
+            return
+        stats = self._stats[user_id % self.shards]
+        stats.active -= 1
+        stats.processed += 1
+        entry = self._locks[user_id]
+        entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[user_id]
+
+    def _forget_old_callbacks(self):
+        # Словарь нажатий не должен расти бесконечно: чистим устаревшие, когда он разрастается
+        if len(self._callbacks) < 10000:
+            return
+        deadline = time.monotonic() - self.duplicate_window
+        for key in [key for key, finished in self._callbacks.items() if finished and finished < deadline]:
+            del self._callbacks[key]
+
+    def stats(self):
+        return {shard: stats.as_dict() for shard, stats in enumerate(self._stats)}
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время выполнения каждого обработчика сообщений и нажатий (метрики handler_* в /metrics).
+
+    process_* вызывается, когда фильтры обработчика прошли, post_process_* — после него,
+    в том числе при исключении: тогда sys.exc_info() содержит ошибку обработчика.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._names = {}
+
+    def _handler_name(self, handler):
+        name = self._names.get(handler)
+        if name is None:
+            name = handler.__name__
+            if name == "<lambda>" and handler.__code__.co_names:
+                # course.py регистрирует обёртки вида lambda cq: next_lesson(cq, dp.bot) —
+                # первое глобальное имя в лямбде и есть вызываемый обработчик
+                name = handler.__code__.co_names[0]
+            self._names[handler] = name
+        return name
+
+    def _started(self, data):
+        data["handler_started"] = time.perf_counter()
+        data["handler_name"] = self._handler_name(current_handler.get())
+
+    def _finished(self, event, data):
+        started = data.get("handler_started")
+        if started is None:
+            return  # Ни один обработчик не подошёл
+        handler_seconds.observe(time.perf_counter() - started, data["handler_name"], event)
+        if sys.exc_info()[1] is not None:
+            handler_errors.inc(data["handler_name"], event)
+
+    async def on_process_message(self, message, data):
+        self._started(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self._finished("message", data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        self._started(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self._finished("callback_query", data)
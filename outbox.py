@@ -0,0 +1,210 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from aiogram import Bot
+from aiogram.bot import api
+from aiogram.utils.exceptions import RetryAfter
+from llm_scheduler import TokenBucket, PRIORITY_INTERACTIVE, PRIORITY_NAMES
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около одного в секунду в один чат.
+# За любую секунду ведро пропускает до rate + burst сообщений, поэтому сумма держится в пределах лимита
+TELEGRAM_GLOBAL_RATE = int(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_GLOBAL_BURST = int(os.getenv("TELEGRAM_GLOBAL_BURST", "5"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "2"))
+# Сколько раз повторять отправку после RetryAfter; слишком долгий RetryAfter отдаётся вызывающему
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))
+OUTBOX_MAX_RETRY_AFTER = 60
+OUTBOX_MAX_CHATS = 10000
+OUTBOX_LATENCY_WINDOW = 1000
+
+# Методы, которые отправляют или меняют сообщения и попадают под лимиты
+THROTTLED_METHODS = {
+    api.Methods.SEND_MESSAGE, api.Methods.EDIT_MESSAGE_TEXT, api.Methods.EDIT_MESSAGE_REPLY_MARKUP,
+    api.Methods.SEND_PHOTO, api.Methods.SEND_DOCUMENT, api.Methods.FORWARD_MESSAGE, api.Methods.COPY_MESSAGE,
+}
+
+# Приоритет отправок текущей задачи: ответы обработчиков идут раньше фоновых рассылок.
+# Рассылки (напоминания) выставляют PRIORITY_BULK на время отправки
+send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+class Outbox:
+    """Очередь исходящих запросов к Bot API с общим и початовыми лимитами.
+
+    Запрос получает разрешение, когда есть квота в общем ведре и в ведре его чата;
+    среди ожидающих первым идёт запрос с меньшим приоритетом, при равенстве — более ранний.
+    Запрос в чат, исчерпавший лимит, не задерживает запросы в другие чаты.
+    RetryAfter приостанавливает отправку в этот чат (или все отправки, если чат неизвестен)
+    и повторяет запрос.
+    """
+
+    def __init__(self, rate=TELEGRAM_GLOBAL_RATE, burst=TELEGRAM_GLOBAL_BURST, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, max_retries=OUTBOX_MAX_RETRIES):
+        self.bucket = TokenBucket(rate * 60, capacity=burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = {}
+        self._paused = {}
+        self._paused_until = 0.0
+        self._heap = []
+        self._seq = itertools.count()
+        self._queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self._timer = None
+        self._latencies = deque(maxlen=OUTBOX_LATENCY_WINDOW)
+        self._stats = {
+            priority: {"granted": 0, "sent": 0, "retries": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for priority in PRIORITY_NAMES
+        }
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= OUTBOX_MAX_CHATS:
+                self._forget_idle_chats()
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate * 60, capacity=self.chat_burst)
+        return bucket
+
+    def _forget_idle_chats(self):
+        # Полное ведро ничем не отличается от нового, поэтому такие чаты можно забыть
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.wait_time(bucket.capacity) == 0]:
+            del self._chats[chat_id]
+        for chat_id in [chat_id for chat_id, until in self._paused.items() if until <= now]:
+            del self._paused[chat_id]
+
+    def _chat_wait(self, chat_id, now):
+        if chat_id is None:
+            return 0.0
+        return max(self._paused.get(chat_id, 0.0) - now, self._chat_bucket(chat_id).wait_time(1))
+
+    def _dispatch(self):
+        now = time.monotonic()
+        blocked = []
+        wait = None
+        while self._heap:
+            priority, _, chat_id, future = self._heap[0]
+            if future.cancelled():
+                heapq.heappop(self._heap)
+                self._queued[priority] -= 1
+                continue
+            global_wait = max(self._paused_until - now, self.bucket.wait_time(1))
+            if global_wait > 0:
+                wait = global_wait
+                break
+            item = heapq.heappop(self._heap)
+            chat_wait = self._chat_wait(chat_id, now)
+            if chat_wait > 0:
+                # Чат исчерпал лимит — пропускаем его запросы и обслуживаем другие чаты
+                blocked.append(item)
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            self._queued[priority] -= 1
+            self.bucket.take(1)
+            if chat_id is not None:
+                self._chat_bucket(chat_id).take(1)
+            future.set_result(None)
+        for item in blocked:
+            heapq.heappush(self._heap, item)
+        if wait is not None:
+            self._schedule(wait)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    async def _acquire(self, chat_id, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), chat_id, future))
+        self._queued[priority] += 1
+        started = time.monotonic()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.done():
+                future.cancel()
+            raise
+        waited = time.monotonic() - started
+        stats = self._stats[priority]
+        stats["granted"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def pause(self, chat_id, seconds):
+        until = time.monotonic() + seconds
+        if chat_id is None:
+            self._paused_until = max(self._paused_until, until)
+        else:
+            self._paused[chat_id] = max(self._paused.get(chat_id, 0.0), until)
+
+    async def send(self, call, chat_id=None, priority=None):
+        """Выполняет call() в пределах лимитов; priority по умолчанию берётся из send_priority."""
+        if priority is None:
+            priority = send_priority.get()
+        stats = self._stats[priority]
+        started = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                result = await call()
+            except RetryAfter as e:
+                if attempt == self.max_retries or e.timeout > OUTBOX_MAX_RETRY_AFTER:
+                    raise
+                stats["retries"] += 1
+                logger.warning(f"Telegram ограничил отправку в чат {chat_id} на {e.timeout} с, повтор {attempt + 1}/{self.max_retries}")
+                self.pause(chat_id, e.timeout)
+                continue
+            stats["sent"] += 1
+            self._latencies.append(time.monotonic() - started)
+            return result
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        result = {
+            "chats": len(self._chats),
+            "latency_p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else 0.0,
+            "latency_p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else 0.0,
+        }
+        for priority, name in PRIORITY_NAMES.items():
+            stats = self._stats[priority]
+            result[name] = {
+                "queued": self._queued[priority],
+                "sent": stats["sent"],
+                "retries": stats["retries"],
+                "wait_avg_ms": round(stats["wait_total"] / stats["granted"] * 1000, 1) if stats["granted"] else 0.0,
+                "wait_max_ms": round(stats["wait_max"] * 1000, 1),
+            }
+        return result
+
+outbox = Outbox()
+
+class ThrottledBot(Bot):
+    """Bot, у которого отправка и правка сообщений идут через Outbox.
+
+    Обработчики, стриминг и напоминания продолжают вызывать bot.send_message и
+    message.reply как обычно: лимиты применяются на уровне Bot.request.
+    """
+
+    def __init__(self, *args, outbox=outbox, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = outbox
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        request = super().request
+        if method not in THROTTLED_METHODS:
+            return await request(method, data, files, **kwargs)
+        chat_id = data.get("chat_id") if data else None
+        return await self.outbox.send(lambda: request(method, data, files, **kwargs), chat_id)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+from llm_scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Фоновая подготовка ответов, которые пользователь скорее всего запросит: упрощённое объяснение
+# текущего урока и предложения курсов на последнем дне. Бюджет — запросов к LLM в минуту
+# и одновременно выполняемых задач; сверх бюджета предзагрузка просто пропускается
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_PER_MINUTE = int(os.getenv("PREFETCH_PER_MINUTE", "10"))
+PREFETCH_MAX_TASKS = int(os.getenv("PREFETCH_MAX_TASKS", "20"))
+# Сколько пользователей с неиспользованной предзагрузкой помним; самые старые забываются
+PREFETCH_MAX_ENTRIES = int(os.getenv("PREFETCH_MAX_ENTRIES", "10000"))
+
+class Prefetch:
+    def __init__(self, key, task):
+        self.key = key
+        self.task = task
+
+    def succeeded(self):
+        return self.task.done() and not self.task.cancelled() and self.task.result() is not None
+
+class Prefetcher:
+    """Фоновые задачи предзагрузки, по одной на пользователя и вид ответа.
+
+    schedule() запускает задачу, если её ещё нет для того же ключа и позволяет бюджет;
+    сама задача кладёт результат в response_cache, и обработчик кнопки берёт его оттуда.
+    wait() вызывается обработчиком перед запросом: дожидается незавершённой задачи
+    и учитывает, пригодилась ли предзагрузка.
+    """
+
+    def __init__(self, enabled=PREFETCH_ENABLED, per_minute=PREFETCH_PER_MINUTE, max_tasks=PREFETCH_MAX_TASKS,
+                 max_entries=PREFETCH_MAX_ENTRIES):
+        self.enabled = enabled
+        self.budget = TokenBucket(per_minute)
+        self.max_tasks = max_tasks
+        self.max_entries = max_entries
+        self.running = 0
+        self._entries = {}
+        self._stats = {}
+
+    def _count(self, kind, name):
+        stats = self._stats.setdefault(kind, {
+            "scheduled": 0, "over_budget": 0, "failed": 0, "cancelled": 0,
+            "hits": 0, "in_flight_hits": 0, "misses": 0, "wasted": 0,
+        })
+        stats[name] += 1
+
+    def schedule(self, user_id, kind, key, factory):
+        """Запускает factory() в фоне; key описывает входные данные (например, текст урока)."""
+        if not self.enabled:
+            return
+        entry = self._entries.get((user_id, kind))
+        if entry is not None:
+            if entry.key == key:
+                return  # Уже готовится или готово для тех же данных
+            self._discard(user_id, kind)
+        if self.running >= self.max_tasks or self.budget.wait_time(1) > 0:
+            self._count(kind, "over_budget")
+            return
+        self.budget.take(1)
+        self.running += 1
+        self._count(kind, "scheduled")
+        task = asyncio.create_task(self._run(kind, factory))
+        # Задача, отменённая до старта, не выполнит ни строчки, поэтому счётчик уменьшаем здесь
+        task.add_done_callback(self._finished)
+        self._entries[(user_id, kind)] = Prefetch(key, task)
+        while len(self._entries) > self.max_entries:
+            self._discard(*next(iter(self._entries)))
+
+    async def _run(self, kind, factory):
+        try:
+            result = await factory()
+        except Exception as e:
+            logger.warning(f"Ошибка предзагрузки '{kind}': {e}")
+            result = None
+        if result is None:
+            self._count(kind, "failed")
+        return result
+
+    def _finished(self, task):
+        self.running -= 1
+
+    def _discard(self, user_id, kind):
+        entry = self._entries.pop((user_id, kind), None)
+        if entry is None:
+            return
+        if entry.succeeded():
+            self._count(kind, "wasted")
+        elif not entry.task.done():
+            entry.task.cancel()
+            self._count(kind, "cancelled")
+
+    async def wait(self, user_id, kind, key):
+        """Дожидается предзагрузки для нажатия пользователя; True, если она пригодилась."""
+        entry = self._entries.get((user_id, kind))
+        if entry is None or entry.key != key:
+            self._discard(user_id, kind)
+            self._count(kind, "misses")
+            return False
+        del self._entries[(user_id, kind)]
+        in_flight = not entry.task.done()
+        try:
+            result = await asyncio.shield(entry.task)
+        except asyncio.CancelledError:
+            if not entry.task.cancelled():
+                raise  # Отменили сам обработчик
+            result = None
+        if result is None:
+            self._count(kind, "misses")
+            return False
+        self._count(kind, "in_flight_hits" if in_flight else "hits")
+        return True
+
+    def cancel(self, user_id):
+        """Отменяет предзагрузку пользователя, например, когда он отказался от курса."""
+        for kind in list(self._stats):
+            self._discard(user_id, kind)
+
+    def stop(self):
+        for user_id, kind in list(self._entries):
+            self._discard(user_id, kind)
+
+    def stats(self):
+        result = {"running": self.running, "entries": len(self._entries)}
+        for kind, stats in self._stats.items():
+            claimed = stats["hits"] + stats["in_flight_hits"] + stats["misses"]
+            result[kind] = dict(stats, hit_rate=round((stats["hits"] + stats["in_flight_hits"]) / claimed, 3) if claimed else 0.0)
+        return result
+
+prefetcher = Prefetcher()
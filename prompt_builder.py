@@ -0,0 +1,74 @@
+import logging
+import math
+import os
+import re
+from search import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Бюджет токенов на материалы из базы в одном промпте и параметры подбора фрагментов
+PROMPT_RESOURCE_TOKEN_BUDGET = int(os.getenv("PROMPT_RESOURCE_TOKEN_BUDGET", "600"))
+RESOURCE_CANDIDATES = int(os.getenv("RESOURCE_CANDIDATES", "20"))
+RESOURCE_SNIPPET_CHARS = 200
+SNIPPET_SIMILARITY_THRESHOLD = 0.8
+
+_CYRILLIC_RE = re.compile(r"[а-яёА-ЯЁ]")
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов: кириллица в токенизаторе Gemini «дороже» латиницы."""
+    cyrillic = len(_CYRILLIC_RE.findall(text))
+    return math.ceil(cyrillic / 2.5 + (len(text) - cyrillic) / 4)
+
+def _shingles(text, size=3):
+    words = tokenize(text)
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def select_resources(resources, budget=PROMPT_RESOURCE_TOKEN_BUDGET):
+    """Строки о материалах для промпта в порядке релевантности.
+
+    resources — строки (title, author, type, content), уже отсортированные поиском.
+    Почти одинаковые фрагменты отбрасываются, строки добавляются, пока укладываются в budget.
+    """
+    lines = []
+    seen = []
+    used = 0
+    for title, author, res_type, content in resources:
+        snippet = (content or "")[:RESOURCE_SNIPPET_CHARS]
+        shingles = _shingles(f"{title} {snippet}")
+        if any(_similarity(shingles, other) >= SNIPPET_SIMILARITY_THRESHOLD for other in seen):
+            continue
+        line = f"- {res_type.capitalize()} '{title}' от {author}: {snippet}...\n"
+        tokens = estimate_tokens(line)
+        if used + tokens > budget:
+            continue
+        seen.append(shingles)
+        lines.append(line)
+        used += tokens
+    return lines
+
+class PromptBuilder:
+    """Собирает промпт из именованных разделов и сообщает размер каждого из них."""
+
+    def __init__(self, name):
+        self.name = name
+        self.sections = []
+
+    def add(self, section, text):
+        if text:
+            self.sections.append((section, text))
+        return self
+
+    def report(self):
+        return {section: estimate_tokens(text) for section, text in self.sections}
+
+    def build(self):
+        report = self.report()
+        logger.info(f"Промпт '{self.name}': ~{sum(report.values())} токенов, по разделам {report}")
+        return "\n".join(text for _, text in self.sections)
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import time
+from aiogram import types
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, RetryAfter, TelegramAPIError, UserDeactivated
+from llm_scheduler import PRIORITY_BULK
+from outbox import send_priority
+from database import save_reminder, delete_reminder, next_reminder_at, get_due_reminders, finish_reminders
+
+logger = logging.getLogger(__name__)
+
+# Напоминания о следующем уроке хранятся в таблице reminders (по одному на пользователя)
+# и рассылаются одним фоновым циклом, поэтому переживают перезапуск бота
+REMINDER_INTERVAL = int(os.getenv("REMINDER_INTERVAL", str(24 * 60 * 60)))
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "100"))
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", "20"))  # сообщений в секунду
+REMINDER_IDLE_WAIT = 60 * 60  # перепроверка таблицы, даже если ближайших напоминаний нет
+LAST_DAY = 6
+
+class ReminderScheduler:
+    """Единый планировщик напоминаний: спит до ближайшего due_at и рассылает наступившие пачками."""
+
+    def __init__(self):
+        self.bot = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self.sent = 0
+        self.failed = 0
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def schedule(self, user_id, chat_id, delay=REMINDER_INTERVAL):
+        # Повторное утверждение плана заменяет напоминание, а не добавляет второе
+        await save_reminder(user_id, chat_id, time.time() + delay)
+        self._wakeup.set()
+
+    async def cancel(self, user_id):
+        await delete_reminder(user_id)
+
+    async def _run(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                next_due = await next_reminder_at()
+                now = time.time()
+                if next_due is None or next_due > now:
+                    timeout = REMINDER_IDLE_WAIT if next_due is None else min(next_due - now, REMINDER_IDLE_WAIT)
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._send_due(now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике напоминаний: {e}")
+                await asyncio.sleep(5)
+
+    async def _send_due(self, now):
+        rescheduled = []
+        removed = []
+        for user_id, chat_id, due_at, current_day in await get_due_reminders(now, REMINDER_BATCH_SIZE):
+            if current_day is None or current_day >= LAST_DAY:
+                removed.append((user_id, due_at))
+                continue
+            delay = await self._send(user_id, chat_id)
+            if delay is None:
+                removed.append((user_id, due_at))
+            else:
+                rescheduled.append((time.time() + delay, user_id, due_at))
+            await asyncio.sleep(1 / REMINDER_RATE)
+        await finish_reminders(rescheduled, removed)
+
+    async def _send(self, user_id, chat_id):
+        """Отправляет напоминание; возвращает задержку до следующего или None, если напоминать больше не нужно."""
+        keyboard = types.InlineKeyboardMarkup()
+        keyboard.add(types.InlineKeyboardButton("Следующий урок", callback_data="next_lesson"))
+        # Напоминания уступают очередь ответам на действия пользователей
+        token = send_priority.set(PRIORITY_BULK)
+        try:
+            await self.bot.send_message(chat_id, "Готов к новому уроку?", reply_markup=keyboard)
+            self.sent += 1
+            return REMINDER_INTERVAL
+        except RetryAfter as e:
+            logger.warning(f"Лимит Telegram при отправке напоминаний, пауза {e.timeout} с")
+            await asyncio.sleep(e.timeout)
+            return e.timeout
+        except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+            logger.info(f"Напоминания для пользователя {user_id} отключены: {e}")
+            return None
+        except TelegramAPIError as e:
+            logger.error(f"Ошибка отправки напоминания пользователю {user_id}: {e}")
+            self.failed += 1
+            return REMINDER_INTERVAL
+        finally:
+            send_priority.reset(token)
+
+    def stats(self):
+        return {"sent": self.sent, "failed": self.failed}
+
+reminders = ReminderScheduler()
@@ -0,0 +1,180 @@
+import re
+from functools import lru_cache
+
+# Нормализация текста для полнотекстового поиска по каталогу материалов:
+# нижний регистр, разбиение на слова и стемминг (Snowball для русского, облегчённый Porter для английского)
+
+_WORD_RE = re.compile(r"[a-zа-яё0-9][a-zа-яё0-9+#]*")
+_CYRILLIC_RE = re.compile(r"[а-я]")
+
+# Служебные слова не участвуют в запросе, иначе совпадает почти любой материал
+STOP_WORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "для", "к", "о", "об", "от", "из", "за", "или", "а", "не",
+    "the", "a", "an", "and", "or", "of", "to", "in", "on", "for", "with",
+}
+
+_RU_VOWELS = "аеиоуыэюя"
+_RU_PERFECTIVE_GERUND_1 = ("вшись", "вши", "в")
+_RU_PERFECTIVE_GERUND_2 = ("ившись", "ывшись", "ивши", "ывши", "ив", "ыв")
+_RU_REFLEXIVE = ("ся", "сь")
+_RU_ADJECTIVE = (
+    "ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой",
+    "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+)
+_RU_PARTICIPLE_1 = ("ем", "нн", "вш", "ющ", "щ")
+_RU_PARTICIPLE_2 = ("ивш", "ывш", "ующ")
+_RU_VERB_1 = ("ете", "йте", "ешь", "нно", "ла", "на", "ли", "ем", "ло", "но", "ет", "ют", "ны", "ть", "й", "л", "н")
+_RU_VERB_2 = (
+    "ейте", "уйте", "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено", "ует", "уют", "ены",
+    "ить", "ыть", "ишь", "ей", "уй", "ил", "ыл", "им", "ым", "ен", "ят", "ит", "ыт", "ую", "ю",
+)
+_RU_NOUN = (
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях", "ев", "ов", "ие", "ье", "еи", "ии", "ей", "ой",
+    "ий", "ям", "ем", "ам", "ом", "ах", "ях", "ию", "ью", "ия", "ья", "а", "е", "и", "й", "о", "у",
+    "ы", "ь", "ю", "я",
+)
+_RU_SUPERLATIVE = ("ейше", "ейш")
+_RU_DERIVATIONAL = ("ость", "ост")
+
+def _longest_suffix(word, suffixes):
+    best = ""
+    for suffix in suffixes:
+        if word.endswith(suffix) and len(suffix) > len(best):
+            best = suffix
+    return best
+
+def _remove_suffix(word, start, suffixes, preceded_by=None):
+    # Удаляет самое длинное окончание из suffixes, если оно целиком лежит в области word[start:]
+    suffix = _longest_suffix(word[start:], suffixes)
+    if not suffix:
+        return word, False
+    stem = word[:-len(suffix)]
+    if preceded_by is not None and not (len(stem) > start and stem[-1] in preceded_by):
+        return word, False
+    return stem, True
+
+def _remove_grouped(word, start, group_1, group_2):
+    # Окончания первой группы должны идти после «а» или «я», второй — после чего угодно
+    candidates = []
+    stem, found = _remove_suffix(word, start, group_1, preceded_by="ая")
+    if found:
+        candidates.append(stem)
+    stem, found = _remove_suffix(word, start, group_2)
+    if found:
+        candidates.append(stem)
+    if not candidates:
+        return word, False
+    return min(candidates, key=len), True
+
+def _ru_regions(word):
+    rv = len(word)
+    for i, char in enumerate(word):
+        if char in _RU_VOWELS:
+            rv = i + 1
+            break
+    r1 = len(word)
+    for i in range(1, len(word)):
+        if word[i] not in _RU_VOWELS and word[i - 1] in _RU_VOWELS:
+            r1 = i + 1
+            break
+    r2 = len(word)
+    for i in range(r1 + 1, len(word)):
+        if word[i] not in _RU_VOWELS and word[i - 1] in _RU_VOWELS:
+            r2 = i + 1
+            break
+    return rv, r2
+
+def stem_russian(word):
+    word = word.replace("ё", "е")
+    rv, r2 = _ru_regions(word)
+    if rv >= len(word):
+        return word
+    # Шаг 1
+    word, found = _remove_grouped(word, rv, _RU_PERFECTIVE_GERUND_1, _RU_PERFECTIVE_GERUND_2)
+    if not found:
+        word, _ = _remove_suffix(word, rv, _RU_REFLEXIVE)
+        word, found = _remove_suffix(word, rv, _RU_ADJECTIVE)
+        if found:
+            word, _ = _remove_grouped(word, rv, _RU_PARTICIPLE_1, _RU_PARTICIPLE_2)
+        else:
+            word, found = _remove_grouped(word, rv, _RU_VERB_1, _RU_VERB_2)
+            if not found:
+                word, _ = _remove_suffix(word, rv, _RU_NOUN)
+    # Шаг 2
+    if word.endswith("и") and len(word) - 1 >= rv:
+        word = word[:-1]
+    # Шаг 3
+    word, _ = _remove_suffix(word, r2, _RU_DERIVATIONAL)
+    # Шаг 4
+    if word.endswith("нн") and len(word) - 2 >= rv:
+        return word[:-1]
+    word, found = _remove_suffix(word, rv, _RU_SUPERLATIVE)
+    if found and word.endswith("нн"):
+        return word[:-1]
+    if word.endswith("ь") and len(word) - 1 >= rv:
+        return word[:-1]
+    return word
+
+def _has_vowel(stem):
+    return any(char in "aeiouy" for char in stem)
+
+def stem_english(word):
+    if len(word) <= 3:
+        return word
+    if word.endswith("sses"):
+        word = word[:-2]
+    elif word.endswith("ies"):
+        word = word[:-2]
+    elif word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        word = word[:-1]
+    for suffix in ("ingly", "edly", "ing", "ed"):
+        if word.endswith(suffix) and _has_vowel(word[:-len(suffix)]) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            if word.endswith(("at", "bl", "iz")):
+                word += "e"
+            elif len(word) > 2 and word[-1] == word[-2] and word[-1] not in "lsz":
+                word = word[:-1]
+            break
+    for suffix in ("ational", "ization", "fulness", "ousness", "iveness", "ation", "ness", "ment", "ful", "ly"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            word = word[:-len(suffix)]
+            break
+    if word.endswith("y") and len(word) > 3 and _has_vowel(word[:-1]):
+        word = word[:-1] + "i"
+    return word
+
+@lru_cache(maxsize=65536)
+def _normalize_token(token):
+    # FTS5 (unicode61) выкидывает символы вроде «+» и «#», поэтому C++ и C# кодируем словами
+    token = token.replace("+", "plus").replace("#", "sharp")
+    if _CYRILLIC_RE.search(token):
+        return stem_russian(token)
+    return stem_english(token)
+
+def tokenize(text):
+    """Список нормализованных основ слов текста."""
+    # Числа не стеммируются и не засоряют кэш основ
+    return [token if token.isdigit() else _normalize_token(token) for token in _WORD_RE.findall((text or "").lower())]
+
+def normalize_text(text):
+    return " ".join(tokenize(text))
+
+def normalize_tags(tags):
+    # Теги хранятся через запятую; каждый тег нормализуется отдельно, пустые и повторы отбрасываются
+    seen = []
+    for tag in (tags or "").split(","):
+        tag = normalize_text(tag)
+        if tag and tag not in seen:
+            seen.append(tag)
+    return " , ".join(seen)
+
+def build_match_query(text):
+    """Запрос FTS5 MATCH: любая из основ запроса, каждая в кавычках, чтобы не было спецсинтаксиса."""
+    terms = []
+    for word in _WORD_RE.findall((text or "").lower()):
+        if word in STOP_WORDS:
+            continue
+        term = _normalize_token(word)
+        if term not in terms:
+            terms.append(term)
+    return " OR ".join(f'"{term}"' for term in terms)
@@ -0,0 +1,57 @@
+import json
+import os
+import zlib
+
+# Формат хранения прогресса пользователей.
+# Версия схемы записывается в PRAGMA user_version базы прогресса.
+SCHEMA_VERSION = 2
+
+# Тексты уроков длиннее порога сжимаются zlib; первый байт значения указывает формат
+LESSON_COMPRESS_THRESHOLD = int(os.getenv("LESSON_COMPRESS_THRESHOLD", "512"))
+_PLAIN = b"t"
+_ZLIB = b"z"
+
+# Поля прогресса, которые хранятся в собственных столбцах user_courses;
+# всё остальное (кроме самих уроков) попадает в JSON-столбец state
+PROGRESS_COLUMNS = (
+    "current_day", "chat_id", "progress", "skill", "current_question", "experience", "goal", "preferences",
+)
+PROGRESS_DEFAULTS = {
+    "current_day": 0, "chat_id": 0, "progress": 0, "skill": "", "current_question": 0,
+    "experience": "", "goal": "", "preferences": "",
+}
+
+def encode_lesson(text):
+    if text is None:
+        return None
+    raw = text.encode("utf-8")
+    if len(raw) >= LESSON_COMPRESS_THRESHOLD:
+        return _ZLIB + zlib.compress(raw)
+    return _PLAIN + raw
+
+def decode_lesson(blob):
+    if blob is None:
+        return None
+    blob = bytes(blob)
+    if blob[:1] == _ZLIB:
+        return zlib.decompress(blob[1:]).decode("utf-8")
+    if blob[:1] == _PLAIN:
+        return blob[1:].decode("utf-8")
+    raise ValueError(f"Неизвестный формат урока: {blob[:1]!r}")
+
+def encode_state(course_data):
+    state = {
+        key: value for key, value in course_data.items()
+        if key not in PROGRESS_COLUMNS and key != "course"
+    }
+    return json.dumps(state, ensure_ascii=False, separators=(",", ":"))
+
+def decode_state(text):
+    state = json.loads(text) if text else {}
+    # JSON не различает кортежи и списки, а пройденные уроки сравниваются как (навык, день)
+    if "completed_lessons" in state:
+        state["completed_lessons"] = [tuple(item) for item in state["completed_lessons"]]
+    return state
+
+def progress_row(course_data):
+    return tuple(course_data.get(column, PROGRESS_DEFAULTS[column]) for column in PROGRESS_COLUMNS)
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter, TelegramAPIError
+
+logger = logging.getLogger(__name__)
+
+# Как часто правим сообщение во время генерации: не чаще чем раз в STREAM_EDIT_INTERVAL секунд
+# и только если добавилось хотя бы STREAM_EDIT_CHARS символов (лимиты Telegram на правки)
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "1") == "1"
+STREAM_EDIT_CHARS = int(os.getenv("STREAM_EDIT_CHARS", "200"))
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+MAX_MESSAGE_LENGTH = 4096
+
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^<>]*>")
+_VOID_TAGS = {"br"}
+
+def balance_html(text):
+    """Обрезает незаконченный тег или сущность в конце текста и закрывает открытые теги,
+    чтобы частичный ответ можно было отправить с parse_mode="HTML"."""
+    last_open = text.rfind("<")
+    if last_open > text.rfind(">"):
+        text = text[:last_open]
+    last_amp = text.rfind("&")
+    if last_amp != -1 and ";" not in text[last_amp:]:
+        text = text[:last_amp]
+    stack = []
+    for match in _TAG_RE.finditer(text):
+        closing, name = match.group(1), match.group(2).lower()
+        if name in _VOID_TAGS:
+            continue
+        if not closing:
+            stack.append(name)
+        elif name in stack:
+            while stack and stack.pop() != name:
+                pass
+    return text + "".join(f"</{name}>" for name in reversed(stack))
+
+class MessageStreamer:
+    """Показывает генерируемый текст правками одного сообщения.
+
+    start() отправляет заглушку, update() вызывается с накопленным текстом на каждый
+    фрагмент ответа и правит сообщение с ограничением частоты, finish() ставит итоговый
+    текст и клавиатуру.
+    """
+
+    def __init__(self, bot, chat_id, placeholder="⏳ Готовлю ответ...", prefix="", reply_to_message_id=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.placeholder = placeholder
+        self.prefix = prefix
+        self.reply_to_message_id = reply_to_message_id
+        self.message = None
+        self._shown_length = 0
+        self._next_edit_at = 0.0
+
+    async def start(self):
+        self.message = await self.bot.send_message(
+            self.chat_id, self.placeholder, reply_to_message_id=self.reply_to_message_id
+        )
+        self._next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+        return self.message
+
+    async def update(self, text):
+        if not STREAMING_ENABLED or self.message is None:
+            return
+        if len(text) < self._shown_length:
+            self._shown_length = 0  # Генерация началась заново (повторная попытка)
+        now = time.monotonic()
+        if now < self._next_edit_at or len(text) - self._shown_length < STREAM_EDIT_CHARS:
+            return
+        partial = balance_html(self.prefix + text[:MAX_MESSAGE_LENGTH - len(self.prefix) - 10]) + " ▌"
+        self._shown_length = len(text)
+        self._next_edit_at = now + STREAM_EDIT_INTERVAL
+        await self._edit(partial)
+
+    async def queued(self, position):
+        # Запрос ждёт квоту Gemini — показываем место в очереди вместо заглушки
+        if self.message is not None:
+            await self._edit(f"⏳ Запрос в очереди, перед тобой: {position - 1}. Ответ появится здесь автоматически.")
+
+    async def finish(self, text, reply_markup=None):
+        if self.message is None or not await self._edit(self.prefix + text, reply_markup, final=True):
+            # Правка не удалась — отправляем итог отдельным сообщением
+            self.message = await self.bot.send_message(
+                self.chat_id, self.prefix + text, reply_markup=reply_markup, parse_mode="HTML"
+            )
+        return self.message
+
+    async def _edit(self, text, reply_markup=None, final=False):
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.message.message_id,
+                reply_markup=reply_markup, parse_mode="HTML"
+            )
+        except MessageNotModified:
+            pass
+        except RetryAfter as e:
+            logger.warning(f"Telegram ограничил правки сообщения на {e.timeout} секунд")
+            self._next_edit_at = time.monotonic() + e.timeout
+            if final:
+                # Итоговый текст обязательно должен дойти: ждём и пробуем ещё раз
+                await asyncio.sleep(e.timeout)
+                return await self._edit(text, reply_markup, final=True)
+        except TelegramAPIError as e:
+            logger.warning(f"Не удалось обновить сообщение: {e}")
+            return False
+        return True
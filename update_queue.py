@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from aiogram import Bot, Dispatcher
+
+logger = logging.getLogger(__name__)
+
+# Пул обработчиков апдейтов в режиме webhook. Обработчики в основном ждут Gemini и Telegram,
+# поэтому их может быть заметно больше, чем ядер
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "10000"))
+UPDATE_DRAIN_TIMEOUT = 30
+
+def update_user_id(update):
+    """ID пользователя, от которого пришёл апдейт, или None для служебных апдейтов."""
+    for event in (
+        update.message, update.edited_message, update.callback_query, update.inline_query,
+        update.chosen_inline_result, update.my_chat_member, update.chat_member,
+    ):
+        if event is not None and event.from_user is not None:
+            return event.from_user.id
+    return None
+
+class UpdateQueue:
+    """Очередь входящих апдейтов с пулом обработчиков.
+
+    Апдейты одного пользователя выполняются строго по порядку, апдейты разных пользователей —
+    параллельно: у каждого пользователя своя очередь, а обработчик берёт следующего пользователя,
+    у которого есть необработанные апдейты. Долгий запрос к Gemini задерживает только его автора.
+    """
+
+    def __init__(self, dp, workers=UPDATE_WORKERS, maxsize=UPDATE_QUEUE_SIZE):
+        self.dp = dp
+        self.workers = workers
+        self.maxsize = maxsize
+        self._pending = {}
+        self._ready = asyncio.Queue()
+        self._tasks = []
+        self.size = 0
+        self.processed = 0
+        self.rejected = 0
+
+    def put(self, update):
+        """Ставит апдейт в очередь; False, если очередь переполнена."""
+        if self.size >= self.maxsize:
+            self.rejected += 1
+            return False
+        key = update_user_id(update)
+        if key is None:
+            key = f"update:{update.update_id}"
+        queue = self._pending.get(key)
+        if queue is None:
+            self._pending[key] = deque([update])
+            self._ready.put_nowait(key)
+        else:
+            # Пользователь уже в работе или ждёт обработчика — апдейт выполнится после предыдущих
+            queue.append(update)
+        self.size += 1
+        return True
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        logger.info(f"Запущено обработчиков апдейтов: {self.workers}")
+
+    async def stop(self, timeout=UPDATE_DRAIN_TIMEOUT):
+        # Даём обработать уже принятые апдейты, затем останавливаем обработчиков
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не обработано апдейтов при остановке: {self.size}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            key = await self._ready.get()
+            queue = self._pending[key]
+            # Апдейт остаётся в очереди до конца обработки, чтобы новые апдейты того же
+            # пользователя не попали к другому обработчику
+            update = queue[0]
+            try:
+                await self.dp.process_update(update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                queue.popleft()
+                self.size -= 1
+                self.processed += 1
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                self._ready.task_done()
+
+    def stats(self):
+        return {"queued": self.size, "users": len(self._pending), "processed": self.processed, "rejected": self.rejected}
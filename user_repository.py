@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from database import load_user_course, save_user_changes
+
+logger = logging.getLogger(__name__)
+
+# Сколько пользователей держать в памяти; остальные подгружаются из базы при первом обращении
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1000"))
+# Изменения прогресса копятся PROGRESS_FLUSH_INTERVAL секунд (или до PROGRESS_FLUSH_BATCH
+# пользователей) и записываются одной транзакцией
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", "0.2"))
+PROGRESS_FLUSH_BATCH = int(os.getenv("PROGRESS_FLUSH_BATCH", "500"))
+PROGRESS_CLOSE_TIMEOUT = 10
+
+class PendingChanges:
+    """Несохранённые изменения одного пользователя."""
+
+    def __init__(self):
+        self.progress = False  # метаданные прогресса
+        self.full = False  # курс целиком вместе с уроками
+        self.lessons = {}  # день -> текст урока
+
+class UserRepository:
+    """Состояние курсов пользователей с ленивой загрузкой из базы и LRU-кэшем активных пользователей.
+
+    Обработчики меняют полученный словарь на месте и затем сообщают об изменениях
+    через save_progress/save_lesson. Пользователи без записи в базе тоже кэшируются (как None),
+    чтобы повторные /help и /donate не ходили в базу.
+
+    Запись отложенная: методы save_* только отмечают пользователя, а фоновая задача раз в
+    flush_interval записывает всех отмеченных одной транзакцией. Несколько изменений одного
+    пользователя между записями сливаются в одну. Что это значит при сбое:
+    - изменения, о которых пользователь уже узнал, становятся постоянными не позже чем
+      через flush_interval; при аварийном завершении процесса последние изменения теряются
+      (пользователь увидит прогресс на шаг-два назад), но не перемешиваются;
+    - каждая запись — одна транзакция, поэтому в базе всегда согласованное состояние
+      на момент одной из записей: метаданные и уроки пользователя не расходятся;
+    - при ошибке записи изменения остаются в очереди и записываются следующей попыткой;
+    - close() в on_shutdown записывает всё накопленное.
+    Пользователи с несохранёнными изменениями не вытесняются из кэша, в том числе пока их
+    запись идёт: иначе при ошибке записи прогресс было бы не из чего повторить, а get()
+    мог бы перечитать из базы данные до окончания транзакции.
+    """
+
+    def __init__(self, max_users=USER_CACHE_SIZE, flush_interval=PROGRESS_FLUSH_INTERVAL, flush_batch=PROGRESS_FLUSH_BATCH):
+        self.max_users = max_users
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._cache = OrderedDict()
+        self._loading = {}
+        self._pending = {}
+        self._inflight = set()  # пользователи, чья запись сейчас идёт
+        self._batch_ready = asyncio.Event()
+        self._flush_task = None
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.written = 0
+
+    async def get(self, user_id):
+        """Запись пользователя (в том числе без активного курса) или None."""
+        if user_id in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(user_id)
+            return self._cache[user_id]
+        # Параллельные запросы одного пользователя ждут одну загрузку, иначе они получат разные словари
+        task = self._loading.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(user_id))
+            self._loading[user_id] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id):
+        try:
+            try:
+                data = await load_user_course(user_id)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки данных пользователя {user_id}: {e}")
+                raise
+            if user_id not in self._cache:
+                pending = self._pending.get(user_id)
+                if pending and data and data.get("course"):
+                    # Уроки, сохранённые после вытеснения пользователя, ещё не записаны в базу
+                    for day, lesson in pending.lessons.items():
+                        if day < len(data["course"]):
+                            data["course"][day] = lesson
+                self._put(user_id, data)
+            return self._cache[user_id]
+        finally:
+            self._loading.pop(user_id, None)
+
+    def _put(self, user_id, data):
+        self._cache[user_id] = data
+        self._cache.move_to_end(user_id)
+        self._evict()
+
+    def _evict(self):
+        # Несохранённые и записываемые сейчас пользователи не вытесняются; после записи в базу
+        # они станут обычными
+        while len(self._cache) > self.max_users:
+            user_id = next(iter(self._cache))
+            if user_id in self._pending or user_id in self._inflight:
+                break
+            self._cache.popitem(last=False)
+
+    def _changes(self, user_id):
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = self._pending[user_id] = PendingChanges()
+            if len(self._pending) >= self.flush_batch:
+                self._batch_ready.set()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        return pending
+
+    async def _flush_loop(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи прогресса пользователей: {e}")
+
+    async def flush(self):
+        """Записывает накопленные изменения всех пользователей одной транзакцией."""
+        pending, self._pending = self._pending, {}
+        courses = []
+        lessons = []
+        for user_id, changes in pending.items():
+            data = self._cache.get(user_id)
+            if data is not None and (changes.full or changes.progress):
+                courses.append((user_id, data, changes.full))
+            if not changes.full or data is None:
+                lessons.extend((user_id, day, lesson) for day, lesson in changes.lessons.items())
+        self._inflight.update(pending)
+        try:
+            if courses or lessons:
+                await save_user_changes(courses, lessons)
+        except BaseException:
+            # Возвращаем изменения в очередь, не затирая сделанные за время записи
+            for user_id, changes in pending.items():
+                newer = self._pending.get(user_id)
+                if newer is not None:
+                    changes.progress |= newer.progress
+                    changes.full |= newer.full
+                    changes.lessons = {**changes.lessons, **newer.lessons} if not newer.full else newer.lessons
+                self._pending[user_id] = changes
+            raise
+        finally:
+            self._inflight.difference_update(pending)
+        self.flushes += 1
+        self.written += len(pending)
+        self._evict()
+
+    async def close(self):
+        # Фоновую запись не отменяем посреди транзакции, а дожидаемся её
+        if self._flush_task and not self._flush_task.done():
+            self._batch_ready.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._flush_task), PROGRESS_CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error("Не удалось дождаться записи прогресса при завершении")
+                return
+        if self._pending:
+            await self.flush()
+
+    async def get_course(self, user_id):
+        """Запись пользователя, только если у него есть активный курс."""
+        data = await self.get(user_id)
+        if data and data.get("course"):
+            return data
+        return None
+
+    async def has_course(self, user_id):
+        return await self.get_course(user_id) is not None
+
+    async def completed_lessons(self, user_id):
+        data = await self.get(user_id)
+        return list(data.get("completed_lessons", [])) if data else []
+
+    async def start_course(self, user_id, course_data):
+        self._put(user_id, course_data)
+        self._save_full(user_id)
+
+    async def drop_course(self, user_id):
+        """Удаляет активный курс, сохраняя историю пройденных уроков."""
+        data = {"completed_lessons": await self.completed_lessons(user_id)}
+        self._put(user_id, data)
+        self._save_full(user_id)
+
+    def _save_full(self, user_id):
+        changes = self._changes(user_id)
+        changes.full = True
+        changes.lessons = {}  # Уроки прежнего курса больше не нужны
+
+    async def save_progress(self, user_id):
+        if user_id in self._cache:
+            self._changes(user_id).progress = True
+
+    async def save_lesson(self, user_id, day, lesson):
+        # Урок может прийти из фоновой генерации, когда пользователь уже вытеснен из кэша:
+        # тогда текст урока хранится в очереди до записи
+        data = self._cache.get(user_id)
+        if data and day < len(data.get("course", [])):
+            data["course"][day] = lesson
+        self._changes(user_id).lessons[day] = lesson
+
+    def stats(self):
+        return {
+            "cached": len(self._cache), "hits": self.hits, "misses": self.misses,
+            "pending": len(self._pending), "flushes": self.flushes, "written": self.written,
+        }
+
+users = UserRepository()